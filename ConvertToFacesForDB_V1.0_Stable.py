@@ -1,29 +1,53 @@
+import json
 import os
-from deepface import DeepFace
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import cv2
+from face_index import FaceIndex, image_extensions, perceptual_hash
+from face_pipeline import init_worker, process_images, use_inference_backend
 
 # User Inputs:
 input_folder_path = r".\convertToFaces_input"
 output_folder_path = r".\convertedFaces_output"
+manifest_path = r".\convertToFaces_manifest.json"  # The converted photos (path, modification time, size) are skipped the next time
+
+# Face index of "FaceRecognition-Eagle" (the embeddings of the saved faces are added to it, no need to embed them again):
+index_folder = r".\face_index"  # None: don't add the faces to the face index
+database_path = r".\my_db"  # Faces saved in the Database are added to the index at once, the other faces when they are copied to the Database
 
 # Model/Script Properties:
 model_name = "Facenet512"
 detector_backend = "fastmtcnn"
 expand_percentage = 20  # How much to expand the face cropping area in percentage %, Keep Constant through all Database
-threshold = 500
+detection_max_side = 1920  # Bigger images are reduced to this size for face detection (None: full resolution)
+tile_min_pixels = 40_000_000  # Bigger images (panoramas, scans) are detected in overlapping tiles (None: no tiles)
+tile_size = 1600  # Width/height of the tiles in pixels
+tile_overlap = 320  # Pixels in common between two tiles
+inference_backend = "deepface"  # "deepface" or "onnx": models run with ONNX Runtime (see FaceRecognition-Eagle)
+onnx_folder = r".\onnx_models"  # The exported ONNX models (same folder as FaceRecognition-Eagle)
+onnx_quantize = False  # True: int8 embedding model
+
+# Concurrent processing:
+num_workers = None  # Number of processes for detection & embedding (None: number of CPU cores)
+chunk_size = 8  # Number of photos sent together to a worker (their faces are embedded together)
+embedding_batch_size = 32  # Number of faces embedded together in one model call
+manifest_save_every = 20  # Number of chunks between two saves of the manifest and of the pending faces of the face
+#                           index (an interrupted run converts the photos of the last chunks again)
 
 def list_files(folder_path):
     """
-    Lists all files in a folder and its subfolders recursively.
+    Lists all image files in a folder and its subfolders recursively.
     Args:
         folder_path (string): Path to the folder.
     Returns:
-        All files in a folder and its subfolders recursively.
+        All image files in a folder and its subfolders recursively (the other files are skipped).
     """
     all_files = []
     for root, dirs, files in os.walk(folder_path):
         # Print the full path of each file
         for filename in files:
+            if not filename.lower().endswith(image_extensions):
+                continue
             file_path = os.path.join(root, filename)
             all_files.append(file_path)
             # print(os.path.join(root, filename))
@@ -60,36 +84,6 @@ def change_root_path(file_path, old_root, new_root):
     return new_path
 
 
-def clip_coordinates(facial_area, image_width, image_height):
-    """
-    Clips the coordinates of a facial area dictionary to stay within image borders.
-
-    Args:
-        facial_area: A dictionary or pandas containing facial area information.
-        image_width: The width of the image.
-        image_height: The height of the image.
-
-    Returns:
-        A new dictionary with clipped coordinates.
-    """
-
-    if "dict" in str(type(facial_area)):
-        clipped_area = {}
-        clipped_area['x'] = max(0, min(facial_area['x'], image_width - 1))
-        clipped_area['y'] = max(0, min(facial_area['y'], image_height - 1))
-        clipped_area['w'] = min(facial_area['w'], image_width - clipped_area['x'])
-        clipped_area['h'] = min(facial_area['h'], image_height - clipped_area['y'])
-        return clipped_area
-
-    elif "pandas" in str(type(facial_area)):
-        clipped_area = {}
-        clipped_area['x'] = max(0, min(facial_area['source_x'][0], image_width - 1))
-        clipped_area['y'] = max(0, min(facial_area['source_y'][0], image_height - 1))
-        clipped_area['w'] = min(facial_area['source_w'][0], image_width - clipped_area['x'])
-        clipped_area['h'] = min(facial_area['source_h'][0], image_height - clipped_area['y'])
-        return clipped_area
-
-
 def create_unique_image_name(folder_path, original_name):
     """
     Creates a folder with a unique name based on the original name and then add "_" and incrementing number.
@@ -110,85 +104,242 @@ def create_unique_image_name(folder_path, original_name):
         num += 1
 
 
-def crop_face(original_image, facial_area):
+def load_manifest(path):
+    """
+    Loads the manifest of the converted photos: {photo path: {"mtime", "size", "faces"}}.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def save_manifest(manifest, path):
+    """
+    Saves the manifest of the converted photos (the old file is replaced only when the new one is complete).
+    """
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def save_progress(manifest, face_index):
+    """
+    Saves the manifest and the embeddings of the faces saved outside of the Database (pending faces of the index).
     """
-    Checks if two images are identical using pixel-by-pixel comparison.
+    if face_index is not None:
+        face_index.save_pending()
+    save_manifest(manifest, manifest_path)
+
+
+def remove_old_faces(face_paths, face_index):
+    """
+    Deletes the faces saved from a photo that changed since it was converted, and removes them from the face index
+    (and its pending faces), so the new faces don't add to the old ones.
 
     Args:
-      original_image : the original image loaded by cv2.
-      facial_area : the dictionary or pandas containing facial area information.
+      face_paths: The paths of the old faces (from the manifest).
+      face_index: The FaceIndex the faces were added to (or None).
+    """
+    if face_index is not None:
+        face_index.remove(face_paths)
+    removed = 0
+    for face_path in face_paths:
+        try:
+            os.remove(face_path)
+            removed += 1
+        except FileNotFoundError:  # Deleted or moved by the user
+            continue
+    print(f"{removed} old faces of the changed photos deleted.")
+
+
+def open_face_index():
+    """
+    Opens the face index of "FaceRecognition-Eagle" if it was made with the same model and detector.
 
     Returns:
-      cropped_face: the cropped face, ready to save.
+      The FaceIndex, or None if index_folder is None or the index was made with other settings.
+    """
+    if index_folder is None:
+        return None
+    signature = {"model_name": model_name, "detector_backend": detector_backend, "face": "aligned"}
+    saved_signature = FaceIndex.read_signature(index_folder, model_name)
+    if saved_signature is not None and saved_signature != signature:  # Don't reset the index of the other script
+        print(f"Face index in '{index_folder}' was made with other settings, the faces won't be added to it.")
+        return None
+    os.makedirs(index_folder, exist_ok=True)
+    return FaceIndex(index_folder, database_path, fr"{database_path}\[new_faces]", model_name, signature)
+
+
+def is_in_database(path):
     """
-    clipped_area = clip_coordinates(facial_area, original_image.shape[1], original_image.shape[
-        0])  # Get the image cropping area, Assuming image is a NumPy array
+    Checks if a path is inside the Database folder.
+    """
+    database = os.path.abspath(database_path)
+    try:
+        return os.path.commonpath([os.path.abspath(path), database]) == database
+    except ValueError:  # On another drive than the Database (Windows)
+        return False
 
-    # Use clipped_area for cropping:
-    cropped_face = original_image[clipped_area['y']:clipped_area['y'] + clipped_area['h'],
-                   clipped_area['x']:clipped_area['x'] + clipped_area['w']]
 
-    return cropped_face
+def read_images(files):
+    """
+    Reads the image files of a chunk to send them to a worker.
 
-# ----------------------------------------------------------------------------------------------------
+    Returns:
+      A list of (file, file, file_bytes), the files that couldn't be read are skipped.
+    """
+    images = []
+    for file in files:
+        try:
+            with open(file, "rb") as image_file:
+                images.append((file, file, image_file.read()))
+        except OSError as e:  # Handel Errors
+            print(f"Couldn't read {file}: {e}")
+    return images
 
 
-# Create script folders (input_folder_path, output_folder_path)
-script_folder_list = [input_folder_path, output_folder_path]
-for folder in script_folder_list:
-    # Check if the folder exists
-    if not os.path.exists(folder):
-        # Create the folder if it doesn't exist
-        os.makedirs(folder)
-        print(f"Folder '{folder}' created successfully.")
-    else:
-        print(f"Folder '{folder}' already exists.")
+def save_faces(file, faces):
+    """
+    Saves the faces of a photo to convertedFaces_output in the same subfolder name.
 
+    Args:
+      file: The path of the photo.
+      faces: The faces from process_images (with "crop" and "embedding").
+
+    Returns:
+      A list of (saved path, face).
+    """
+    saved_faces = []
+    for face in faces:
+        cropped_face = face['crop']  # The face cropped from the original image, expanded with expand_percentage
+
+        # Save cropped_face to convertedFaces_output in same subfolder name:
+        new_root_path = change_root_path(file, input_folder_path.split("\\")[-1], output_folder_path.split("\\")[-1])
+        new_root_path_no_ext = new_root_path.rsplit(".", 1)[0]
+        new_image_save_path = f"{new_root_path_no_ext}.jpg"
+        new_image_name = new_image_save_path.split("\\")[-1]
+        new_image_name_no_ext = new_image_name.rsplit(".", 1)[0]
+
+        # Try to create the directory (and any missing parent directories)
+        directory = os.path.dirname(new_image_save_path)
+        try:
+            os.makedirs(directory, exist_ok=True)  # exist_ok avoids errors if directory exists
+        except OSError:
+            print(f"Error creating directory: {directory}")
+
+        if os.path.exists(new_image_save_path):
+            print("File with same name already exists!")
+            new_image_save_path = create_unique_image_name(directory, new_image_name_no_ext)
+
+        if cv2.imwrite(new_image_save_path, cropped_face):
+            saved_faces.append((new_image_save_path, face))
+            print(f"Face cropped and saved successfully!, to Folder: {new_image_save_path}")
+        else:
+            print(f"Couldn't save the face to: {new_image_save_path}")
+    return saved_faces
 
-all_files = list_files(input_folder_path)
-# print(all_files)
 
-# Extract faces using DeepFace and save them in output_folder_path:
-for file in all_files:
-    try:
-        # Detect and Extract the face:
-        extracted_face = DeepFace.extract_faces(img_path=str(file), enforce_detection=True,
-                                                detector_backend=detector_backend, expand_percentage=expand_percentage)
-
-        img = cv2.imread(str(file))  # Read the image
-        for face in range(len(extracted_face)):
-            facial_area = extracted_face[face]['facial_area']  # Get the facial area from DeepFace.extract_faces result
-            cropped_face = crop_face(img, facial_area)  # Crop the Face from original image
-
-            # Save cropped_face to convertedFaces_output in same subfolder name:
-            new_root_path = change_root_path(file, input_folder_path.split("\\")[-1], output_folder_path.split("\\")[-1])
-            new_root_path_no_ext = new_root_path.rsplit(".", 1)[0]
-            new_image_save_path = f"{new_root_path_no_ext}.jpg"
-            new_image_name = new_image_save_path.split("\\")[-1]
-            new_image_name_no_ext = new_image_name.rsplit(".", 1)[0]
-
-            # Try to create the directory (and any missing parent directories)
-            directory = os.path.dirname(new_image_save_path)
-            try:
-                os.makedirs(directory, exist_ok=True)  # exist_ok avoids errors if directory exists
-            except OSError:
-                print(f"Error creating directory: {directory}")
-
-            if os.path.exists(new_image_save_path):
-                print("File with same name already exists!")
-                new_root_path_only = new_root_path_no_ext.rsplit("\\", 1)[0]
-                unique_name = create_unique_image_name(directory, new_image_name_no_ext)
-                cv2.imwrite(unique_name, cropped_face)
-                print("Face cropped and saved successfully! with unique name")
-
-            else:
-                cv2.imwrite(new_image_save_path, cropped_face)
-                print(f"Face cropped and saved successfully!, to Folder: {new_image_save_path}")
-
-    except Exception as e:
-        if "Face could not be detected" in str(e):  # Handel Face could not be detected
+def record_results(chunk_results, file_stats, manifest, face_index):
+    """
+    Saves the faces found by a worker, adds them to the face index and records the photos in the manifest.
+
+    Args:
+      chunk_results: (results, worker_metrics, rejected_faces) from process_images.
+      file_stats: {photo path: {"mtime", "size"}} of the photos to convert.
+      manifest: The manifest of the converted photos (saved by save_progress every manifest_save_every chunks).
+      face_index: The FaceIndex to add the faces to (or None).
+    """
+    results, _, _ = chunk_results
+    pending_faces = []
+    for file, status, result in results:
+        saved_faces = []
+        if status == "faces":
+            saved_faces = save_faces(file, result)
+        elif status == "no_face":  # Handel Face could not be detected
             print(f"Face could not be detected in {file}")
         else:
-            print(e)  # Handel Other Errors
+            print(result)  # Handel Other Errors
+            continue
+
+        if face_index is not None:
+            for save_path, face in saved_faces:
+                if face.get('embedding') is None:
+                    continue
+                if is_in_database(save_path):  # Searchable at once by FaceRecognition-Eagle
+                    face_index.add(save_path, face['embedding'], perceptual_hash(face['crop']))
+                else:  # Used when the face is copied to the Database
+                    pending_faces.append((save_path, face['embedding']))
+
+        manifest[file] = dict(file_stats[file], faces=[save_path for save_path, face in saved_faces])
+
+    if face_index is not None:
+        face_index.add_pending(pending_faces, save=False)  # Saved with the manifest
 
-print("Process Done!")
+
+# ----------------------------------------------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    # Create script folders (input_folder_path, output_folder_path)
+    script_folder_list = [input_folder_path, output_folder_path]
+    for folder in script_folder_list:
+        # Check if the folder exists
+        if not os.path.exists(folder):
+            # Create the folder if it doesn't exist
+            os.makedirs(folder)
+            print(f"Folder '{folder}' created successfully.")
+        else:
+            print(f"Folder '{folder}' already exists.")
+
+    # Skip the photos that were already converted and didn't change since
+    manifest = load_manifest(manifest_path)
+    all_files = list_files(input_folder_path)
+    file_stats = {}
+    for file in all_files:
+        stat = os.stat(file)
+        file_stat = {"mtime": int(stat.st_mtime), "size": stat.st_size}
+        converted = manifest.get(file)
+        if converted is None or converted["mtime"] != file_stat["mtime"] or converted["size"] != file_stat["size"]:
+            file_stats[file] = file_stat
+    files_to_convert = list(file_stats)
+    print(f"{len(all_files) - len(files_to_convert)} photos already converted, {len(files_to_convert)} to convert.")
+
+    face_index = open_face_index()
+    old_faces = [face for file in files_to_convert for face in manifest.get(file, {}).get("faces", [])]
+    if old_faces:
+        remove_old_faces(old_faces, face_index)
+
+    # The ONNX models are exported once here, before the workers load them
+    inference = {"folder": onnx_folder, "quantize": onnx_quantize} if inference_backend == "onnx" else None
+    if inference:
+        use_inference_backend(inference, model_name, detector_backend)
+
+    # Extract faces using DeepFace and save them in output_folder_path (the photos are processed by a pool of
+    # workers, every worker loads the models once):
+    workers = max(1, os.cpu_count() if num_workers is None else num_workers)
+    settings = {"model_name": model_name, "detector_backend": detector_backend,
+                "expand_percentage": expand_percentage, "batch_size": embedding_batch_size,
+                "detection_max_side": detection_max_side,
+                "threads_per_worker": max(1, (os.cpu_count() or 1) // workers), "inference": inference,
+                "tiling": {"min_pixels": tile_min_pixels, "tile_size": tile_size,
+                           "overlap": tile_overlap} if tile_min_pixels else None}
+    recorded_chunks = 0
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(settings,)) as executor:
+            in_flight = deque()  # The chunks sent to the workers, in order
+            for start in range(0, len(files_to_convert), chunk_size):
+                in_flight.append(executor.submit(process_images,
+                                                 read_images(files_to_convert[start:start + chunk_size])))
+                # Wait for the oldest chunk when the workers are busy (don't read all the photos in memory)
+                while len(in_flight) >= workers * 2:
+                    record_results(in_flight.popleft().result(), file_stats, manifest, face_index)
+                    recorded_chunks += 1
+                    if recorded_chunks % manifest_save_every == 0:
+                        save_progress(manifest, face_index)
+            while in_flight:
+                record_results(in_flight.popleft().result(), file_stats, manifest, face_index)
+    finally:  # The photos converted before an error or Ctrl+C are skipped the next time
+        save_progress(manifest, face_index)
+
+    print("Process Done!")
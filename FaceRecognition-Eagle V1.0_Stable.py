@@ -1,408 +1,448 @@
 # Tag matched face and create new faces in Database but don't tag them in Eagle as "New Face_{Num}".
-import requests
-from urllib.parse import unquote
-from deepface import DeepFace
+from deepface.modules.verification import find_threshold
 import cv2
+import numpy as np
 import os
-from PIL import ImageChops
-from PIL import Image
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from eagle_client import EagleClient, EagleError, ItemPathResolver
+from ann_index import IVFIndex
+from compact_embeddings import CompactEmbeddings
+from face_index import FaceIndex, perceptual_hash
+from prototype_index import PrototypeIndex
+from rematch import rematch_faces
+from face_pipeline import (ThreadStage, crop_face, detect_faces, get_face_embedder, init_worker, process_images,
+                           use_inference_backend)
+from run_journal import PageCursor, RunJournal, content_hash
+from unknown_faces import NameAllocator, UnknownFaceClusters
+from metrics import metrics
+from work_leases import LeaseStore
 
 # -----------------------------------------------------------
 # Eagle default API URL:
-BASE_API_URL = "http://localhost:41595"
+BASE_API_URL = os.environ.get("EAGLE_API_URL", "http://localhost:41595")  # EAGLE_API_URL: e.g. the benchmark mock
+eagle_timeout = 30  # Timeout in seconds of every Eagle API call
+eagle_retries = 3  # How many times a failed Eagle API call is retried (with increasing wait)
 
 # Folder to Process:
 folderNameToProcess = "FaceReco_Process"
 
+# Daemon mode (run with --daemon): keep running, the models and the face index stay loaded and Eagle is polled
+# for the new items of folderNameToProcess (only the items added since the last poll are listed)
+daemon_mode = "--daemon" in sys.argv
+daemon_poll_interval = 30  # Seconds between two polls of Eagle
+daemon_full_scan_every = 20  # Every N polls the whole folder is listed (e.g. photos moved into the folder keep
+#                              their old creation date) and the face index is synced with the Database folder
+
+# Re-match mode (run with --rematch after renaming, merging or deleting folders of the Database): the faces of the
+# processed items are matched again from their embeddings kept in the journal (no detection), and only the changed
+# tags are written to Eagle
+rematch_mode = "--rematch" in sys.argv
+
+# Worker mode (run with --worker): several copies of the script on the same computer process the same Eagle
+# folder and share the same Database. Every item is claimed by one worker, the Database writes are locked
+worker_mode = "--worker" in sys.argv
+lease_store_path = r".\face_reco_leases.sqlite"  # Shared by all the workers (on a local disk, not a network drive)
+lease_seconds = 300  # The items of a worker that stopped are claimed by the other workers after this time
+
 # -----------------------------------------------------------
 # User Parameters to change:
 database_path = r".\my_db"  # do not give full path it will not get the person name correctly. Give relative path is better.
 new_faces_path = fr"{database_path}\[new_faces]"
-tempo_folder = r".\tempo"
+index_folder = r".\face_index"  # Embeddings of all the faces in the Database (replace DeepFace .pkl file)
+journal_path = r".\face_reco_journal.sqlite"  # Journal of the processed photos (re-runs skip the photos already done)
 
 model_name = "Facenet512"
 detector_backend = "fastmtcnn"
 distance_metric = "cosine"  # default is "cosine"
 expand_percentage = 20  # How much to expand the face cropping area in percentage %
-threshold = 500
+detection_max_side = 1920  # Bigger photos are reduced to this size for face detection, the faces are still cropped
+#                            from the full resolution photo (None: detect on the full resolution photo)
+thumbnail_detection = False  # Detect the faces on the Eagle thumbnail first (much faster for big photos), the full
+#                              photo is used when no face is found on the thumbnail or a face is too small
+thumbnail_min_face = 32  # Min size in pixels of a face on the thumbnail (smaller: detect on the full photo)
+tile_min_pixels = 40_000_000  # Photos with more pixels (panoramas, scans) are detected in overlapping tiles at full
+#                               resolution, the small faces are not lost in the reduced copy (None: no tiles)
+tile_size = 1600  # Width/height of the tiles in pixels (the memory of the detector depends on it)
+tile_overlap = 320  # Pixels in common between two tiles (the bigger faces are found on the reduced copy)
+tile_threads = None  # Tiles of a photo detected at the same time (None: the CPU cores of the detection worker)
+distance_threshold = None  # None: use DeepFace default threshold for model_name & distance_metric
+duplicate_distance = 0.25  # A face is already in the Database if its distance to a face of the matched folder is
+#                            below duplicate_distance * threshold and their perceptual hashes are almost the same
+duplicate_hash_bits = 10  # Max number of different bits (out of 64) between the perceptual hashes of a duplicate
+unknown_cluster_threshold = None  # Max distance between a face with no match and the average face of a "New Face"
+#                                   folder to be saved in it (None: same as the matching threshold)
+embedding_batch_size = 32  # Number of faces (from one or more photos) embedded together in one model call
+embedding_batch_window = 2  # Max seconds a photo waits to be sent to a detection worker with the next photos
+search_mode = "exact"  # "exact": compare with every face of the Database, "ivf": approximate search (for 100k+ faces)
+ivf_probes = 8  # "ivf" search: number of face clusters searched per face (more = better recall, slower)
+embedding_storage = "float32"  # Embeddings used by the search: "float32", "float16" (half the RAM) or "int8" (a
+#                                quarter), check the match decisions with: python compact_embeddings.py --storage int8
+matching_mode = "nearest"  # "nearest": nearest face image, "prototypes": nearest person (average + typical faces)
+num_prototypes = 3  # "prototypes" matching: number of typical faces kept per person folder (plus the average face)
+
+# Face quality gate (the rejected faces are not embedded, not tagged and not saved to the Database):
+min_face_size = 0  # Min width/height in pixels of a face in the photo, e.g. 32 (0: no limit)
+min_face_confidence = 0  # Min confidence of the detector, e.g. 0.9 (0: no limit)
+min_face_sharpness = 0  # Min variance of the Laplacian of the face, e.g. 30 to reject blurry faces (0: no limit)
+max_face_asymmetry = None  # Max offset of the eyes center from the face center / face width, e.g. 0.2 to reject
+#                            profile faces (None: no limit)
+
+# Inference backend of the detection & embedding models (CPU):
+inference_backend = "deepface"  # "deepface": TensorFlow/PyTorch models of DeepFace, "onnx": the same models exported
+#                                 to ONNX and run with ONNX Runtime (check the results with: python onnx_backend.py)
+onnx_folder = r".\onnx_models"  # The exported ONNX models (exported on the first run)
+onnx_quantize = False  # True: int8 embedding model (faster, check it with: python onnx_backend.py --quantize)
+onnx_intra_op_threads = None  # Threads per model call (None: the CPU cores shared between the detection workers)
+onnx_inter_op_threads = 1  # Threads running independent parts of a model at the same time
+
+# Concurrent processing:
+detection_workers = None  # Number of processes for detection & embedding (None: number of CPU cores, 0: no process)
+io_workers = 4  # Number of threads getting the photos from Eagle and reading the files
+pipeline_chunk_size = 8  # Number of photos sent together to a detection worker (their faces are embedded together)
+pipeline_queue_size = 32  # Max number of photos waiting between the stages
+tag_write_batch_size = 1  # Number of items sent together to the tag writer (1: write every item as soon as it's done)
+
+# Metrics (time of every stage, counters):
+metrics_enabled = os.environ.get("FACE_RECO_METRICS") == "1"  # True: record the metrics (benchmark.py turns them on)
+metrics_path = r".\face_reco_metrics.jsonl"  # A JSON line with all the metrics is added every metrics_interval
+metrics_interval = 60  # Seconds between two writes of the metrics
+metrics_prometheus_path = None  # Prometheus text file, e.g. r".\face_reco_metrics.prom" (None: no file)
+metrics_prometheus_port = None  # Prometheus endpoint port, e.g. 9108 for http://localhost:9108/metrics (None: off)
+metrics_prometheus_host = "127.0.0.1"  # Address of the endpoint ("0.0.0.0": reachable from the whole network)
 
 # -----------------------------------------------------------
-# Create script folders (my_db, tempo)
-script_folder_list = [database_path, new_faces_path, tempo_folder]
-for folder in script_folder_list:
-    # Check if the folder exists
-    if not os.path.exists(folder):
-        # Create the folder if it doesn't exist
-        os.makedirs(folder)
-        print(f"Folder '{folder}' created successfully.")
-    else:
-        print(f"Folder '{folder}' already exists.")
+# Eagle API client (one connection pool for all the calls):
+eagle = EagleClient(BASE_API_URL, timeout=eagle_timeout, retries=eagle_retries, pool_size=io_workers + 2)
+# Unique folder and image names of the Database (from counters):
+name_allocator = NameAllocator()
+# Inference backend of the models (saved with the journal results too, None: DeepFace):
+inference = {"folder": onnx_folder, "quantize": onnx_quantize, "intra_op_threads": onnx_intra_op_threads,
+             "inter_op_threads": onnx_inter_op_threads} if inference_backend == "onnx" else None
+# Tiled detection of the very large photos (saved with the journal results too):
+tiling = {"min_pixels": tile_min_pixels, "tile_size": tile_size, "overlap": tile_overlap,
+          "threads": tile_threads} if tile_min_pixels else None
+# Face quality gate of the detection workers (saved with the journal results too):
+quality_gate = {"min_size": min_face_size, "min_confidence": min_face_confidence,
+                "min_sharpness": min_face_sharpness, "max_asymmetry": max_face_asymmetry}
+quality_rejects = Counter()  # Number of faces rejected by the quality gate per reason
+# Checkpoint of the item listing, an interrupted run continues from the last page that is not done (one-shot run):
+page_cursor = None
+# Leases of the items and lock of the Database writes (worker mode):
+lease_store = None
 
 
 def get_folderID(folderName):
-    response = requests.get(f'{BASE_API_URL}/api/folder/list')
-    data = response.json()
-
-    folders = data['data']
-
     # Get the folder ID:
-    for folder in folders:
-        if folder['name'] == folderName:
-            folderID = folder['id']
-            print("Folder ID is:", folderID, "\n")  # Print folder ID.
+    folderID = eagle.get_folder_id(folderName)
+    print("Folder ID is:", folderID, "\n")  # Print folder ID.
     return folderID
 
 
-def get_items_with_no_FaceTag(max_iterations=None, folderID=None):
-    offset = 0
-    limit = 200
-    items_with_no_FaceTag = []
+# Only get files in these extensions 'jpg', 'jpeg', 'png', 'bmp', 'webp', 'avif', 'jfif' &
+# does not have one of the following tags: 'Auto_FaceReco', 'No_FaceReco', 'Broken_FaceReco'
+desired_extensions = {'jpg', 'jpeg', 'png', 'bmp', 'webp', 'avif', 'jfif'}
+undesired_tags = {'Auto_FaceReco', 'No_FaceReco', 'Broken_FaceReco'}
 
-    while True:
-        print(f'Fetching items with offset {offset}...')
-
-        response = requests.get(f'{BASE_API_URL}/api/item/list?limit={limit}&offset={offset}&folders={folderID}')
-        data = response.json()
-
-        if response.status_code != 200:
-            print('Error fetching data:', response.status_code, response.text)
-            break
-
-        if 'data' not in data:
-            print('Error: "data" key not found in response.')
-            break
 
-        items = data['data']
+def iter_items_with_no_FaceTag(max_iterations=None, folderID=None, cursor=None):
+    """
+    Yields the items to process page by page: the next page is requested only when the pipeline needs more items,
+    so the processing starts with the first page and only a few pages are in memory.
+    The items are listed from the oldest (new items are added at the end and don't move the pages).
 
-        if not items:
-            print('No more items to fetch.')
-            break
+    Args:
+      max_iterations: The max number of pages to fetch, every page is fetched only once (None: all the pages).
+      folderID: The id of the folder to process.
+      cursor: The PageCursor of the listing, the listing starts from its page (None: from the first page).
+              The cursor is marked complete when the last page of the folder was listed.
 
-        if max_iterations is not None and offset >= max_iterations:
-            print(f'Max iterations reached: {max_iterations}')
-            break
+    Raises:
+      EagleError: A page could not be listed (the cursor keeps the page to continue from).
+    """
+    page = cursor.start_page if cursor else 0
+    start_page = page
+    if page:
+        print(f"Continuing the listing of the last run from page {page + 1}")
+    total = 0
+    page_start = time.perf_counter()
+    for items in eagle.iter_item_pages(folder_id=folderID, max_pages=max_iterations, order_by="CREATEDATE",
+                                       start_page=page):
+        metrics.observe("list", time.perf_counter() - page_start)
+        # you can add "and not item['annotation']" to exclude photo with note
+        items = [item for item in items
+                 if item['ext'] in desired_extensions and undesired_tags.isdisjoint(item['tags'])]
+        if cursor:
+            cursor.add_page(page, items)
+
+        page += 1
+        total += len(items)
+        print(f'Page {page} fetched. Total items to process: {total}')
+        yield from items
+        page_start = time.perf_counter()
+
+    if max_iterations is None or page - start_page < max_iterations:  # Ended on a short or empty page
+        if cursor:
+            cursor.complete = True
+        print('No more items to fetch.')
+
+
+def item_done(item, done=True):
+    """
+    Records that an item is done in the page cursor (processed, skipped or failed) and releases its lease.
 
-        for item in items:  # you can add "and not item['annotation']" to exclude photo with note
-            # Only get files in these extensions 'jpg', 'jpeg', 'png', 'bmp', 'webp', 'avif', 'jfif' &
-            # does not have one of the following tags: 'Auto_FaceReco', 'No_FaceReco', 'Broken_FaceReco'
-            undesired_tags = {'Auto_FaceReco', 'No_FaceReco', 'Broken_FaceReco'}
-            if item['ext'] in ['jpg', 'jpeg', 'png', 'bmp', 'webp', 'avif', 'jfif'] and all(
-                    tag not in item['tags'] for tag in undesired_tags):
-                items_with_no_FaceTag.append(item)
+    Args:
+      item: The Eagle item.
+      done: False if the item should be processed again (its lease is released for any worker, and the page
+            cursor doesn't move past it).
+    """
+    if page_cursor is not None:
+        page_cursor.done(item, done)
+    if lease_store is not None:
+        lease_store.release(item['id'], done)
 
-        offset += 1
-        print(f'Iteration {offset} completed. Total items to process: {len(items_with_no_FaceTag)}')
 
-    return items_with_no_FaceTag
+def skip_done_items(items):
+    """
+    Feeder stage: yields the items that were not done in a previous run (journal) and, in worker mode, that
+    this worker could claim (not claimed by another worker).
+    """
+    for item in items:
+        if journal.is_done(item) or (lease_store is not None and not lease_store.claim(item['id'])):
+            item_done(item)
+        else:
+            yield item
 
 
-def get_thumbnail_path(item_id):
-    response = requests.get(f'{BASE_API_URL}/api/item/thumbnail?id={item_id}')
-    data = response.json()
-    if response.status_code == 200 and 'data' in data:
-        return data['data']
-    else:
-        print('Error fetching thumbnail:', response.text)
-        return None
+def database_lock():
+    """
+    Worker mode: the lock of the Database writes shared by all the workers (no lock when running alone).
+    """
+    return lease_store.database_lock() if lease_store is not None else nullcontext()
 
 
-def get_item_ext(item_id):
-    response = requests.get(f'{BASE_API_URL}/api/item/info?id={item_id}')
-    data = response.json()
-    if response.status_code == 200 and 'data' in data:
-        return data['data']['ext']
-    else:
-        print('Error fetching extension:', response.text)
-        return None
+@contextmanager
+def shared_database():
+    """
+    Worker mode: holds the Database lock and first reads the faces the other workers added to the face index,
+    so the matches, the "New Face" clusters and the new names include them.
+    """
+    with database_lock():
+        if lease_store is not None:
+            new_rows = face_index.refresh()
+            if new_rows is None:  # The index was rewritten by another worker
+                name_allocator.clear()
+                unknown_clusters.load(face_index)
+            elif new_rows:
+                name_allocator.clear()  # Folders and images created by the other workers
+                for row in new_rows:
+                    entry = face_index.entries[row]
+                    if entry["new_face"]:
+                        unknown_clusters.add(entry["identity"], face_index.embeddings(row))
+        yield
+
+
+def get_new_items_with_no_FaceTag(folderID, watermark, seen_items, full_scan=False):
+    """
+    Daemon mode: lists the items of the folder from the newest one and stops at the first page that only has
+    items created before the watermark (the creation time of the newest item of the last poll).
 
+    Args:
+      folderID: The id of the folder to process.
+      watermark: The creation time (btime) of the newest item of the last poll (0: list the whole folder).
+      seen_items: {item id: modificationTime} of the items already listed, an item is listed again only if it
+                  changed (updated by the poll).
+      full_scan: True to list the whole folder, even the items already seen.
 
-def update_item_FaceTag(item_id, new_tags=None):
-    response = requests.get(f'{BASE_API_URL}/api/item/info?id={item_id}')
-    data = response.json()
-    if response.status_code == 200 and 'data' in data and data['data']:
-        existing_tags = data["data"]['tags']
-        all_tags = list(set(existing_tags + new_tags))
+    Returns:
+      (items to process, new watermark)
 
-        data = {
-            'id': item_id,
-            'tags': all_tags,
-        }
-        response = requests.post(f'{BASE_API_URL}/api/item/update', json=data)
-        if response.status_code == 200:
-            print('Face Tags updated successfully for item', item_id)
-        else:
-            print('Error updating Face Tags:', response.text)
-    else:
-        print('Error fetching item:', response.text)
+    Raises:
+      EagleError: A page could not be listed (seen_items is not updated, the poll is done again).
+    """
+    new_items = []
+    new_watermark = watermark
+    listed_items = {}  # Added to seen_items only if the listing succeeds
+    page_start = time.perf_counter()
+    for items in eagle.iter_item_pages(folder_id=folderID, order_by="-CREATEDATE"):
+        metrics.observe("list", time.perf_counter() - page_start)
+        for item in items:
+            new_watermark = max(new_watermark, item.get('btime') or 0)
+            changed = seen_items.get(item['id']) != item.get('modificationTime')
+            listed_items[item['id']] = item.get('modificationTime')
+            if (full_scan or changed) and item['ext'] in desired_extensions and undesired_tags.isdisjoint(item['tags']):
+                new_items.append(item)
+
+        page_start = time.perf_counter()
+        if not full_scan and min(item.get('btime') or 0 for item in items) < watermark:  # Next pages are older
+            break
+    seen_items.update(listed_items)
+    return new_items, new_watermark
 
 
-def create_unique_folder(base_path, prefix="New Face_"):
+def merge_item_FaceTag(item, new_tags):
     """
-    Creates a folder with a unique name based on the provided prefix and incrementing number.
+    Merges the new tags with the tags the item already has (from the item list, no extra API call).
 
     Args:
-      base_path: The base path where the folder will be created.
-      prefix: The prefix for the folder name (default: "New Face_").
+      item: The Eagle item (from iter_items_with_no_FaceTag).
+      new_tags: The tags found for the item.
 
     Returns:
-      The path to the created folder.
+      The list of all the tags of the item, or None if the item already has all the new tags.
     """
-    num = 0
-    while True:
-        folder_name = f"{prefix}{num}"
-        folder_path = os.path.join(base_path, folder_name)
-        if not os.path.exists(folder_path):
-            os.makedirs(folder_path)
-            return folder_path
-        num += 1
+    existing_tags = item['tags']
+    added_tags = sorted(set(new_tags).difference(existing_tags))
+    if not added_tags:
+        return None
+    return existing_tags + added_tags
 
 
-def create_unique_image_name(folder_path, original_name):
+def match_tags(identity, new_face):
     """
-    Creates a folder with a unique name based on the provided prefix and incrementing number.
+    Returns the tags of a face match (the same tags as face_recognition).
 
     Args:
-      folder_path: The folder path where the file will be saved.
-      original_name: The original name of the image without extension.
-
-    Returns:
-      The path with unique name of image.
+      identity: The folder name of the matched face (None: no match).
+      new_face: True if the matched face is in a "New Face" folder.
     """
-    num = 0
-    while True:
-        file_name = f"{original_name}_{num}.jpg"
-        file_path = os.path.join(folder_path, file_name)
-        if not os.path.exists(file_path):
-            return file_path
-        num += 1
+    if identity is None:
+        return set()
+    if new_face:
+        return {"Extracted_FaceReco"}
+    return {identity, "Auto_FaceReco"}
 
 
-def clip_coordinates(facial_area, image_width, image_height):
+def update_items_FaceTag(tag_writes):
     """
-    Clips the coordinates of a facial area dictionary to stay within image borders.
+    Writes the tags of a batch of Eagle items (one call per item, no read before the write).
 
     Args:
-        facial_area: A dictionary or pandas containing facial area information.
-        image_width: The width of the image.
-        image_height: The height of the image.
-
-    Returns:
-        A new dictionary with clipped coordinates.
+      tag_writes: A list of (item_id, all_tags).
     """
-
-    if "dict" in str(type(facial_area)):
-        clipped_area = {}
-        clipped_area['x'] = max(0, min(facial_area['x'], image_width - 1))
-        clipped_area['y'] = max(0, min(facial_area['y'], image_height - 1))
-        clipped_area['w'] = min(facial_area['w'], image_width - clipped_area['x'])
-        clipped_area['h'] = min(facial_area['h'], image_height - clipped_area['y'])
-        return clipped_area
-
-    elif "pandas" in str(type(facial_area)):
-        clipped_area = {}
-        clipped_area['x'] = max(0, min(facial_area['source_x'][0], image_width - 1))
-        clipped_area['y'] = max(0, min(facial_area['source_y'][0], image_height - 1))
-        clipped_area['w'] = min(facial_area['source_w'][0], image_width - clipped_area['x'])
-        clipped_area['h'] = min(facial_area['source_h'][0], image_height - clipped_area['y'])
-        return clipped_area
+    for item_id, all_tags in tag_writes:
+        with metrics.timer("tag"):
+            updated = eagle.update_item(item_id, tags=all_tags)
+        if updated is not None:
+            journal.mark_tags_written(item_id)
+            print('Face Tags updated successfully for item', item_id)
+        else:
+            print('Error updating Face Tags for item', item_id)
 
 
-def are_images_identical(image_path1, image_path2, threshold):
+def create_unique_image_name(folder_path, original_name):
     """
-    Checks if two images are identical using pixel-by-pixel comparison.
+    Creates a unique image name: the original name, or the original name with the next number if it is used.
+    The number is taken from a counter (the folder is listed once).
 
     Args:
-      image_path1 : cropped_face from cv2 (image from image_path).
-      image_path2 (str): Path to the second image file (the matched image in Database).
-      threshold: Threshold for pixel-by-pixel comparison.
+      folder_path: The folder path where the file will be saved.
+      original_name: The original name of the image without extension.
 
     Returns:
-      bool: True if the images are identical, False otherwise.
+      The path with unique name of image.
     """
+    return name_allocator.image_path(folder_path, original_name)
 
-    try:
-        # Open images and handle potential errors
-        image1 = cv2.imread(image_path1)
-        image2 = cv2.imread(image_path2)
-        if image1 is None or image2 is None:
-            raise ValueError("Failed to read one or both images")
-
-        # Check if image dimensions match (fast initial check)
-        if image1.shape != image2.shape:
-            print("Images have different shapes")
-            return False
-
-        # Convert to grayscale for comparison
-        image1_gray = cv2.cvtColor(image1, cv2.COLOR_BGR2GRAY)
-        image2_gray = cv2.cvtColor(image2, cv2.COLOR_BGR2GRAY)
-
-        # Efficient pixel-by-pixel comparison using NumPy
-        difference = cv2.absdiff(image1_gray, image2_gray)
-        if cv2.countNonZero(difference) <= threshold:
-            return True
 
-        # Additional check for alpha channel (if present)
-        image1_pil = Image.open(image_path1)
-        image2_pil = Image.open(image_path2)
-        if image1_pil.mode in ("RGBA", "P") and image2_pil.mode in ("RGBA", "P"):
-            alpha_difference = ImageChops.difference(image1_pil.convert("RGBA").getchannel('A'),
-                                                     image2_pil.convert("RGBA").getchannel('A'))
-            if alpha_difference.getbbox() is not None:  # Check for non-zero differences
-                return False
-
-        return False
-
-    except (IOError, ValueError) as e:
-        print(f"Error occurred: {e}")
-        return False
-
-
-def crop_face(original_image, facial_area):
+def represent_database_face(image_path):
     """
-    Checks if two images are identical using pixel-by-pixel comparison.
+    Calculates the embedding of a face image of the Database to add it to the face index.
+    The face is detected and aligned the same way as the faces of the processed photos.
 
     Args:
-      original_image : the original image loaded by cv2.
-      facial_area : the dictionary or pandas containing facial area information.
+      image_path: The path of the face image in the Database.
 
     Returns:
-      cropped_face: the cropped face, ready to save.
+      The embedding of the face, or None if the image couldn't be read.
     """
-    # Get the image cropping area, Assuming image is a NumPy array
-    clipped_area = clip_coordinates(facial_area, original_image.shape[1], original_image.shape[0])
-
-    # Use clipped_area for cropping:
-    cropped_face = original_image[clipped_area['y']:clipped_area['y'] + clipped_area['h'],
-                                  clipped_area['x']:clipped_area['x'] + clipped_area['w']]
-    return cropped_face
+    try:
+        # The Database images are already cropped faces, if no face is detected the whole image is used.
+        faces = detect_faces(image_path, detector_backend, expand_percentage, enforce_detection=False)
+        biggest_face = max(faces, key=lambda face: face['facial_area']['w'] * face['facial_area']['h'])
+        return get_face_embedder(model_name).embed(biggest_face['face'])
+    except Exception as e:  # Handel Errors (e.g. broken image in Database)
+        print(f"Couldn't add {image_path} to face index: {e}")
+        return None
 
 
-def face_recognition(item_id, img_path, db_path, tempo_folder, model_name, detector_backend,
-                     distance_metric, expand_percentage):
+def face_recognition(item_id, img_path, extracted_faces, face_index, distance_metric):
     """
-    Face recognition using DeepFace.
+    Face recognition of the embedded faces of an Eagle item.
     Args:
         item_id: the Eagle id of the image
         img_path: The path to the image to find match for.
-        db_path: The path to the DeepFace database to search in.
-        tempo_folder: The path to the temporary folder to save the faces when same name is found and do pixel-by-pixel
-                        comparison. The image will be deleted after comparison complete.
-        model_name: The name of the model to use.
-        detector_backend: The backend to use.
+        extracted_faces: The faces from process_images with their "crop" and "embedding".
+        face_index: The FaceIndex of the Database to search in.
         distance_metric: The distance metric to use.
-        expand_percentage: The percentage of faces to expand for cropping.
 
     Returns:
-
+        The tags to add to the item (all the faces of the image), they are written once when the item is done.
     """
     image_name = os.path.basename(img_path)  # Get the image name with extension
     image_name_no_ext = image_name.rsplit(".", 1)[0]  # Split from right at first dot
+    item_tags = set()
+    face_matches = []  # The match of every face, kept in the journal for the re-match
 
-    try:  # Handel if face detected or not
-        extracted_faces = DeepFace.extract_faces(img_path=img_path, enforce_detection=True,
-                                                detector_backend=detector_backend, expand_percentage=expand_percentage)
-
-        print(f"Face Extracted Successfully in {image_name}")
-
-    except Exception as e:  # Handel Errors
-        extracted_faces = None
-        if "Face could not be detected" in str(e):  # Handel Face could not be detected
-            print(f"Face could not be detected (DeepFace.extract_faces) in {image_name}")
-
-            # Eagle add Tags:
-            update_item_FaceTag(item_id, ["No_FaceReco"])
-            print(f"Image Name: {image_name} | Tagged with: No_FaceReco")
-
-        else:
-            print(e)  # Handel Other Errors
+    if extracted_faces:
+        for face in range(len(extracted_faces)):  # Search for every face in the image
+            cropped_face = extracted_faces[face]['crop']
+            target_embedding = extracted_faces[face].get('embedding')
 
-    if extracted_faces:  # if extracted_faces run successfully:
-        img = cv2.imread(img_path)  # Read the image
+            if target_embedding is not None:  # if embed run successfully:
+                # Search for the nearest face in the Database
+                with metrics.timer("match"):
+                    match = face_index.find_nearest(target_embedding, distance_metric, target_threshold)
 
-        for face in range(len(extracted_faces)):  # Search for every face in the image
-            facial_area = extracted_faces[face]['facial_area']  # Get the face coordinate
-            cropped_face = crop_face(img, facial_area)  # Crop the Face from original image
-
-            try:  # Handel if face detected or not
-                res = DeepFace.find(img_path=cropped_face, db_path=db_path, enforce_detection=True,
-                                    model_name=model_name, detector_backend=detector_backend,
-                                    distance_metric=distance_metric, expand_percentage=expand_percentage, silent=True)
-
-            except Exception as e:  # Handel Errors
-                res = None
-                if "Face could not be detected" in str(e):  # Handel Face could not be detected
-                    print(f"Face could not be detected (DeepFace.find) in {image_name}")
-                else:
-                    print(e)  # Handel Other Errors
-
-            if res:  # if res run successfully:
-                if len(res[0]['identity']) > 0:  # If face has match:
+                if match:  # If face has match:
+                    metrics.count("matches")
                     # Get image Full path of matched face
-                    matched_image_path = res[0]['identity'][0]
-                    # Get image name with Extension of matched face
-                    matched_image_name = res[0]['identity'][0].split('\\')[-1]
-                    # Get image name without extension
-                    matched_image_name_no_ext = matched_image_name.rsplit(".", 1)[0]
+                    matched_image_path = match['path']
                     matched_folder_path = os.path.dirname(matched_image_path)
-                    # define the save path to matched folder in Database
-                    matched_save_path = os.path.join(matched_folder_path, f"{image_name_no_ext}.jpg")
 
                     # Get folder name of matched face (Face Name)
-                    if "new_faces" in matched_folder_path:
-                        matched_folder_name = res[0]['identity'][0].split('\\')[3]
+                    matched_folder_name = match['identity']
+                    if match['new_face']:
                         # Eagle add Tags:
                         new_tags = ["Extracted_FaceReco"]
-                        update_item_FaceTag(item_id, new_tags)
+                        item_tags.update(new_tags)
                         print(f"Image Name: {image_name} | Tagged with: {new_tags}")
 
                     else:
-                        matched_folder_name = res[0]['identity'][0].split('\\')[2]
                         # Eagle add Tags:
                         new_tags = [matched_folder_name, "Auto_FaceReco"]
-                        update_item_FaceTag(item_id, new_tags)
+                        item_tags.update(new_tags)
                         print(f"Image Name: {image_name} | Tagged with: {new_tags}")
 
                     print(f"Image Name: {image_name} | Matched with: {matched_folder_name}")
+                    face_matches.append({'identity': matched_folder_name, 'new_face': match['new_face'],
+                                         'distance': match['distance'], 'embedding': target_embedding})
 
-                    # Check if the file with same name already exists
-                    if os.path.exists(matched_save_path):
-                        print("File with same name already exists!")
-
-                        # save cropped face to tempo Folder:
-                        tempo_file_path = os.path.join(tempo_folder, f"{image_name_no_ext}.jpg")
-                        cv2.imwrite(tempo_file_path, cropped_face)
-
-                        # Check if cropped source Face is exact match of target cropped Face
-                        # (Source = img_path/tempo_file) (target = the matched image in database)
-                        if are_images_identical(tempo_file_path, matched_image_path, threshold):
-                            print("Images are identical, didn't save")
-                        else:  # Save cropped_face/tempo_file to matched folder in Database
-                            print("Images are different, Saving...")
-                            # Create a unique image name and store the image path
-                            unique_image_path = create_unique_image_name(matched_folder_path, image_name_no_ext)
-
-                            try:
-                                cv2.imwrite(unique_image_path, cropped_face)
-                                print("Image saved successfully")
-                            except Exception as e:
-                                if "Assertion failed" in str(e):  # Handle file with same name already exist
-                                    print("Matched image with same name in same folder is found, Image couldn't be saved")
-                                else:  # Handel other Errors
-                                    print(e)
-
-                        # Remove tempo image
-                        # Check if the file exists (optional but recommended)
-                        if os.path.exists(tempo_file_path):
-                            os.remove(tempo_file_path)
-                            print(f"Tempo File '{tempo_file_path}' deleted successfully.")
-                        else:
-                            print(f"Tempo File '{tempo_file_path}' does not exist.")
-
-                    else:  # Save cropped_face to matched folder in Database
+                    # Check in memory if the same face (from the same photo) is already in the matched folder
+                    face_hash = perceptual_hash(cropped_face)
+                    duplicate_path = face_index.find_duplicate(matched_folder_path, target_embedding, face_hash,
+                                                               distance_metric, duplicate_distance * target_threshold,
+                                                               duplicate_hash_bits)
+                    if duplicate_path:
+                        metrics.count("duplicates")
+                        print(f"Same face already in Database ({os.path.basename(duplicate_path)}), didn't save")
+
+                    else:  # Save cropped_face to matched folder in Database (with a unique name)
+                        save_path = create_unique_image_name(matched_folder_path, image_name_no_ext)
 
                         try:
-                            cv2.imwrite(matched_save_path, cropped_face)
-                            print("Image saved successfully")
+                            with metrics.timer("save"):
+                                saved = cv2.imwrite(save_path, cropped_face)
+                                if saved:
+                                    face_index.add(save_path, target_embedding, face_hash)  # Add the face to the index
+                            if saved:
+                                if match['new_face']:  # Update the average face of the "New Face" folder
+                                    unknown_clusters.add(matched_folder_name, target_embedding)
+                                print("Image saved successfully")
                         except Exception as e:
                             if "Assertion failed" in str(e):  # Handle file with same name already exist
                                 print("Matched image with same name in same folder is found, Image couldn't be saved")
@@ -410,47 +450,514 @@ def face_recognition(item_id, img_path, db_path, tempo_folder, model_name, detec
                                 print(e)
 
                 else:  # If face has No match
+                    metrics.count("misses")
                     print(f"Image Name: {image_name} | No Match found!!")
 
-                    # Save cropped_face to "New Face_{num}" in new_faces_path
-                    # Create a unique folder and store the folder name path
-                    unique_folder_name = create_unique_folder(new_faces_path)
-                    new_image_save_path = os.path.join(unique_folder_name, f"{image_name_no_ext}.jpg")
-                    cv2.imwrite(new_image_save_path, cropped_face)
-                    print(f"New Face added to new_faces successfully!, to Folder: {unique_folder_name}")
+                    # Save cropped_face to the "New Face_{num}" folder of its cluster of unknown faces
+                    # (a new folder is created if the face is not near any cluster)
+                    cluster_folder_path, is_new_folder = unknown_clusters.assign(target_embedding)
+                    new_image_save_path = create_unique_image_name(cluster_folder_path, image_name_no_ext)
+                    with metrics.timer("save"):
+                        if cv2.imwrite(new_image_save_path, cropped_face):
+                            # Add the face to the index
+                            face_index.add(new_image_save_path, target_embedding, perceptual_hash(cropped_face))
+                    if is_new_folder:
+                        print(f"New Face added to new_faces successfully!, to Folder: {cluster_folder_path}")
+                    else:
+                        print(f"New Face added to unknown faces cluster: {cluster_folder_path}")
 
                     # Eagle add Tags:
                     new_tags = ["Extracted_FaceReco"]
-                    update_item_FaceTag(item_id, new_tags)
+                    item_tags.update(new_tags)
                     print(f"Image Name: {image_name} | Tagged with: {new_tags}")
+                    face_matches.append({'identity': os.path.basename(cluster_folder_path), 'new_face': True,
+                                         'distance': None, 'embedding': target_embedding})
 
-# -----------------------------------------------------------
+    journal.record_matches(item_id, face_matches)
+    return item_tags
+
+
+def finish_item_FaceTag(item, new_tags, status, item_content_hash=None):
+    """
+    Called once when an item is done: records it in the journal, merges its tags and queues one write to Eagle
+    (skipped if nothing changes). The writes are sent to the tag writer stage in batches of tag_write_batch_size.
 
+    Args:
+      item: The Eagle item (from iter_items_with_no_FaceTag).
+      new_tags: All the tags found for the item.
+      status: The outcome of the item: "faces", "no_face" or "broken".
+      item_content_hash: The content hash of the image of the item.
+    """
+    all_tags = merge_item_FaceTag(item, new_tags)
+    journal.record_item(item, item_content_hash, status, all_tags or item['tags'])
+    item_done(item)
+    if all_tags is None:
+        journal.mark_tags_written(item['id'])
+        print(f"Item {item['id']} already has the tags: {sorted(new_tags)}")
+        return
+
+    item['tags'] = all_tags
+    pending_tag_writes.append((item['id'], all_tags))
+    if len(pending_tag_writes) >= tag_write_batch_size:
+        flush_item_FaceTag()
+
+
+def flush_item_FaceTag():
+    """
+    Sends the waiting tag writes to the tag writer stage.
+    """
+    if pending_tag_writes:
+        tag_writer.put(list(pending_tag_writes))
+        pending_tag_writes.clear()
+
+
+def tag_broken_item(item, img_path, error):
+    """
+    Tags an Eagle item with 'Broken_FaceReco' when its image couldn't be processed.
+
+    Args:
+      item: The Eagle item.
+      img_path: The path to the image.
+      error: The error raised when processing the image.
+    """
+    metrics.count("broken")
+    print(f'Error processing file: {img_path} ({error})')
+    # Add 'Broken_FaceReco' tag for corrupted images
+    finish_item_FaceTag(item, ["Broken_FaceReco"], "broken")
+    print(f'Tagged item {item["id"]} as "Broken_FaceReco"')
+
+
+def read_item(item):
+    """
+    Reader stage: gets the original image path of an Eagle item and reads the image file.
+
+    Args:
+      item: The Eagle item (from iter_items_with_no_FaceTag).
+
+    Returns:
+      (item, img_path, file_bytes, content_hash, error), img_path is None if Eagle doesn't know the file of the item
+      (error is set if the path couldn't be asked to Eagle), error is set if the file couldn't be read.
+    """
+    # The path is built from the library path and the item (no API call, unless the file is not found)
+    with metrics.timer("resolve_path"):
+        original_image_path = path_resolver.resolve(item)
+    if not original_image_path:
+        return item, None, None, None, None
+
+    try:
+        with metrics.timer("read"), open(original_image_path, "rb") as file:
+            file_bytes = file.read()
+    except OSError as e:  # Handel Errors (file not found, no permission...)
+        return item, original_image_path, None, None, e
+    return item, original_image_path, file_bytes, content_hash(file_bytes), None
+
+
+def read_item_failed(item, error):
+    """
+    Result of the reader stage for an item when read_item raised an error (e.g. Eagle API error).
+    """
+    return item, None, None, None, error
+
+
+def crop_journal_faces(file_bytes, faces):
+    """
+    Crops the faces found in a previous run (from the journal) from the image, no detection and no embedding.
+
+    Args:
+      file_bytes: The content of the image file.
+      faces: The faces from the journal (with "save_area" and "embedding").
+
+    Returns:
+      The faces with their "crop" key.
+    """
+    with metrics.timer("decode"):
+        img = cv2.imdecode(np.frombuffer(file_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+    for face in faces:
+        face['crop'] = crop_face(img, face['save_area'])
+    return faces
+
+
+def recognize_processed_images(results):
+    """
+    Runs face recognition on the photos processed by the detection workers.
+
+    Args:
+      results: A list of ((item, img_path, content_hash), status, result) from process_images.
+    """
+    for (item, img_path, item_content_hash), status, result in results:
+        image_name = os.path.basename(img_path)  # Get the image name with extension
+        metrics.count("items")
+
+        if status == "faces":
+            metrics.count("faces", len(result))
+            print(f"Face Extracted Successfully in {image_name}")
+            try:
+                with shared_database():  # Only one worker writes to the Database at a time
+                    item_tags = face_recognition(item_id=item['id'], img_path=img_path, extracted_faces=result,
+                                                 face_index=face_index,
+                                                 distance_metric=distance_metric)
+            except (FileNotFoundError, SyntaxError) as e:
+                tag_broken_item(item, img_path, e)
+            else:
+                # Write the tags of all the faces of the image at once
+                finish_item_FaceTag(item, item_tags, status, item_content_hash)
+
+        elif status == "no_face":  # Handel Face could not be detected
+            metrics.count("no_face")
+            print(f"Face could not be detected (detect_faces) in {image_name}")
+            # Eagle add Tags:
+            finish_item_FaceTag(item, ["No_FaceReco"], status, item_content_hash)
+            print(f"Image Name: {image_name} | Tagged with: No_FaceReco")
+
+        elif status == "broken":
+            tag_broken_item(item, img_path, result)
+
+        else:
+            metrics.count("errors")
+            print(result)  # Handel Other Errors
+            item_done(item, done=False)  # Not recorded, it is processed again the next time
+
+
+def record_processed_images(chunk_results):
+    """
+    Records the faces found by the detection workers in the journal, then runs face recognition on them.
+
+    Args:
+      chunk_results: (results, worker_metrics, rejected_faces) from process_images, results is a list of
+                     ((item, img_path, content_hash), status, result).
+    """
+    results, worker_metrics, rejected_faces = chunk_results
+    metrics.merge(worker_metrics)  # Stage times of the detection worker
+    quality_rejects.update(rejected_faces)
+    for reason, count in rejected_faces.items():
+        metrics.count(f"rejected_{reason}", count)
+    for (item, img_path, item_content_hash), status, result in results:
+        if status in ("faces", "no_face"):
+            journal.record_faces(item_content_hash, status, result or [])
+    recognize_processed_images(results)
+
+
+def start_detection_workers():
+    """
+    Starts the detection workers (processes), every worker loads the models once.
+
+    Returns:
+      (executor, number of workers), 0 workers: the detection runs in a thread of the main process.
+    """
+    workers = os.cpu_count() if detection_workers is None else detection_workers
+    settings = {"model_name": model_name, "detector_backend": detector_backend,
+                "expand_percentage": expand_percentage, "batch_size": embedding_batch_size,
+                "detection_max_side": detection_max_side, "thumbnail_detection": thumbnail_detection,
+                "thumbnail_min_face": thumbnail_min_face, "quality_gate": quality_gate, "metrics": metrics_enabled,
+                "inference": inference, "tiling": tiling}
+    if workers > 0:
+        settings["threads_per_worker"] = max(1, (os.cpu_count() or 1) // workers)
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(settings,))
+    else:  # Detection & embedding in the main process (in a thread)
+        executor = ThreadPoolExecutor(max_workers=1, initializer=init_worker, initargs=(settings,))
+    return executor, workers
+
+
+def run_pipeline(items, executor=None, workers=None):
+    """
+    Runs face recognition on the Eagle items with concurrent stages:
+      0. Feeder thread: lists the items page by page (when items is a generator) and skips the items already
+         done in the journal.
+      1. Reader threads: get the original image path from Eagle and read the image file.
+      2. Detection workers (processes): decode, detect, crop and embed the faces (in batches).
+      3. Main thread: match the faces with the face index and save them to the Database
+         (only one thread uses the face index and creates the names in the Database).
+      4. Tag writer thread: update the Eagle tags.
+
+    Args:
+      items: The Eagle items to process.
+      executor: The detection workers from start_detection_workers (None: started for this run only).
+      workers: The number of detection workers of executor.
+    """
+    own_executor = executor is None
+    if own_executor:
+        executor, workers = start_detection_workers()
 
-folderID = get_folderID(folderNameToProcess)
-items_with_no_FaceTag = get_items_with_no_FaceTag(folderID=folderID)
+    reader = ThreadStage(read_item, num_threads=io_workers, queue_size=pipeline_queue_size, keep_results=True,
+                         on_error=read_item_failed)
+    threading.Thread(target=reader.feed, args=(skip_done_items(items),), daemon=True).start()
 
-for item in items_with_no_FaceTag:
-    thumbnail_path = get_thumbnail_path(item['id'])
+    in_flight = deque()  # The chunks sent to the detection workers, in order
+    max_in_flight = max(1, workers) * 2
+    chunk = []
+    chunk_time = None
 
-    if thumbnail_path:
-        thumbnail_path = unquote(thumbnail_path)
-        # print("Thumbnail path: ", thumbnail_path)
-        original_image_ext = get_item_ext(item['id'])
-        # print(original_image_ext)
-        original_image_path = thumbnail_path.replace("_thumbnail.png", f".{original_image_ext}")
-        # print("Original image path: ", original_image_path)
+    def chunk_wait():  # The chunk is sent when its first photo waited embedding_batch_window seconds
+        return max(0, chunk_time + embedding_batch_window - time.monotonic()) if chunk else None
 
-        try:
-            face_recognition(item_id=item['id'], img_path=original_image_path, db_path=database_path, tempo_folder=tempo_folder,
-                             model_name=model_name, detector_backend=detector_backend,
-                             distance_metric=distance_metric, expand_percentage=expand_percentage)
+    try:
+        for result in reader.results(timeout=chunk_wait):
+            if result is None:  # No photo came in time: send the waiting chunk
+                in_flight.append(executor.submit(process_images, chunk))
+                chunk = []
+                while len(in_flight) >= max_in_flight:
+                    record_processed_images(in_flight.popleft().result())
+                continue
+            item, img_path, file_bytes, item_content_hash, error = result
+            if error is not None and img_path is None:  # Not recorded, it is processed again the next time
+                metrics.count("errors")
+                print(f"Couldn't get the file of item {item['id']}: {error}")
+                item_done(item, done=False)
+                continue
+            if error is not None:
+                tag_broken_item(item, img_path, error)
+                continue
+            if img_path is None:
+                item_done(item)
+                continue
+
+            # Same image content already processed with the same settings: reuse its faces and embeddings
+            journal_faces = journal.get_faces(item_content_hash)
+            if journal_faces is not None:
+                metrics.count("journal_hits")
+                status, faces = journal_faces
+                if status == "faces":
+                    faces = crop_journal_faces(file_bytes, faces)
+                recognize_processed_images([((item, img_path, item_content_hash), status, faces)])
+                continue
+
+            if not chunk:
+                chunk_time = time.monotonic()
+            chunk.append(((item, img_path, item_content_hash), img_path, file_bytes))
+
+            if len(chunk) >= pipeline_chunk_size or time.monotonic() - chunk_time >= embedding_batch_window:
+                in_flight.append(executor.submit(process_images, chunk))
+                chunk = []
+
+            # Wait for the oldest chunk when the workers are busy (the reader threads wait too)
+            while len(in_flight) >= max_in_flight:
+                record_processed_images(in_flight.popleft().result())
+
+        if chunk:
+            in_flight.append(executor.submit(process_images, chunk))
+        while in_flight:
+            record_processed_images(in_flight.popleft().result())
+
+        # The listing failed: the items read are done, the caller must not take it as the end of the listing
+        if reader.feed_error is not None:
+            raise reader.feed_error
+
+    finally:
+        if own_executor:
+            executor.shutdown(cancel_futures=True)
+
+
+def sync_database():
+    """
+    Daemon mode: syncs the face index and the "New Face" clusters with the Database folder (e.g. a "New Face"
+    folder renamed to the person name, or photos added by the user).
+    """
+    unknown_clusters.save()
+    name_allocator.clear()
+    face_index.sync_with_folder(represent_database_face)
+    unknown_clusters.load(face_index)
+
+
+def run_rematch(folderID):
+    """
+    Re-matches the faces of the processed items with the Database as it is now (from the embeddings kept in the
+    journal, only the faces a change of the Database can affect) and writes the changed tags to Eagle.
+    The face tags that don't match anymore are removed, the other tags of the items are kept.
+
+    Args:
+      folderID: The id of the processed folder (the current tags of its items are listed page by page).
+    """
+    records, embeddings = journal.get_matches()
+    updates, snapshot = rematch_faces(face_index, records, embeddings, journal.get_state("rematch_snapshot", {}),
+                                      distance_metric, target_threshold)
+
+    # Face tags of the items before and after the re-match
+    item_faces = {}
+    for num, record in enumerate(records):
+        item_faces.setdefault(record['item_id'], []).append(num)
+    changed_items = {}
+    for item_id in {records[num]['item_id'] for num in updates}:
+        old_tags, new_tags = set(), set()
+        for num in item_faces[item_id]:
+            old_tags |= match_tags(records[num]['identity'], records[num]['new_face'])
+            new_match = updates.get(num, records[num])
+            new_tags |= match_tags(new_match['identity'], new_match['new_face'])
+        if old_tags != new_tags:
+            changed_items[item_id] = (old_tags, new_tags)
+    print(f"Re-match: the face tags of {len(changed_items)} items changed.")
+
+    # The current tags of the items (the user could have changed them in Eagle), from the item list
+    current_tags = {}
+    if changed_items:
+        for items in eagle.iter_item_pages(folder_id=folderID):
+            for item in items:
+                if item['id'] in changed_items:
+                    current_tags[item['id']] = item.get('tags', [])
+    tag_writes = []
+    for item_id, (old_tags, new_tags) in changed_items.items():
+        tags = current_tags.get(item_id)
+        if tags is None:  # Moved out of the folder
+            info = eagle.get_item_info(item_id)
+            if info is None:  # Deleted from Eagle
+                continue
+            tags = info.get('tags', [])
+        removed_tags = old_tags - new_tags
+        all_tags = [tag for tag in tags if tag not in removed_tags] + sorted(new_tags.difference(tags))
+        if all_tags != tags:
+            print(f"Item {item_id}: {sorted(removed_tags & set(tags))} -> {sorted(new_tags.difference(tags))}")
+            journal.set_item_tags(item_id, all_tags)  # Written again by the next run if a write fails
+            tag_writes.append((item_id, all_tags))
+
+    journal.update_matches([dict(records[num], **match) for num, match in updates.items()])
+    journal.set_state("rematch_snapshot", snapshot)
+
+    # The tag writes are sent in parallel (the Eagle API has no call to update many items)
+    writer = ThreadStage(update_items_FaceTag, num_threads=io_workers, queue_size=pipeline_queue_size)
+    writer.feed(tag_writes[start:start + tag_write_batch_size]
+                for start in range(0, len(tag_writes), tag_write_batch_size))
+    writer.join()
+    print(f"Re-match done: {len(tag_writes)} items tagged again.")
+
+
+def run_daemon(folderID):
+    """
+    Daemon mode: keeps the detection workers (and their models) running and processes the new items of the folder
+    every daemon_poll_interval seconds, until Ctrl+C. The watermark is saved in the journal, a restart continues
+    from the last poll.
 
-        except (FileNotFoundError, SyntaxError) as e:
-            print(f'Error processing file: {original_image_path} ({e})')
-            # Add 'Broken_FaceReco' tag for corrupted images
-            update_item_FaceTag(item['id'], new_tags=["Broken_FaceReco"])
-            print(f'Tagged item {item["id"]} as "Broken_FaceReco"')
-            continue
+    Args:
+      folderID: The id of the folder to process.
+    """
+    executor, workers = start_detection_workers()
+    watermark_name = f"daemon_watermark:{folderID}"
+    watermark = journal.get_state(watermark_name, 0)
+    seen_items = {}
+    poll = 0
+    print(f"Daemon mode: polling '{folderNameToProcess}' every {daemon_poll_interval} s (Ctrl+C to stop)")
+    try:
+        while True:
+            full_scan = not watermark or poll % daemon_full_scan_every == 0
+            if full_scan and poll:  # The face index was synced at the start
+                with database_lock():
+                    sync_database()
+            try:
+                items, new_watermark = get_new_items_with_no_FaceTag(folderID, watermark, seen_items, full_scan)
+            except EagleError as e:  # The watermark doesn't move, the next poll lists the same pages
+                print(f"Poll {poll} skipped: {e}")
+                poll += 1
+                time.sleep(daemon_poll_interval)
+                continue
+            if items:
+                print(f"Poll {poll}: {len(items)} new items to process.")
+                run_pipeline(items, executor, workers)
+                flush_item_FaceTag()
+                unknown_clusters.save()
+
+            # The watermark moves only when the items are done (an interrupted poll is done again)
+            if new_watermark != watermark:
+                watermark = new_watermark
+                journal.set_state(watermark_name, watermark)
+            poll += 1
+            time.sleep(daemon_poll_interval)
+    except KeyboardInterrupt:
+        print("Daemon stopped.")
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+# -----------------------------------------------------------
 
-print("Face Recognition Complete")
+
+if __name__ == "__main__":
+    if metrics_enabled:
+        metrics.enable(metrics_path, metrics_interval, metrics_prometheus_path, metrics_prometheus_port,
+                       metrics_prometheus_host)
+
+    # Create script folders (my_db, face_index)
+    script_folder_list = [database_path, new_faces_path, index_folder]
+    for folder in script_folder_list:
+        # Check if the folder exists
+        if not os.path.exists(folder):
+            # Create the folder if it doesn't exist
+            os.makedirs(folder)
+            print(f"Folder '{folder}' created successfully.")
+        else:
+            print(f"Folder '{folder}' already exists.")
+
+    if worker_mode:
+        lease_store = LeaseStore(lease_store_path, lease_seconds=lease_seconds)
+
+    # Load the face index of the Database once, and add the faces that are not in it yet
+    target_threshold = distance_threshold or find_threshold(model_name, distance_metric)
+    with database_lock():  # The other workers don't write to the Database while it is synced
+        # Models of the main process (Database faces), the ONNX models are exported here before the workers start
+        use_inference_backend(inference, model_name, detector_backend)
+        face_index = FaceIndex(index_folder, database_path, new_faces_path, model_name,
+                               signature={"model_name": model_name, "detector_backend": detector_backend,
+                                          "face": "aligned"})
+        face_index.sync_with_folder(represent_database_face)
+        if embedding_storage != "float32":  # Compact embeddings in RAM (the float32 file stays on disk)
+            face_index.use_compact(CompactEmbeddings(index_folder, model_name, storage=embedding_storage))
+        if search_mode == "ivf":  # Check the recall with: python ann_index.py --probes {ivf_probes}
+            face_index.use_ann(IVFIndex(index_folder, model_name, num_probes=ivf_probes))
+        if matching_mode == "prototypes":  # Used instead of the search_mode
+            face_index.use_prototypes(PrototypeIndex(face_index, num_medoids=num_prototypes))
+
+        # Clusters of the unknown faces (one per "New Face_{num}" folder)
+        unknown_clusters = UnknownFaceClusters(os.path.join(index_folder, f"{model_name}_unknown_clusters.npz"),
+                                               new_faces_path, name_allocator, distance_metric,
+                                               unknown_cluster_threshold or target_threshold)
+        unknown_clusters.load(face_index)
+
+    folderID = get_folderID(folderNameToProcess)
+    if folderID is None:  # Don't process the whole library
+        raise SystemExit(f"Folder '{folderNameToProcess}' not found in Eagle library.")
+    path_resolver = ItemPathResolver(eagle)  # Asks the library path once
+
+    # The journal keeps the results per settings, changing one of them only invalidates the old results
+    journal = RunJournal(journal_path, settings={"model_name": model_name, "detector_backend": detector_backend,
+                                                 "expand_percentage": expand_percentage, "face": "aligned",
+                                                 "detection_max_side": detection_max_side,
+                                                 "thumbnail_detection": thumbnail_detection,
+                                                 "quality_gate": quality_gate, "inference": inference,
+                                                 "tiling": tiling})
+
+    tag_writer = ThreadStage(update_items_FaceTag, num_threads=1, queue_size=pipeline_queue_size)
+    pending_tag_writes = []  # Tag writes waiting to be sent to the tag writer (tag_write_batch_size)
+    try:
+        # Write the tags that were not written in the last run (e.g. interrupted or Eagle was closed)
+        pending_tag_writes.extend(journal.get_unwritten_tags())
+        flush_item_FaceTag()
+
+        if rematch_mode:
+            run_rematch(folderID)
+        elif daemon_mode:
+            run_daemon(folderID)
+        elif worker_mode:  # Every worker lists all the items, the items claimed by other workers are skipped
+            run_pipeline(iter_items_with_no_FaceTag(folderID=folderID))
+        else:
+            # The items are listed while the first ones are processed
+            page_cursor = PageCursor(journal, f"page_cursor:{folderID}")
+            try:
+                run_pipeline(iter_items_with_no_FaceTag(folderID=folderID, cursor=page_cursor))
+            except EagleError as e:  # The cursor keeps its page, the next run continues the listing from there
+                print(f"Listing stopped: {e}")
+            if page_cursor.complete:
+                page_cursor.reset()
+            print(f"Original paths found with the API (not found in the library folder): {path_resolver.fallbacks}")
+    finally:
+        # Wait for the last tags to be written to Eagle
+        flush_item_FaceTag()
+        tag_writer.close()
+        tag_writer.join()
+        journal.close()
+        unknown_clusters.save()
+        metrics.close()
+        if lease_store is not None:
+            lease_store.close()
+
+    eagle.print_stats()
+    if lease_store is not None:
+        lease_store.print_stats()
+    if quality_rejects:
+        print(f"Faces rejected by the quality gate: {dict(quality_rejects)}")
+    print("Face Recognition Complete")
@@ -0,0 +1,275 @@
+# Approximate nearest neighbour search (IVF) for the face index, for Databases with 100k+ faces.
+# The faces are grouped in clusters (k-means on the L2-normalized embeddings), a search only compares the face
+# with the faces of the nearest clusters, and the candidates are ranked with the exact distance, so the
+# distance_metric threshold keeps the same meaning as in the exact search.
+#
+# Recall report (compare with the exact search on faces of the index):
+#   python ann_index.py --model Facenet512 --metric cosine --probes 8
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from face_index import find_distances
+
+
+def normalize_rows(vectors):
+    """
+    Returns the L2-normalized rows of a matrix (as float32).
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def assign_to_centroids(matrix, centroids, chunk_size=8192):
+    """
+    Returns the nearest centroid of every row of the matrix (read by chunks, the matrix can be memory-mapped).
+    """
+    assignments = np.empty(len(matrix), dtype=np.int32)
+    for start in range(0, len(matrix), chunk_size):
+        chunk = normalize_rows(matrix[start:start + chunk_size])
+        assignments[start:start + chunk_size] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+
+def train_centroids(matrix, num_lists, iterations=10, seed=0):
+    """
+    Trains the cluster centroids with k-means (spherical) on a sample of the rows.
+
+    Args:
+        matrix: The (n, dimensions) matrix of the embeddings.
+        num_lists: The number of clusters.
+        iterations: The number of k-means iterations.
+        seed: The random seed (the same Database always gives the same clusters).
+
+    Returns:
+        The (num_lists, dimensions) matrix of the L2-normalized centroids.
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(matrix), num_lists * 32)
+    sample_rows = np.sort(rng.choice(len(matrix), sample_size, replace=False))
+    sample = normalize_rows(matrix[sample_rows])
+    centroids = sample[rng.choice(sample_size, num_lists, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = assign_to_centroids(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        counts = np.bincount(assignments, minlength=num_lists)
+        empty = counts == 0
+        sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]  # Restart the empty clusters
+        centroids = normalize_rows(sums)
+
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted file index: the rows of the face index are split in lists (one per cluster).
+    It is saved in the index folder and new faces are added to their nearest list without rebuilding.
+    """
+
+    def __init__(self, index_folder, model_name, num_probes=8, num_lists=None, rebuild_growth=4):
+        """
+        Args:
+            index_folder: The folder where the index files are saved.
+            model_name: The name of the model used for the embeddings.
+            num_probes: The number of clusters searched per face (more = better recall, slower).
+            num_lists: The number of clusters (None: 4 * sqrt(number of faces)).
+            rebuild_growth: The clusters are trained again when the index grew this many times since the training.
+        """
+        self.num_probes = num_probes
+        self.num_lists = num_lists
+        self.rebuild_growth = rebuild_growth
+        self._centroids_path = os.path.join(index_folder, f"{model_name}_ivf_centroids.npz")
+        self._assignments_path = os.path.join(index_folder, f"{model_name}_ivf_assignments.i32")
+
+        self.centroids = None
+        self.lists = []
+        self.trained_rows = 0
+
+    @property
+    def is_ready(self):
+        return self.centroids is not None
+
+    def reset(self):
+        """
+        Forgets the clusters (the rows of the face index changed), call load_or_build again.
+        """
+        self.centroids = None
+        self.lists = []
+        for path in (self._centroids_path, self._assignments_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def load_or_build(self, matrix, generation=0):
+        """
+        Loads the index from disk, adds the rows that are missing, or trains it again if needed (e.g. the rows
+        of the face index were rewritten since the index was saved).
+
+        Args:
+            matrix: The matrix of the face index.
+            generation: The generation of the face index (FaceIndex.generation, changes when its rows are rewritten).
+        """
+        rows = len(matrix)
+        assignments = None
+        if os.path.exists(self._centroids_path) and os.path.exists(self._assignments_path):
+            with np.load(self._centroids_path) as saved:  # Closed at once, else the file can't be removed on Windows
+                saved_generation = int(saved['generation']) if 'generation' in saved.files else None
+                if saved_generation == generation:
+                    self.centroids, self.trained_rows = saved['centroids'], int(saved['trained_rows'])
+                    assignments = np.fromfile(self._assignments_path, dtype=np.int32)
+
+        needs_training = (assignments is None or len(assignments) > rows
+                          or self.centroids.shape[1] != matrix.shape[1]
+                          or rows > self.trained_rows * self.rebuild_growth)
+        if needs_training:
+            self.build(matrix, generation)
+            return
+
+        if len(assignments) < rows:  # Faces added after the last save
+            missing = assign_to_centroids(matrix[len(assignments):], self.centroids)
+            with open(self._assignments_path, "ab") as file:
+                file.write(missing.tobytes())
+            assignments = np.concatenate([assignments, missing])
+        self._fill_lists(assignments)
+
+    def build(self, matrix, generation=0):
+        """
+        Trains the clusters on all the rows of the face index and saves the index with the generation of the
+        face index.
+        """
+        rows = len(matrix)
+        if rows == 0:
+            self.reset()
+            return
+        num_lists = self.num_lists or int(4 * np.sqrt(rows))
+        num_lists = max(1, min(num_lists, rows))
+
+        start = time.perf_counter()
+        self.centroids = train_centroids(matrix, num_lists)
+        self.trained_rows = rows
+        assignments = assign_to_centroids(matrix, self.centroids)
+        np.savez(self._centroids_path, centroids=self.centroids, trained_rows=rows, generation=generation)
+        assignments.tofile(self._assignments_path)
+        self._fill_lists(assignments)
+        print(f"IVF index built: {rows} faces in {num_lists} clusters ({time.perf_counter() - start:.1f} s)")
+
+    def _fill_lists(self, assignments):
+        order = np.argsort(assignments, kind='stable')
+        bounds = np.searchsorted(assignments[order], np.arange(len(self.centroids) + 1))
+        self.lists = [list(order[bounds[i]:bounds[i + 1]]) for i in range(len(self.centroids))]
+
+    def add(self, row, vector, save=True):
+        """
+        Adds a new row of the face index to its nearest cluster (no training).
+        save=False: the row is already saved by another process (see FaceIndex.refresh).
+        """
+        if not self.is_ready:
+            return
+        list_num = int(np.argmax(self.centroids @ normalize_rows(np.reshape(vector, (1, -1)))[0]))
+        self.lists[list_num].append(row)
+        if save:
+            with open(self._assignments_path, "ab") as file:
+                file.write(np.int32(list_num).tobytes())
+
+    def candidates(self, embedding):
+        """
+        Returns the rows of the nearest clusters of the embedding.
+        """
+        query = normalize_rows(np.reshape(embedding, (1, -1)))[0]
+        scores = self.centroids @ query
+        num_probes = min(self.num_probes, len(self.lists))
+        nearest_lists = np.argpartition(-scores, num_probes - 1)[:num_probes]
+        rows = [self.lists[list_num] for list_num in nearest_lists if self.lists[list_num]]
+        if not rows:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([np.asarray(list_rows, dtype=np.int64) for list_rows in rows])
+
+
+def recall_report(face_index, ivf_index, distance_metric, threshold, sample_size=1000, seed=0):
+    """
+    Compares the approximate search with the exact search, using faces of the index as queries
+    (each query face is removed from its own search).
+
+    Returns:
+        A dictionary with the recall of the nearest face, the agreement of the match decisions at the threshold,
+        the average number of compared faces and the time of both searches.
+    """
+    matrix, norms = face_index._matrix, face_index.norms
+    rng = np.random.default_rng(seed)
+    queries = rng.choice(len(matrix), min(sample_size, len(matrix)), replace=False)
+
+    same_nearest = same_decision = compared = 0
+    exact_time = ann_time = 0.0
+    for row in queries:
+        embedding = np.array(matrix[row])
+
+        start = time.perf_counter()
+        distances = find_distances(matrix, norms, embedding, distance_metric)
+        distances[row] = np.inf
+        exact_row = int(np.argmin(distances))
+        exact_match = distances[exact_row] <= threshold
+        exact_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        candidates = ivf_index.candidates(embedding)
+        candidates = candidates[candidates != row]
+        ann_match = False
+        ann_row = None
+        if len(candidates):
+            candidate_distances = find_distances(matrix[candidates], norms[candidates], embedding, distance_metric)
+            best = int(np.argmin(candidate_distances))
+            ann_row = int(candidates[best])
+            ann_match = candidate_distances[best] <= threshold
+        ann_time += time.perf_counter() - start
+
+        compared += len(candidates)
+        same_nearest += ann_row == exact_row
+        # Same decision: both no match, or both match the same person
+        same_decision += (exact_match == ann_match and (not exact_match or face_index.entries[ann_row]["identity"]
+                                                        == face_index.entries[exact_row]["identity"]))
+
+    count = len(queries)
+    return {
+        "faces_in_index": len(matrix),
+        "queries": count,
+        "probes": ivf_index.num_probes,
+        "clusters": len(ivf_index.lists),
+        "recall_at_1": round(same_nearest / count, 4),
+        "decision_agreement": round(same_decision / count, 4),
+        "mean_compared_faces": round(compared / count, 1),
+        "exact_ms_per_query": round(exact_time / count * 1000, 3),
+        "ivf_ms_per_query": round(ann_time / count * 1000, 3),
+    }
+
+
+if __name__ == "__main__":
+    from deepface.modules.verification import find_threshold
+    from face_index import FaceIndex
+
+    parser = argparse.ArgumentParser(description="Recall of the IVF search compared to the exact search.")
+    parser.add_argument("--index-folder", default=os.path.join(".", "face_index"))
+    parser.add_argument("--db-path", default=os.path.join(".", "my_db"))
+    parser.add_argument("--model", default="Facenet512")
+    parser.add_argument("--metric", default="cosine")
+    parser.add_argument("--threshold", type=float, default=None)
+    parser.add_argument("--probes", type=int, default=8)
+    parser.add_argument("--samples", type=int, default=1000)
+    args = parser.parse_args()
+
+    # Open the index with the settings it was made with (so it is not reset)
+    signature = FaceIndex.read_signature(args.index_folder, args.model)
+    if signature is None:
+        raise SystemExit(f"No face index in '{args.index_folder}'.")
+    report_index = FaceIndex(args.index_folder, args.db_path, os.path.join(args.db_path, "[new_faces]"),
+                             args.model, signature)
+    report_ivf = IVFIndex(args.index_folder, args.model, num_probes=args.probes)
+    report_ivf.load_or_build(report_index._matrix, report_index.generation)
+
+    report = recall_report(report_index, report_ivf, args.metric,
+                           args.threshold or find_threshold(args.model, args.metric), args.samples)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,337 @@
+# Benchmark of the Face Recognition script against the mock Eagle API (no Eagle needed).
+# A synthetic Eagle library is made from the sample images ("Eagle Photos to Test on" and "my_db"), the script
+# runs on it in its own work folder (copy of my_db, face index, journal) and the results are saved as JSON, to
+# compare the versions of the script:
+#
+#   python benchmark.py --items 500 --scenarios cold,warm,slow_eagle
+#   python benchmark.py --items 500 --compare benchmark_results\old.json
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from face_index import image_extensions
+from mock_eagle_server import MockEagleLibrary, MockEagleServer
+
+script_folder = os.path.dirname(os.path.abspath(__file__))
+script_path = os.path.join(script_folder, "FaceRecognition-Eagle V1.0_Stable.py")
+sample_folders = [os.path.join(script_folder, "Eagle Photos to Test on"), os.path.join(script_folder, "my_db")]
+
+# Same relative paths as in the script (the script runs in the work folder of the scenario)
+script_database_path = r".\my_db"
+script_journal_path = r".\face_reco_journal.sqlite"
+script_metrics_path = r".\face_reco_metrics.jsonl"
+process_folder_name = "FaceReco_Process"
+thumbnail_max_side = 400
+
+# Scenarios: latency (s) and failure rate of the mock Eagle, and "reuse" to run again on the work folder of
+# another scenario (e.g. a re-run where the journal skips the items already done)
+scenarios = {
+    "cold": {"latency": 0.0, "failure_rate": 0.0},
+    "warm": {"latency": 0.0, "failure_rate": 0.0, "reuse": "cold"},
+    "slow_eagle": {"latency": 0.02, "failure_rate": 0.05},
+}
+
+
+def percentiles(values):
+    """
+    Returns the count, p50, p95, p99 and max of a list of durations in seconds (in ms).
+    """
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    count = len(values)
+    return {"count": count,
+            "p50_ms": round(values[count // 2] * 1000, 2),
+            "p95_ms": round(values[min(count - 1, int(count * 0.95))] * 1000, 2),
+            "p99_ms": round(values[min(count - 1, int(count * 0.99))] * 1000, 2),
+            "max_ms": round(values[-1] * 1000, 2)}
+
+
+def list_sample_images(folders):
+    samples = []
+    for folder in folders:
+        for root, dirs, files in os.walk(folder):
+            for filename in sorted(files):
+                if filename.lower().endswith(image_extensions):
+                    samples.append(os.path.join(root, filename))
+    return samples
+
+
+def make_thumbnail(image_path):
+    """
+    Returns the PNG bytes of a thumbnail of the image (like the Eagle _thumbnail.png), or None, and the image size.
+    """
+    img = cv2.imdecode(np.fromfile(image_path, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return None, (None, None)
+    height, width = img.shape[:2]
+    scale = min(1.0, thumbnail_max_side / max(height, width))
+    thumbnail = cv2.resize(img, (max(1, int(width * scale)), max(1, int(height * scale))),
+                           interpolation=cv2.INTER_AREA)
+    return cv2.imencode(".png", thumbnail)[1].tobytes(), (width, height)
+
+
+def build_library(library_path, num_items, unique_content=True, seed=0):
+    """
+    Creates a synthetic Eagle library with num_items items made from the sample images (same folder layout as
+    Eagle: images\\{id}.info\\{name}.{ext} and {name}_thumbnail.png).
+
+    Args:
+        library_path: The folder of the library.
+        num_items: The number of items.
+        unique_content: If True, every copy of a sample image gets different bytes (random bytes added after the
+                        end of the image), so the journal doesn't find the same content twice.
+        seed: The random seed.
+
+    Returns:
+        The MockEagleLibrary.
+    """
+    rng = np.random.default_rng(seed)
+    samples = list_sample_images(sample_folders)
+    if not samples:
+        raise SystemExit("No sample images found.")
+
+    library = MockEagleLibrary(library_path)
+    folder_id = library.add_folder(process_folder_name)
+    thumbnails = {}
+    for num in range(num_items):
+        sample = samples[num % len(samples)]
+        if sample not in thumbnails:
+            thumbnails[sample] = make_thumbnail(sample)
+        thumbnail, (width, height) = thumbnails[sample]
+
+        name, ext = os.path.splitext(os.path.basename(sample))
+        name, ext = f"{name} ({num})", ext[1:]
+        with open(sample, "rb") as file:
+            file_bytes = file.read()
+        if unique_content:
+            file_bytes += rng.bytes(16)
+
+        item_id = library.add_item(name, ext, folder_id, item_id=f"BENCH{num:08d}", size=len(file_bytes),
+                                   width=width, height=height)
+        item_folder = library.item_folder(item_id)
+        os.makedirs(item_folder, exist_ok=True)
+        with open(os.path.join(item_folder, f"{name}.{ext}"), "wb") as file:
+            file.write(file_bytes)
+        if thumbnail is not None:
+            with open(os.path.join(item_folder, f"{name}_thumbnail.png"), "wb") as file:
+                file.write(thumbnail)
+    return library
+
+
+def load_library(library_path):
+    """
+    Loads a library made by build_library (for the scenarios that run again on the same work folder).
+    """
+    with open(os.path.join(library_path, "library.json"), encoding="utf-8") as file:
+        saved = json.load(file)
+    library = MockEagleLibrary(library_path)
+    library.folders = saved["folders"]
+    library.items = saved["items"]
+    return library
+
+
+def save_library(library):
+    with open(os.path.join(library.library_path, "library.json"), "w", encoding="utf-8") as file:
+        json.dump({"folders": library.folders, "items": library.items}, file)
+
+
+class PeakMemory:
+    """
+    Follows the peak memory (RSS) of the script and its worker processes while it runs (psutil is used if
+    installed, else the max RSS of the biggest child process is read at the end, Unix only).
+    """
+
+    def __init__(self, process):
+        self.process = process
+        self.peak = 0
+        self.method = None
+        try:
+            import psutil
+            self._psutil_process = psutil.Process(process.pid)
+            self.method = "psutil_tree"
+            self._thread = threading.Thread(target=self._poll, daemon=True)
+            self._thread.start()
+        except ImportError:
+            self._psutil_process = None
+
+    def _poll(self):
+        while self.process.poll() is None:
+            try:
+                processes = [self._psutil_process] + self._psutil_process.children(recursive=True)
+                self.peak = max(self.peak, sum(process.memory_info().rss for process in processes))
+            except Exception:  # A worker process stopped while reading
+                pass
+            time.sleep(0.2)
+
+    def peak_mb(self):
+        if self._psutil_process is not None:
+            return round(self.peak / 2 ** 20, 1)
+        try:
+            import resource
+            self.method = "max_child_rss"
+            return round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)  # KB on Linux
+        except ImportError:
+            return None
+
+
+def read_journal(work_folder, start_time):
+    """
+    Reads the items and faces recorded in the journal of the work folder since start_time.
+    """
+    journal_file = os.path.join(work_folder, script_journal_path)
+    if not os.path.exists(journal_file):
+        return {}, 0, []
+    connection = sqlite3.connect(journal_file)
+    try:
+        statuses = dict(connection.execute(
+            "SELECT status, COUNT(*) FROM items WHERE updated_at >= ? GROUP BY status", (start_time,)).fetchall())
+        faces = connection.execute(
+            "SELECT COUNT(*) FROM items JOIN faces USING (content_hash, settings_key) WHERE updated_at >= ?",
+            (start_time,)).fetchone()[0]
+        done_times = [row[0] for row in connection.execute(
+            "SELECT updated_at FROM items WHERE updated_at >= ? ORDER BY updated_at", (start_time,))]
+    finally:
+        connection.close()
+    return statuses, faces, done_times
+
+
+def read_stage_metrics(work_folder):
+    """
+    Reads the stage times of the last metrics line written by the script in the work folder.
+    """
+    metrics_file = os.path.join(work_folder, script_metrics_path)
+    if not os.path.exists(metrics_file):
+        return {}
+    with open(metrics_file, encoding="utf-8") as file:
+        lines = [line for line in file if line.strip()]
+    return json.loads(lines[-1])["stages"] if lines else {}
+
+
+def run_scenario(name, settings, num_items, work_root):
+    """
+    Runs the script on the synthetic library of a scenario and returns its results.
+    """
+    work_folder = os.path.join(work_root, settings.get("reuse", name))
+    library_path = os.path.join(work_folder, "library")
+    if "reuse" in settings and os.path.exists(library_path):
+        library = load_library(library_path)
+    else:
+        shutil.rmtree(work_folder, ignore_errors=True)
+        os.makedirs(work_folder)
+        print(f"[{name}] Creating a library of {num_items} items...")
+        library = build_library(library_path, num_items)
+        save_library(library)
+        shutil.copytree(os.path.join(script_folder, "my_db"), os.path.join(work_folder, script_database_path))
+
+    server = MockEagleServer(library, latency=settings["latency"], failure_rate=settings["failure_rate"]).start()
+    env = dict(os.environ, EAGLE_API_URL=server.url, FACE_RECO_METRICS="1")
+    metrics_file = os.path.join(work_folder, script_metrics_path)
+    if os.path.exists(metrics_file):  # Keep only the metrics of this run
+        os.remove(metrics_file)
+    log_path = os.path.join(work_folder, f"{name}_output.txt")
+    print(f"[{name}] Running the script (output: {log_path})...")
+
+    start_time = time.time()
+    start = time.perf_counter()
+    with open(log_path, "w", encoding="utf-8") as log_file:
+        process = subprocess.Popen([sys.executable, script_path], cwd=work_folder, env=env,
+                                   stdout=log_file, stderr=subprocess.STDOUT)
+        memory = PeakMemory(process)
+        exit_code = process.wait()
+    wall_time = time.perf_counter() - start
+    server.stop()
+
+    statuses, faces, done_times = read_journal(work_folder, start_time)
+    items_done = sum(statuses.values())
+    # Throughput after the start (model loading, index sync): from the first to the last item done
+    steady_time = done_times[-1] - done_times[0] if len(done_times) > 1 else 0
+    durations = server.durations
+    result = {
+        "scenario": name,
+        "settings": settings,
+        "items": num_items,
+        "items_done": items_done,
+        "statuses": statuses,
+        "faces": faces,
+        "exit_code": exit_code,
+        "wall_s": round(wall_time, 2),
+        "items_per_sec": round(items_done / wall_time, 3) if wall_time else None,
+        "listed_items_per_sec": round(num_items / wall_time, 3) if wall_time else None,  # Done or skipped
+        "faces_per_sec": round(faces / wall_time, 3) if wall_time else None,
+        "steady_items_per_sec": round((len(done_times) - 1) / steady_time, 3) if steady_time else None,
+        "item_interval": percentiles(np.diff(done_times).tolist() if len(done_times) > 1 else []),
+        "http_calls": server.calls,
+        "http_latency": {endpoint: percentiles(values) for endpoint, values in durations.items()},
+        # Time of every stage measured in the script (mean and percentiles in ms)
+        "stages": read_stage_metrics(work_folder),
+        "peak_rss_mb": memory.peak_mb(),
+        "peak_rss_method": memory.method,
+    }
+    return result
+
+
+def get_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=script_folder, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare_results(old_results, new_results):
+    """
+    Prints the change of the main numbers of every scenario compared to an older results file.
+    """
+    old_scenarios = {result["scenario"]: result for result in old_results["results"]}
+    for result in new_results["results"]:
+        old = old_scenarios.get(result["scenario"])
+        if old is None:
+            continue
+        for key in ("items_per_sec", "faces_per_sec", "steady_items_per_sec", "peak_rss_mb"):
+            if old.get(key) and result.get(key) is not None:
+                change = (result[key] - old[key]) / old[key] * 100
+                print(f"[{result['scenario']}] {key}: {old[key]} -> {result[key]} ({change:+.1f}%)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the Face Recognition script with a mock Eagle.")
+    parser.add_argument("--items", type=int, default=200, help="Number of items of the synthetic library")
+    parser.add_argument("--scenarios", default="cold,warm", help=f"Scenarios to run: {', '.join(scenarios)}")
+    parser.add_argument("--work-folder", default=os.path.join(".", "benchmark_runs"))
+    parser.add_argument("--output", default=None, help="Results JSON file (default: benchmark_results folder)")
+    parser.add_argument("--compare", default=None, help="Results JSON file of an older version to compare with")
+    parser.add_argument("--keep", action="store_true", help="Keep the work folders (library, Database copy)")
+    args = parser.parse_args()
+
+    results = {"version": get_version(), "time": time.strftime("%Y-%m-%d %H:%M:%S"), "python": sys.version,
+               "cpu_count": os.cpu_count(), "results": []}
+    for scenario_name in args.scenarios.split(","):
+        scenario_result = run_scenario(scenario_name, scenarios[scenario_name], args.items,
+                                       os.path.abspath(args.work_folder))
+        results["results"].append(scenario_result)
+        print(f"[{scenario_name}] {scenario_result['items_done']} items, {scenario_result['faces']} faces in "
+              f"{scenario_result['wall_s']} s: {scenario_result['items_per_sec']} items/s, "
+              f"{scenario_result['faces_per_sec']} faces/s, peak RSS {scenario_result['peak_rss_mb']} MB")
+
+    output_path = args.output or os.path.join(".", "benchmark_results",
+                                              f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Results saved to {output_path}")
+    if not args.keep:
+        shutil.rmtree(args.work_folder, ignore_errors=True)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as compare_file:
+            compare_results(json.load(compare_file), results)
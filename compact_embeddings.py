@@ -0,0 +1,294 @@
+# Compact copy of the face index embeddings for the search, to keep several 100k faces in RAM.
+# Every embedding is saved as its L2-normalized direction in float16 (2 bytes per value) or in int8 with a scale
+# per vector (1 byte per value), plus its norm, and the distances are calculated directly from the compact
+# vectors. The float32 embeddings file stays on disk (used to rebuild the compact copy and the other indexes).
+#
+# Decision report (compare the match decisions with the float32 search on faces of the index):
+#   python compact_embeddings.py --model Facenet512 --metric cosine --storage int8
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from face_index import find_distances
+
+# Storage types and their numpy types
+storage_types = {"float16": np.float16, "int8": np.int8}
+
+
+def quantize(matrix, storage):
+    """
+    Converts embeddings to the compact form.
+
+    Args:
+        matrix: The (n, dimensions) embeddings.
+        storage: "float16" or "int8".
+
+    Returns:
+        (codes, scales, norms): the compact directions, the scale of every vector (1 for float16) and the norm of
+        every embedding.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1).astype(np.float32)
+    directions = matrix / np.maximum(norms, 1e-12)[:, None]
+
+    if storage == "float16":
+        return directions.astype(np.float16), np.ones(len(matrix), dtype=np.float32), norms
+    if storage == "int8":
+        scales = np.maximum(np.abs(directions).max(axis=1), 1e-12).astype(np.float32) / 127
+        codes = np.clip(np.rint(directions / scales[:, None]), -127, 127).astype(np.int8)
+        return codes, scales, norms
+    raise ValueError(f"Invalid storage: {storage}")
+
+
+class CompactEmbeddings:
+    """
+    Compact embeddings of a FaceIndex, loaded in RAM and kept up to date by the index (see FaceIndex.use_compact).
+
+    Files in the index folder:
+      {model_name}_embeddings.{storage}: the compact directions (one row per face, same rows as the index).
+      {model_name}_embeddings_{storage}_scales.f32: the scale and the norm of every row (2 float32 per row).
+      {model_name}_embeddings_{storage}.json: the generation of the face index the files were built from.
+    """
+
+    def __init__(self, index_folder, model_name, storage="float16", chunk_rows=65536):
+        """
+        Args:
+            index_folder: The folder of the face index.
+            model_name: The name of the model of the face index.
+            storage: "float16" or "int8".
+            chunk_rows: Number of rows converted to float32 at once in a search (limits the temporary memory).
+        """
+        if storage not in storage_types:
+            raise ValueError(f"Invalid storage: {storage}")
+        self.storage = storage
+        self.chunk_rows = chunk_rows
+        self._codes_path = os.path.join(index_folder, f"{model_name}_embeddings.{storage}")
+        self._scales_path = os.path.join(index_folder, f"{model_name}_embeddings_{storage}_scales.f32")
+        self._meta_path = os.path.join(index_folder, f"{model_name}_embeddings_{storage}.json")
+
+        self.count = 0
+        self._codes = np.zeros((0, 0), dtype=storage_types[storage])
+        self._scales = np.zeros(0, dtype=np.float32)
+        self._norms = np.zeros(0, dtype=np.float32)
+
+    @property
+    def norms(self):
+        return self._norms[:self.count]
+
+    @property
+    def nbytes(self):
+        return self.count * (self._codes.shape[1] * self._codes.itemsize + 8)
+
+    def _read_generation(self):
+        if not os.path.exists(self._meta_path):
+            return None
+        with open(self._meta_path, encoding="utf-8") as file:
+            return json.load(file).get("generation")
+
+    def load_or_build(self, matrix, generation=0):
+        """
+        Loads the compact embeddings from disk, or builds them from the float32 matrix of the index if the files
+        don't match the index (other generation, e.g. faces removed and added by a sync, or other number of faces
+        or dimensions).
+
+        Args:
+            matrix: The float32 matrix of the face index.
+            generation: The generation of the face index (FaceIndex.generation, changes when its rows are rewritten).
+        """
+        rows, dimensions = len(matrix), (matrix.shape[1] if matrix.ndim == 2 else 0)
+        item_size = np.dtype(storage_types[self.storage]).itemsize
+        if (rows and self._read_generation() == generation
+                and os.path.exists(self._codes_path) and os.path.exists(self._scales_path)
+                and os.path.getsize(self._codes_path) == rows * dimensions * item_size
+                and os.path.getsize(self._scales_path) == rows * 8):
+            self._codes = np.fromfile(self._codes_path, dtype=storage_types[self.storage]).reshape(rows, dimensions)
+            scales = np.fromfile(self._scales_path, dtype=np.float32).reshape(rows, 2)
+            self._scales, self._norms = scales[:, 0].copy(), scales[:, 1].copy()
+            self.count = rows
+            print(f"Compact embeddings loaded: {rows} faces ({self.storage}, {self.nbytes / 2 ** 20:.1f} MB).")
+        else:
+            self.build(matrix, generation)
+
+    def build(self, matrix, generation=0):
+        """
+        Builds the compact embeddings from the float32 matrix of the index (chunk by chunk) and saves them with
+        the generation of the index.
+        """
+        rows = len(matrix)
+        dimensions = matrix.shape[1] if matrix.ndim == 2 else 0
+        self._codes = np.zeros((rows, dimensions), dtype=storage_types[self.storage])
+        self._scales = np.zeros(rows, dtype=np.float32)
+        self._norms = np.zeros(rows, dtype=np.float32)
+        for start in range(0, rows, self.chunk_rows):
+            end = min(rows, start + self.chunk_rows)
+            self._codes[start:end], self._scales[start:end], self._norms[start:end] = quantize(matrix[start:end],
+                                                                                                self.storage)
+        self.count = rows
+
+        with open(self._codes_path + ".tmp", "wb") as file:
+            file.write(self._codes.tobytes())
+        with open(self._scales_path + ".tmp", "wb") as file:
+            file.write(np.stack([self._scales, self._norms], axis=1).astype(np.float32).tobytes())
+        os.replace(self._codes_path + ".tmp", self._codes_path)
+        os.replace(self._scales_path + ".tmp", self._scales_path)
+        with open(self._meta_path + ".tmp", "w", encoding="utf-8") as file:
+            json.dump({"generation": generation}, file)
+        os.replace(self._meta_path + ".tmp", self._meta_path)
+        if rows:
+            print(f"Compact embeddings built: {rows} faces ({self.storage}, {self.nbytes / 2 ** 20:.1f} MB).")
+
+    def add(self, vector, save=True):
+        """
+        Appends the compact form of an embedding added to the index.
+        save=False: the row is already saved by another process (see FaceIndex.refresh).
+        """
+        codes, scales, norms = quantize(np.asarray(vector, dtype=np.float32).reshape(1, -1), self.storage)
+        if self.count >= len(self._codes) or self._codes.shape[1] != codes.shape[1]:  # Grow (doubled)
+            capacity = max(1024, 2 * len(self._codes))
+            grown_codes = np.zeros((capacity, codes.shape[1]), dtype=self._codes.dtype)
+            grown_scales = np.zeros(capacity, dtype=np.float32)
+            grown_norms = np.zeros(capacity, dtype=np.float32)
+            if self.count:
+                grown_codes[:self.count] = self._codes[:self.count]
+                grown_scales[:self.count] = self._scales[:self.count]
+                grown_norms[:self.count] = self._norms[:self.count]
+            self._codes, self._scales, self._norms = grown_codes, grown_scales, grown_norms
+
+        self._codes[self.count], self._scales[self.count], self._norms[self.count] = codes[0], scales[0], norms[0]
+        self.count += 1
+        if save:
+            with open(self._codes_path, "ab") as file:
+                file.write(codes.tobytes())
+            with open(self._scales_path, "ab") as file:
+                file.write(np.array([scales[0], norms[0]], dtype=np.float32).tobytes())
+
+    def find_distances(self, embedding, distance_metric, rows=None):
+        """
+        Calculates the distance between one embedding and the compact embeddings (same as face_index.find_distances).
+
+        Args:
+            embedding: The embedding of the face to search for.
+            distance_metric: "cosine", "euclidean" or "euclidean_l2".
+            rows: The rows to compare with (None: all the rows).
+
+        Returns:
+            A numpy array with the distance to every row.
+        """
+        target = np.asarray(embedding, dtype=np.float32)
+        target_norm = np.linalg.norm(target)
+        direction = target / max(target_norm, 1e-12)
+
+        if rows is None:
+            codes, scales, norms = self._codes[:self.count], self._scales[:self.count], self._norms[:self.count]
+        else:
+            codes, scales, norms = self._codes[rows], self._scales[rows], self._norms[rows]
+        cosine_similarity = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), self.chunk_rows):
+            cosine_similarity[start:start + self.chunk_rows] = \
+                codes[start:start + self.chunk_rows].astype(np.float32) @ direction
+        cosine_similarity *= scales
+
+        if distance_metric == "cosine":
+            return 1 - cosine_similarity
+
+        elif distance_metric == "euclidean":
+            squared = norms ** 2 - 2 * norms * target_norm * cosine_similarity + target_norm ** 2
+            return np.sqrt(np.maximum(squared, 0))
+
+        elif distance_metric == "euclidean_l2":
+            return np.sqrt(np.maximum(2 - 2 * cosine_similarity, 0))
+
+        raise ValueError(f"Invalid distance metric: {distance_metric}")
+
+
+def decision_report(face_index, compact, distance_metric, threshold, sample_size=1000, seed=0):
+    """
+    Compares the match decisions of the compact search with the float32 search, using faces of the index as
+    queries (each query face is removed from its own search).
+
+    Returns:
+        A dictionary with the agreement of the match decisions at the threshold, the number of matches gained and
+        lost, the distance error, the memory of both forms and the time of both searches.
+    """
+    matrix, norms = face_index._matrix, face_index.norms
+    rng = np.random.default_rng(seed)
+    queries = rng.choice(len(matrix), min(sample_size, len(matrix)), replace=False)
+
+    same_nearest = same_decision = gained = lost = 0
+    distance_errors = []
+    exact_time = compact_time = 0.0
+    for row in queries:
+        embedding = np.array(matrix[row])
+
+        start = time.perf_counter()
+        distances = find_distances(matrix, norms, embedding, distance_metric)
+        distances[row] = np.inf
+        exact_row = int(np.argmin(distances))
+        exact_match = distances[exact_row] <= threshold
+        exact_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        compact_distances = compact.find_distances(embedding, distance_metric)
+        compact_distances[row] = np.inf
+        compact_row = int(np.argmin(compact_distances))
+        compact_match = compact_distances[compact_row] <= threshold
+        compact_time += time.perf_counter() - start
+
+        same_nearest += compact_row == exact_row
+        # Same decision: both no match, or both match the same person
+        same_decision += (exact_match == compact_match and (
+            not exact_match or face_index.entries[compact_row]["identity"]
+            == face_index.entries[exact_row]["identity"]))
+        gained += compact_match and not exact_match
+        lost += exact_match and not compact_match
+        distance_errors.append(abs(float(compact_distances[exact_row]) - float(distances[exact_row])))
+
+    count = len(queries)
+    return {
+        "faces_in_index": len(matrix),
+        "queries": count,
+        "storage": compact.storage,
+        "distance_metric": distance_metric,
+        "threshold": threshold,
+        "nearest_agreement": round(same_nearest / count, 4),
+        "decision_agreement": round(same_decision / count, 4),
+        "matches_gained": gained,  # Match with the compact form, no match with float32
+        "matches_lost": lost,  # No match with the compact form, match with float32
+        "mean_distance_error": round(float(np.mean(distance_errors)), 6),
+        "max_distance_error": round(float(np.max(distance_errors)), 6),
+        "float32_mb": round(matrix.size * 4 / 2 ** 20, 2),
+        "compact_mb": round(compact.nbytes / 2 ** 20, 2),
+        "float32_ms_per_query": round(exact_time / count * 1000, 3),
+        "compact_ms_per_query": round(compact_time / count * 1000, 3),
+    }
+
+
+if __name__ == "__main__":
+    from deepface.modules.verification import find_threshold
+    from face_index import FaceIndex
+
+    parser = argparse.ArgumentParser(description="Match decisions of the compact embeddings compared to float32.")
+    parser.add_argument("--index-folder", default=os.path.join(".", "face_index"))
+    parser.add_argument("--db-path", default=os.path.join(".", "my_db"))
+    parser.add_argument("--model", default="Facenet512")
+    parser.add_argument("--metric", default="cosine")
+    parser.add_argument("--threshold", type=float, default=None)
+    parser.add_argument("--storage", default="int8", choices=sorted(storage_types))
+    parser.add_argument("--samples", type=int, default=1000)
+    args = parser.parse_args()
+
+    # Open the index with the settings it was made with (so it is not reset)
+    signature = FaceIndex.read_signature(args.index_folder, args.model)
+    if signature is None:
+        raise SystemExit(f"No face index in '{args.index_folder}'.")
+    report_index = FaceIndex(args.index_folder, args.db_path, os.path.join(args.db_path, "[new_faces]"),
+                             args.model, signature)
+    report_compact = CompactEmbeddings(args.index_folder, args.model, args.storage)
+    report_compact.load_or_build(report_index._matrix, report_index.generation)
+
+    report = decision_report(report_index, report_compact, args.metric,
+                             args.threshold or find_threshold(args.model, args.metric), args.samples)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,285 @@
+# Client for the Eagle local API (http://localhost:41595 by default).
+# One keep-alive session is shared by all the calls (and threads), every call has a timeout and is retried with
+# backoff when Eagle is busy, and the time of every call is recorded per endpoint.
+import os
+import threading
+import time
+from collections import deque
+from urllib.parse import unquote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import metrics
+
+# HTTP status codes that are worth retrying (Eagle busy or restarting)
+retry_status_codes = {429, 500, 502, 503, 504}
+# Number of latest calls per endpoint kept for the latency percentiles (the memory stays the same in daemon mode)
+latency_window = 1000
+
+
+class EagleError(Exception):
+    """
+    An Eagle call failed after all the retries (e.g. Eagle closed or busy).
+    """
+
+
+class EagleClient:
+    """
+    Eagle API client with connection pooling, timeouts, retries and per-endpoint latency stats.
+    """
+
+    def __init__(self, base_url, timeout=30, retries=3, backoff=0.5, pool_size=16, page_size=200,
+                 offset_is_page=True):
+        """
+        Args:
+            base_url: The Eagle API URL (e.g. "http://localhost:41595").
+            timeout: Timeout in seconds of every call.
+            retries: How many times a failed call is retried.
+            backoff: The wait before the first retry in seconds, doubled after every retry.
+            pool_size: Max number of kept-alive connections (at least the number of threads using the client).
+            page_size: Number of items per page when listing items.
+            offset_is_page: True if Eagle "offset" parameter is the page number (Eagle API), False if it is the
+                            number of items to skip.
+        """
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.page_size = page_size
+        self.offset_is_page = offset_is_page
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    # ----------------------------------------------------------- Requests
+
+    def _record(self, endpoint, duration, retries, failed):
+        with self._stats_lock:
+            stats = self._stats.setdefault(endpoint, {"calls": 0, "retries": 0, "errors": 0, "total": 0.0, "max": 0.0,
+                                                      "durations": deque(maxlen=latency_window)})
+            stats["calls"] += 1
+            stats["retries"] += retries
+            stats["errors"] += failed
+            stats["total"] += duration
+            stats["max"] = max(stats["max"], duration)
+            stats["durations"].append(duration)
+        metrics.count("http_calls")
+        metrics.count("http_retries", retries)
+        metrics.count("http_errors", int(failed))
+
+    def request(self, method, endpoint, params=None, json=None):
+        """
+        Calls an Eagle endpoint, retries on connection errors, timeouts and busy status codes.
+
+        Args:
+            method: "GET" or "POST".
+            endpoint: The endpoint path (e.g. "/api/item/list").
+            params: The query parameters.
+            json: The JSON body (for POST).
+
+        Returns:
+            The "data" of the response, or None if the call failed.
+        """
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            error = None
+            try:
+                response = self.session.request(method, f"{self.base_url}{endpoint}", params=params, json=json,
+                                                timeout=self.timeout)
+                if response.status_code not in retry_status_codes:
+                    break
+                error = f"{response.status_code} {response.text}"
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+
+            if attempt >= self.retries:
+                print(f"Error calling Eagle {endpoint}: {error}")
+                self._record(endpoint, time.perf_counter() - start, attempt, True)
+                return None
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+        data = None
+        if response.status_code == 200:
+            try:
+                data = response.json().get("data")
+            except ValueError:
+                pass
+        if data is None:
+            print(f"Error calling Eagle {endpoint}: {response.status_code} {response.text}")
+        self._record(endpoint, time.perf_counter() - start, attempt, data is None)
+        return data
+
+    # ----------------------------------------------------------- Endpoints
+
+    def get_folders(self):
+        """
+        Returns the list of the folders of the library (/api/folder/list).
+        """
+        return self.request("GET", "/api/folder/list") or []
+
+    def get_folder_id(self, folder_name):
+        """
+        Returns the id of the (top level) folder with the given name, or None if not found.
+        """
+        for folder in self.get_folders():
+            if folder['name'] == folder_name:
+                return folder['id']
+        return None
+
+    def iter_item_pages(self, folder_id=None, max_pages=None, order_by=None, start_page=0):
+        """
+        Walks the item pages of a folder (/api/item/list), each page is requested only once.
+
+        Args:
+            folder_id: The id of the folder to list (None: all the library).
+            max_pages: Max number of pages to request (None: all the pages).
+            order_by: The order of the items, e.g. "-CREATEDATE" for the newest first (None: Eagle default order).
+            start_page: The number of the first page to request (e.g. to continue an interrupted listing).
+
+        Yields:
+            The list of items of every page, the walk stops after the first short or empty page.
+
+        Raises:
+            EagleError: A page could not be listed (the walk did not reach the last page).
+        """
+        page = start_page
+        while max_pages is None or page < start_page + max_pages:
+            offset = page if self.offset_is_page else page * self.page_size
+            params = {"limit": self.page_size, "offset": offset}
+            if folder_id:
+                params["folders"] = folder_id
+            if order_by:
+                params["orderBy"] = order_by
+
+            items = self.request("GET", "/api/item/list", params=params)
+            if items is None:  # Not the end of the listing, the caller must not take it as the last page
+                raise EagleError(f"Couldn't list the items of page {page + 1}")
+            if not items:  # No more items
+                return
+            yield items
+
+            if len(items) < self.page_size:  # Last page
+                return
+            page += 1
+
+    def get_library_info(self):
+        """
+        Returns the information of the library opened in Eagle (/api/library/info), or None.
+        """
+        return self.request("GET", "/api/library/info")
+
+    def get_thumbnail_path(self, item_id):
+        """
+        Returns the path of the thumbnail of an item (/api/item/thumbnail), or None.
+        """
+        return self.request("GET", "/api/item/thumbnail", params={"id": item_id})
+
+    def get_item_info(self, item_id):
+        """
+        Returns the information of an item (/api/item/info), or None.
+        """
+        return self.request("GET", "/api/item/info", params={"id": item_id})
+
+    def update_item(self, item_id, **fields):
+        """
+        Updates the fields of an item, e.g. update_item(item_id, tags=[...]) (/api/item/update).
+
+        Returns:
+            The updated item, or None if the update failed.
+        """
+        return self.request("POST", "/api/item/update", json={"id": item_id, **fields})
+
+    def get_original_path(self, item):
+        """
+        Gets the path of the original file of an item from its thumbnail path (2 API calls are avoided by
+        ItemPathResolver, this is only the fallback).
+
+        Args:
+            item: The Eagle item (from the item list).
+
+        Returns:
+            The path of the original file, or None.
+        """
+        thumbnail_path = self.get_thumbnail_path(item['id'])
+        if not thumbnail_path:
+            return None
+        return unquote(thumbnail_path).replace("_thumbnail.png", f".{item['ext']}")
+
+    # ----------------------------------------------------------- Stats
+
+    def get_stats(self):
+        """
+        Returns the latency stats per endpoint: calls, retries, errors and latency (mean/p50/p95/max in ms, the
+        percentiles of the last latency_window calls).
+        """
+        with self._stats_lock:
+            report = {}
+            for endpoint, stats in self._stats.items():
+                durations = sorted(stats["durations"])
+                count = len(durations)
+                report[endpoint] = {
+                    "calls": stats["calls"],
+                    "retries": stats["retries"],
+                    "errors": stats["errors"],
+                    "mean_ms": round(stats["total"] / stats["calls"] * 1000, 2),
+                    "p50_ms": round(durations[count // 2] * 1000, 2),
+                    "p95_ms": round(durations[min(count - 1, int(count * 0.95))] * 1000, 2),
+                    "max_ms": round(stats["max"] * 1000, 2),
+                }
+            return report
+
+    def print_stats(self):
+        """
+        Prints the latency stats per endpoint.
+        """
+        for endpoint, stats in self.get_stats().items():
+            print(f"Eagle {endpoint}: {stats['calls']} calls, {stats['retries']} retries, {stats['errors']} errors, "
+                  f"mean {stats['mean_ms']} ms, p50 {stats['p50_ms']} ms, p95 {stats['p95_ms']} ms, "
+                  f"max {stats['max_ms']} ms")
+
+
+class ItemPathResolver:
+    """
+    Builds the path of the original file of an item from the library path, the item id, name and ext
+    ({library}\images\{id}.info\{name}.{ext}), with no API call per item.
+    The library path is asked once, and the API is only used when the file is not found.
+    """
+
+    def __init__(self, client):
+        """
+        Args:
+            client: The EagleClient.
+        """
+        self.client = client
+        library_info = client.get_library_info() or {}
+        self.library_path = library_info.get('library', {}).get('path')
+        self.fallbacks = 0  # Number of items that needed the API
+        self._lock = threading.Lock()  # resolve is called by the reader threads
+        if self.library_path:
+            print(f"Eagle library path: {self.library_path}")
+        else:
+            print("Eagle library path not found, the file paths will be asked to the API.")
+
+    def resolve(self, item):
+        """
+        Returns the path of the original file of an item, or None if Eagle doesn't know it.
+
+        Args:
+            item: The Eagle item (from the item list, with "id", "name" and "ext").
+        """
+        if self.library_path:
+            path = os.path.join(self.library_path, "images", f"{item['id']}.info", f"{item['name']}.{item['ext']}")
+            if os.path.exists(path):
+                return path
+
+        with self._lock:
+            self.fallbacks += 1
+        return self.client.get_original_path(item)
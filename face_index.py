@@ -0,0 +1,665 @@
+# Persistent embedding index of the faces in the Database "my_db".
+# Replaces the per-face DeepFace.find scan: the embeddings are stored once as a contiguous float32 matrix
+# (memory-mapped from disk) next to an identity/path table, and new face crops are appended to it.
+import json
+import os
+
+import cv2
+import numpy as np
+
+# Image extensions that are considered as faces in the Database folder
+image_extensions = ('.jpg', '.jpeg', '.png', '.bmp', '.webp', '.avif', '.jfif')
+
+
+def find_distances(matrix, norms, embedding, distance_metric):
+    """
+    Calculates the distance between one embedding and every row of the matrix in a single vectorized pass.
+
+    Args:
+        matrix: The (n, dimensions) float32 matrix of the Database embeddings.
+        norms: The L2 norm of every row of the matrix.
+        embedding: The embedding of the face to search for.
+        distance_metric: "cosine", "euclidean" or "euclidean_l2" (same as DeepFace).
+
+    Returns:
+        A numpy array with the distance to every row of the matrix.
+    """
+    target = np.asarray(embedding, dtype=np.float32)
+    target_norm = np.linalg.norm(target)
+    dot_products = matrix @ target
+
+    if distance_metric == "cosine":
+        return 1 - dot_products / (norms * target_norm)
+
+    elif distance_metric == "euclidean":
+        squared = norms ** 2 - 2 * dot_products + target_norm ** 2
+        return np.sqrt(np.maximum(squared, 0))
+
+    elif distance_metric == "euclidean_l2":
+        cosine_similarity = dot_products / (norms * target_norm)
+        return np.sqrt(np.maximum(2 - 2 * cosine_similarity, 0))
+
+    raise ValueError(f"Invalid distance metric: {distance_metric}")
+
+
+def perceptual_hash(image):
+    """
+    Calculates the 64 bits difference hash (dHash) of an image: the image is reduced to 9x8 gray pixels and every
+    bit tells if a pixel is brighter than its right neighbour. Crops of the same photo that differ by a few pixels
+    have the same or a very close hash.
+
+    Args:
+        image: The image (BGR or gray numpy array from cv2).
+
+    Returns:
+        The hash as an int, or None if the image is empty.
+    """
+    if image is None or image.size == 0:
+        return None
+    if image.ndim == 3:
+        image = cv2.cvtColor(image[:, :, :3], cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(sum(1 << num for num, bit in enumerate(bits) if bit))
+
+
+def hash_distance(hash1, hash2):
+    """
+    Returns the number of different bits between two perceptual hashes.
+    """
+    return bin(hash1 ^ hash2).count("1")
+
+
+class FaceIndex:
+    """
+    Embedding index of the Database, loaded once per process and updated incrementally.
+
+    The index is made of 3 files in the index folder:
+      {model_name}_embeddings.f32: the raw float32 matrix (one row per face image).
+      {model_name}_identities.jsonl: one line per row with the image path (relative to the Database),
+                                     the person name (folder name), the file size/mtime and the perceptual hash.
+      {model_name}_meta.json: the settings used to create the embeddings, if they change the index is rebuilt.
+    The embeddings of face images that are not in the Database yet (e.g. from ConvertToFacesForDB) are kept in
+    {model_name}_pending.npz, and used when the images are copied to the Database.
+    """
+
+    def __init__(self, index_folder, db_path, new_faces_path, model_name, signature):
+        """
+        Args:
+            index_folder: The folder where the index files are saved.
+            db_path: The path to the Database folder (my_db).
+            new_faces_path: The path to the "[new_faces]" sub folder of the Database.
+            model_name: The name of the model used for the embeddings.
+            signature: A dictionary with all the settings that change the embeddings (model, detector, ...).
+        """
+        self.index_folder = index_folder
+        self.db_path = db_path
+        self.new_faces_folder_name = os.path.basename(os.path.normpath(new_faces_path))
+        self.signature = signature
+
+        self._matrix_path = os.path.join(index_folder, f"{model_name}_embeddings.f32")
+        self._table_path = os.path.join(index_folder, f"{model_name}_identities.jsonl")
+        self._meta_path = os.path.join(index_folder, f"{model_name}_meta.json")
+        self._pending_path = os.path.join(index_folder, f"{model_name}_pending.npz")
+        self._unsaved_pending = {}  # Pending faces added with save=False, {image key: embedding} (see save_pending)
+
+        self.entries = []
+        self.dimensions = None
+        self.generation = 0  # Number of rewrites of the index files (see refresh)
+        self._table_size = 0  # Size of the table file read by this process (see refresh)
+        self._matrix = None
+        self._buffer = None  # In-RAM copy of the embeddings once faces are added, with room for more (see add)
+        self._norms = None  # L2 norm of every row (see norms)
+        self._norms_buffer = None  # The array _norms is a view of, with room for more rows (see _append_norms)
+        self.ann = None  # Approximate search index (see use_ann)
+        self.compact = None  # Compact copy of the embeddings for the search (see use_compact)
+        self.prototypes = None  # Prototypes of every person (see use_prototypes)
+        self._folder_rows = {}  # Rows of every folder of the Database (for find_duplicate)
+
+        self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    # ----------------------------------------------------------- Loading / Saving
+
+    def load(self):
+        """
+        Loads the index from disk. If the settings changed since the index was created, the index is reset.
+        """
+        meta = self._read_meta()
+        if meta is None or meta.get("signature") != self.signature:
+            if meta is not None:
+                print("Face index settings changed, the index will be rebuilt.")
+            self._reset()
+            return
+
+        self.dimensions = meta["dimensions"]
+        self.generation = meta.get("generation", 0)
+
+        entries = []
+        self._table_size = 0
+        if os.path.exists(self._table_path):
+            with open(self._table_path, encoding="utf-8") as file:
+                entries = [json.loads(line) for line in file if line.strip()]
+            self._table_size = os.path.getsize(self._table_path)
+
+        # If the script stopped between writing the matrix and the table, keep only the complete rows
+        rows = 0
+        if self.dimensions and os.path.exists(self._matrix_path):
+            rows = os.path.getsize(self._matrix_path) // (self.dimensions * 4)
+        count = min(rows, len(entries))
+        self.entries = entries[:count]
+        if count != rows or count != len(entries):
+            print(f"Face index was not complete, keeping {count} faces.")
+            self._rewrite(self._map_matrix(rows)[:count] if rows else None)
+            return
+
+        self._map_matrix(count)
+        self._norms = None  # Calculated when needed (the embeddings file is not read at the start)
+        self._group_folders()
+        print(f"Face index loaded: {count} faces.")
+
+    def _map_matrix(self, rows):
+        """
+        Memory-maps the first rows of the embeddings file (the file is not loaded in RAM).
+        """
+        self._buffer = None
+        if rows == 0:
+            self._matrix = np.zeros((0, self.dimensions or 0), dtype=np.float32)
+        else:
+            self._matrix = np.memmap(self._matrix_path, dtype=np.float32, mode='r', shape=(rows, self.dimensions))
+        return self._matrix
+
+    @staticmethod
+    def read_signature(index_folder, model_name):
+        """
+        Returns the signature of the index saved in index_folder, or None if there is no index.
+        """
+        meta_path = os.path.join(index_folder, f"{model_name}_meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, encoding="utf-8") as file:
+            return json.load(file).get("signature")
+
+    def _read_meta(self):
+        if not os.path.exists(self._meta_path):
+            return None
+        with open(self._meta_path, encoding="utf-8") as file:
+            return json.load(file)
+
+    def _save_meta(self):
+        with open(self._meta_path, "w", encoding="utf-8") as file:
+            json.dump({"signature": self.signature, "dimensions": self.dimensions, "generation": self.generation},
+                      file, indent=2)
+
+    def _reset(self):
+        self.entries = []
+        self.dimensions = None
+        self._rewrite(None)
+
+    def _rewrite(self, matrix):
+        """
+        Rewrites the embeddings and table files with the given matrix and the current entries.
+        """
+        matrix = np.zeros((0, 0), dtype=np.float32) if matrix is None else np.array(matrix, dtype=np.float32)
+        self._matrix = None  # Release the memory-map before replacing the file (needed on Windows)
+
+        with open(self._matrix_path + ".tmp", "wb") as file:
+            file.write(matrix.tobytes())
+        with open(self._table_path + ".tmp", "w", encoding="utf-8") as file:
+            for entry in self.entries:
+                file.write(json.dumps(entry) + "\n")
+        os.replace(self._matrix_path + ".tmp", self._matrix_path)
+        os.replace(self._table_path + ".tmp", self._table_path)
+        self._table_size = os.path.getsize(self._table_path)
+        self.generation += 1  # The other processes must load the index again
+        self._save_meta()
+
+        self._map_matrix(len(self.entries))
+        self._norms = None
+        self._group_folders()
+        if self.ann is not None:  # The rows changed
+            self.ann.build(self._matrix, self.generation)
+        if self.compact is not None:
+            self.compact.build(self._matrix, self.generation)
+        if self.prototypes is not None:
+            self.prototypes.build()
+
+    @property
+    def norms(self):
+        """
+        The L2 norm of every row, calculated once from the embeddings file (or taken from the compact embeddings).
+        """
+        if self._norms is None:
+            if self.compact is not None and self.compact.count == len(self.entries):
+                self._norms = self.compact.norms.copy()
+            elif self.entries:
+                self._norms = np.linalg.norm(self._matrix, axis=1)
+            else:
+                self._norms = np.zeros(0, dtype=np.float32)
+        return self._norms
+
+    def _append_norms(self, norms):
+        """
+        Adds the norms of new rows, the capacity is doubled when full (adding rows one by one stays cheap).
+        """
+        count = len(self._norms)
+        if self._norms_buffer is None or self._norms.base is not self._norms_buffer \
+                or count + len(norms) > len(self._norms_buffer):
+            self._norms_buffer = np.zeros(max(16, 2 * (count + len(norms))), dtype=np.float32)
+            self._norms_buffer[:count] = self._norms
+        self._norms_buffer[count:count + len(norms)] = norms
+        self._norms = self._norms_buffer[:count + len(norms)]
+
+    def embeddings(self, rows):
+        """
+        Returns the float32 embeddings of some rows of the index (read from the embeddings file).
+
+        Args:
+            rows: A row number, or a list/array of row numbers.
+        """
+        return np.asarray(self._matrix[rows], dtype=np.float32)
+
+    def _group_folders(self):
+        self._folder_rows = {}
+        for row, entry in enumerate(self.entries):
+            self._folder_rows.setdefault(os.path.dirname(entry["path"]), []).append(row)
+
+    # ----------------------------------------------------------- Database Folder
+
+    def _make_entry(self, relative_path, stat, image_hash=None):
+        """
+        Creates the table entry of an image, the person name is the folder name of the image.
+        """
+        parts = relative_path.split(os.sep)
+        new_face = parts[0] == self.new_faces_folder_name
+        identity = parts[1] if new_face else parts[0]
+        return {"path": relative_path, "identity": identity, "new_face": new_face,
+                "size": stat.st_size, "mtime": int(stat.st_mtime), "phash": image_hash}
+
+    def list_database_images(self):
+        """
+        Lists all the face images inside the person folders of the Database.
+
+        Returns:
+            A dictionary of {relative path: os.stat result}.
+        """
+        images = {}
+        for root, dirs, files in os.walk(self.db_path):
+            for filename in files:
+                if not filename.lower().endswith(image_extensions):
+                    continue
+                file_path = os.path.join(root, filename)
+                relative_path = os.path.relpath(file_path, self.db_path)
+                parts = relative_path.split(os.sep)
+                # Only images inside a person folder (or inside [new_faces]\New Face_{num}) have a name
+                if len(parts) < 2 or (parts[0] == self.new_faces_folder_name and len(parts) < 3):
+                    continue
+                images[relative_path] = os.stat(file_path)
+        return images
+
+    def sync_with_folder(self, embed_fn):
+        """
+        Makes the index match the images in the Database folder. Only the images that are new or changed are
+        embedded, the images that were moved or renamed (e.g. a "New Face_{num}" folder renamed to the person
+        name) keep their embeddings, and deleted images are removed from the index.
+
+        Args:
+            embed_fn: A function that takes an image path and returns its embedding (or None if it fails).
+        """
+        images = self.list_database_images()
+
+        kept_rows = []
+        missing_rows = []
+        indexed_paths = set()
+        for row, entry in enumerate(self.entries):
+            stat = images.get(entry["path"])
+            if stat is not None and stat.st_size == entry["size"] and int(stat.st_mtime) == entry["mtime"]:
+                kept_rows.append(row)
+                indexed_paths.add(entry["path"])
+            elif stat is None:
+                missing_rows.append(row)
+
+        # Find the moved images by their name, size and modification time
+        unindexed = {}
+        for relative_path, stat in images.items():
+            if relative_path not in indexed_paths:
+                key = (os.path.basename(relative_path), stat.st_size, int(stat.st_mtime))
+                unindexed.setdefault(key, []).append(relative_path)
+
+        moved = 0
+        for row in missing_rows:
+            entry = self.entries[row]
+            key = (os.path.basename(entry["path"]), entry["size"], entry["mtime"])
+            if unindexed.get(key):
+                relative_path = unindexed[key].pop()
+                self.entries[row] = self._make_entry(relative_path, images[relative_path], entry.get("phash"))
+                kept_rows.append(row)
+                indexed_paths.add(relative_path)
+                moved += 1
+
+        removed = len(self.entries) - len(kept_rows)
+        if removed or moved:
+            kept_rows.sort()
+            matrix = self._matrix[kept_rows] if kept_rows else None
+            self.entries = [self.entries[row] for row in kept_rows]
+            self._rewrite(matrix)
+            print(f"Face index: {moved} faces moved, {removed} faces removed.")
+
+        new_paths = [path for path in images if path not in indexed_paths]
+        pending = self.load_pending() if new_paths else {}
+        if new_paths:
+            print(f"Face index: Adding {len(new_paths)} new faces from the Database...")
+        used_pending = 0
+        for relative_path in new_paths:
+            # Images converted by ConvertToFacesForDB keep their embedding (same name, size and modification time)
+            embedding = pending.pop(self.image_key(relative_path, images[relative_path]), None)
+            if embedding is not None:
+                used_pending += 1
+            else:
+                embedding = embed_fn(os.path.join(self.db_path, relative_path))
+            if embedding is not None:
+                self.add(os.path.join(self.db_path, relative_path), embedding)
+        if used_pending:
+            self._save_pending(pending)
+            print(f"Face index: {used_pending} faces added with the embeddings saved by ConvertToFacesForDB.")
+
+    # ----------------------------------------------------------- Pending faces
+
+    @staticmethod
+    def image_key(image_path, stat):
+        """
+        Returns the key of a face image that doesn't change when the image is moved: name, size and mtime.
+        """
+        return f"{os.path.basename(image_path)}|{stat.st_size}|{int(stat.st_mtime)}"
+
+    def load_pending(self):
+        """
+        Returns the embeddings of the face images that are not in the Database yet, {image key: embedding}.
+        """
+        if not os.path.exists(self._pending_path):
+            return {}
+        with np.load(self._pending_path) as pending:
+            if json.loads(str(pending["signature"])) != self.signature:  # Made with other settings
+                return {}
+            return dict(zip(map(str, pending["keys"]), pending["embeddings"]))
+
+    def _save_pending(self, pending):
+        if not pending:  # All the pending faces are in the Database
+            if os.path.exists(self._pending_path):
+                os.remove(self._pending_path)
+            return
+        keys = list(pending)
+        embeddings = np.array([pending[key] for key in keys], dtype=np.float32)
+        with open(self._pending_path + ".tmp", "wb") as file:
+            np.savez(file, signature=json.dumps(self.signature), keys=np.array(keys, dtype=str),
+                     embeddings=embeddings)
+        os.replace(self._pending_path + ".tmp", self._pending_path)
+
+    def add_pending(self, faces, save=True):
+        """
+        Saves the embeddings of face images that are saved outside of the Database (e.g. by ConvertToFacesForDB).
+        When an image is copied to the Database later (with the same name, size and modification time), its
+        embedding is taken from here instead of embedding the image again.
+
+        Args:
+            faces: A list of (image_path, embedding).
+            save: False to keep the faces in memory until save_pending is called (the pending file is rewritten
+                  once for many calls).
+        """
+        for image_path, embedding in faces:
+            key = self.image_key(image_path, os.stat(image_path))
+            self._unsaved_pending[key] = np.asarray(embedding, dtype=np.float32)
+        if save:
+            self.save_pending()
+
+    def save_pending(self):
+        """
+        Saves the pending faces added with save=False.
+        """
+        if not self._unsaved_pending:
+            return
+        pending = self.load_pending()
+        pending.update(self._unsaved_pending)
+        self._save_pending(pending)
+        self._unsaved_pending = {}
+
+    def remove(self, image_paths):
+        """
+        Removes face images from the index and from the pending faces (e.g. the old faces of a photo converted
+        again by ConvertToFacesForDB). Call it before the image files are deleted (the pending key needs their stat).
+
+        Args:
+            image_paths: The paths of the face images (inside the Database or not).
+        """
+        relative_paths = set()
+        pending_keys = set()
+        for image_path in image_paths:
+            if os.path.exists(image_path):
+                pending_keys.add(self.image_key(image_path, os.stat(image_path)))
+            try:
+                relative_paths.add(os.path.relpath(image_path, self.db_path))
+            except ValueError:  # On another drive than the Database
+                continue
+
+        kept_rows = [row for row, entry in enumerate(self.entries) if entry["path"] not in relative_paths]
+        if len(kept_rows) < len(self.entries):
+            matrix = self._matrix[kept_rows] if kept_rows else None
+            self.entries = [self.entries[row] for row in kept_rows]
+            self._rewrite(matrix)
+
+        for key in pending_keys:
+            self._unsaved_pending.pop(key, None)
+        pending = self.load_pending() if pending_keys else {}
+        if pending_keys & pending.keys():
+            for key in pending_keys:
+                pending.pop(key, None)
+            self._save_pending(pending)
+
+    # ----------------------------------------------------------- Add / Search
+
+    def add(self, image_path, embedding, image_hash=None):
+        """
+        Appends the embedding of a face image saved in the Database, without touching the other faces.
+
+        Args:
+            image_path: The path of the face image inside the Database.
+            embedding: The embedding of the face.
+            image_hash: The perceptual hash of the face image (None: calculated from the image file).
+        """
+        vector = np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+        if self.dimensions is None:
+            self.dimensions = vector.shape[1]
+            self._save_meta()
+
+        if image_hash is None:
+            image_hash = perceptual_hash(cv2.imread(image_path))
+        relative_path = os.path.relpath(image_path, self.db_path)
+        entry = self._make_entry(relative_path, os.stat(image_path), image_hash)
+
+        # The embeddings are copied once to RAM with room for more rows (the capacity is doubled when full), so
+        # adding faces one by one doesn't map the file again for every face. This also releases the memory-map
+        # before appending to the file (needed on Windows).
+        row = len(self.entries)
+        if self._buffer is None or row >= len(self._buffer):
+            buffer = np.zeros((max(16, 2 * row), self.dimensions), dtype=np.float32)
+            if row:
+                buffer[:row] = self._matrix[:row]
+            self._buffer = buffer
+            self._matrix = self._buffer[:row]
+        with open(self._matrix_path, "ab") as file:
+            file.write(vector.tobytes())
+        with open(self._table_path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(entry) + "\n")
+        self._table_size = os.path.getsize(self._table_path)
+
+        self.entries.append(entry)
+        self._folder_rows.setdefault(os.path.dirname(relative_path), []).append(row)
+        self._buffer[row] = vector[0]
+        self._matrix = self._buffer[:row + 1]
+        if self._norms is not None:
+            self._append_norms(np.linalg.norm(vector, axis=1))
+        if self.ann is not None:
+            self.ann.add(len(self.entries) - 1, vector)
+        if self.compact is not None:
+            self.compact.add(vector)
+        if self.prototypes is not None:
+            self.prototypes.add(len(self.entries) - 1)
+
+    def refresh(self):
+        """
+        Reads the faces added to the index files by other processes (worker mode, call it while holding the
+        Database lock so the files are not being written).
+
+        Returns:
+            The rows that were added, or None if the index was rewritten by another process (it was loaded again).
+        """
+        meta = self._read_meta()
+        if meta is None or meta.get("generation", 0) != self.generation or meta.get("signature") != self.signature:
+            self.load()
+            if self.ann is not None:
+                self.ann.load_or_build(self._matrix, self.generation)
+            if self.compact is not None:
+                self.compact.load_or_build(self._matrix, self.generation)
+            if self.prototypes is not None:
+                self.prototypes.build()
+            return None
+
+        if not os.path.exists(self._table_path) or os.path.getsize(self._table_path) == self._table_size:
+            return []
+        with open(self._table_path, "rb") as file:
+            file.seek(self._table_size)
+            data = file.read()
+        data = data[:data.rfind(b"\n") + 1]  # Only the complete lines
+        self._table_size += len(data)
+        new_entries = [json.loads(line) for line in data.decode("utf-8").splitlines() if line.strip()]
+        if not new_entries:
+            return []
+
+        self.dimensions = meta["dimensions"]
+        first_row = len(self.entries)
+        self.entries.extend(new_entries)
+        self._map_matrix(len(self.entries))
+        if self._norms is not None:
+            self._append_norms(np.linalg.norm(self._matrix[first_row:], axis=1))
+        new_rows = list(range(first_row, len(self.entries)))
+        for row in new_rows:  # The other process already saved the rows in the files of the indexes
+            self._folder_rows.setdefault(os.path.dirname(self.entries[row]["path"]), []).append(row)
+            if self.ann is not None:
+                self.ann.add(row, self._matrix[row], save=False)
+            if self.compact is not None:
+                self.compact.add(self._matrix[row], save=False)
+            if self.prototypes is not None:
+                self.prototypes.add(row)
+        return new_rows
+
+    def use_ann(self, ann):
+        """
+        Searches with an approximate index (e.g. ann_index.IVFIndex) instead of comparing with every face.
+        The index is loaded from disk (or built) and kept up to date by add and sync_with_folder.
+        """
+        self.ann = ann
+        ann.load_or_build(self._matrix, self.generation)
+
+    def use_compact(self, compact):
+        """
+        Searches with the compact embeddings (compact_embeddings.CompactEmbeddings: float16 or int8, in RAM)
+        instead of the float32 embeddings file. They are loaded from disk (or built) and kept up to date by add
+        and sync_with_folder.
+        """
+        self.compact = compact
+        compact.load_or_build(self._matrix, self.generation)
+
+    def use_prototypes(self, prototypes):
+        """
+        Matches the faces with the prototypes of every person (prototype_index.PrototypeIndex) instead of every
+        face image. The prototypes are calculated from the index and kept up to date by add and sync_with_folder.
+        """
+        self.prototypes = prototypes
+        prototypes.build()
+
+    def find_nearest(self, embedding, distance_metric, threshold):
+        """
+        Finds the nearest face in the Database (same as the first row of DeepFace.find result).
+        With an approximate index only the faces of the nearest clusters are compared, the distance and the
+        threshold are the same as in the exact search.
+
+        Args:
+            embedding: The embedding of the face to search for.
+            distance_metric: The distance metric to use.
+            threshold: Faces with a distance bigger than the threshold are not a match.
+
+        Returns:
+            A dictionary with "identity", "path", "new_face" and "distance" of the matched face,
+            or None if there is no match.
+        """
+        if not self.entries:
+            return None
+        if self.prototypes is not None:
+            return self.prototypes.find_nearest(embedding, distance_metric, threshold)
+
+        if self.ann is not None and self.ann.is_ready:
+            rows = self.ann.candidates(embedding)
+            if len(rows) == 0:
+                return None
+            if self.compact is not None:
+                distances = self.compact.find_distances(embedding, distance_metric, rows)
+            else:
+                distances = find_distances(self._matrix[rows], self.norms[rows], embedding, distance_metric)
+            best = int(np.argmin(distances))
+            row, distance = int(rows[best]), float(distances[best])
+        else:
+            if self.compact is not None:
+                distances = self.compact.find_distances(embedding, distance_metric)
+            else:
+                distances = find_distances(self._matrix, self.norms, embedding, distance_metric)
+            row = int(np.argmin(distances))
+            distance = float(distances[row])
+
+        if distance > threshold:
+            return None
+
+        entry = self.entries[row]
+        return {"identity": entry["identity"], "path": os.path.join(self.db_path, entry["path"]),
+                "new_face": entry["new_face"], "distance": distance}
+
+    def _get_hash(self, row):
+        """
+        Returns the perceptual hash of a face of the index (calculated once from the image file for the faces
+        indexed before the hashes were saved).
+        """
+        entry = self.entries[row]
+        if entry.get("phash") is None:
+            entry["phash"] = perceptual_hash(cv2.imread(os.path.join(self.db_path, entry["path"])))
+        return entry["phash"]
+
+    def find_duplicate(self, folder_path, embedding, image_hash, distance_metric, max_distance, max_hash_distance):
+        """
+        Checks in memory if the same face (from the same photo) is already in a folder of the Database: the
+        embeddings must be very close and the perceptual hashes must be almost the same, so crops of the same
+        photo that differ by a few pixels are found, but other photos of the person are not.
+
+        Args:
+            folder_path: The Database folder where the face would be saved.
+            embedding: The embedding of the face.
+            image_hash: The perceptual hash of the face crop.
+            distance_metric: The distance metric to use.
+            max_distance: Max embedding distance of a duplicate.
+            max_hash_distance: Max number of different bits between the hashes of a duplicate.
+
+        Returns:
+            The path of the duplicate face image, or None.
+        """
+        rows = self._folder_rows.get(os.path.relpath(folder_path, self.db_path))
+        if not rows or image_hash is None:
+            return None
+
+        distances = find_distances(self._matrix[rows], self.norms[rows], embedding, distance_metric)
+        for num in np.argsort(distances):
+            if distances[num] > max_distance:
+                break
+            row_hash = self._get_hash(rows[num])
+            if row_hash is not None and hash_distance(row_hash, image_hash) <= max_hash_distance:
+                return os.path.join(self.db_path, self.entries[rows[num]]["path"])
+        return None
@@ -0,0 +1,820 @@
+# Face detection and embedding stages used by the Face Recognition script.
+# The faces are detected only once in the original image, the aligned faces from the detector are embedded
+# directly by the model (no second detection inside the cropped face), and the padded crop is only used for
+# the image saved to the Database.
+# The faces of several images are embedded together in batches (one model call per batch).
+# The stages run concurrently: I/O stages in threads and the detection/embedding stage in worker processes.
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from deepface import DeepFace
+from deepface.modules import preprocessing
+
+from metrics import metrics
+
+
+def clip_coordinates(facial_area, image_width, image_height):
+    """
+    Clips the coordinates of a facial area dictionary to stay within image borders.
+
+    Args:
+        facial_area: A dictionary or pandas containing facial area information.
+        image_width: The width of the image.
+        image_height: The height of the image.
+
+    Returns:
+        A new dictionary with clipped coordinates.
+    """
+
+    if "dict" in str(type(facial_area)):
+        clipped_area = {}
+        clipped_area['x'] = max(0, min(facial_area['x'], image_width - 1))
+        clipped_area['y'] = max(0, min(facial_area['y'], image_height - 1))
+        clipped_area['w'] = min(facial_area['w'], image_width - clipped_area['x'])
+        clipped_area['h'] = min(facial_area['h'], image_height - clipped_area['y'])
+        return clipped_area
+
+    elif "pandas" in str(type(facial_area)):
+        clipped_area = {}
+        clipped_area['x'] = max(0, min(facial_area['source_x'][0], image_width - 1))
+        clipped_area['y'] = max(0, min(facial_area['source_y'][0], image_height - 1))
+        clipped_area['w'] = min(facial_area['source_w'][0], image_width - clipped_area['x'])
+        clipped_area['h'] = min(facial_area['source_h'][0], image_height - clipped_area['y'])
+        return clipped_area
+
+
+def crop_face(original_image, facial_area):
+    """
+    Crops the face from the original image.
+
+    Args:
+      original_image : the original image loaded by cv2.
+      facial_area : the dictionary or pandas containing facial area information.
+
+    Returns:
+      cropped_face: the cropped face, ready to save.
+    """
+    # Get the image cropping area, Assuming image is a NumPy array
+    clipped_area = clip_coordinates(facial_area, original_image.shape[1], original_image.shape[0])
+
+    # Use clipped_area for cropping:
+    cropped_face = original_image[clipped_area['y']:clipped_area['y'] + clipped_area['h'],
+                                  clipped_area['x']:clipped_area['x'] + clipped_area['w']]
+    return cropped_face
+
+
+def expand_facial_area(facial_area, expand_percentage):
+    """
+    Expands the facial area with a percentage (same as DeepFace expand_percentage).
+
+    Args:
+        facial_area: A dictionary containing facial area information (x, y, w, h).
+        expand_percentage: How much to expand the facial area in percentage %.
+
+    Returns:
+        A new dictionary with the expanded coordinates (use clip_coordinates to keep it inside the image).
+    """
+    x, y, w, h = facial_area['x'], facial_area['y'], facial_area['w'], facial_area['h']
+    if expand_percentage > 0:
+        expanded_w = w + int(w * expand_percentage / 100)
+        expanded_h = h + int(h * expand_percentage / 100)
+        x = max(0, x - int((expanded_w - w) / 2))
+        y = max(0, y - int((expanded_h - h) / 2))
+        w, h = expanded_w, expanded_h
+    return {'x': x, 'y': y, 'w': w, 'h': h}
+
+
+def reduce_image(img, max_side):
+    """
+    Makes a reduced copy of an image for face detection (big photos are detected much faster at a lower
+    resolution and the faces are still found).
+
+    Args:
+        img: The image loaded by cv2.
+        max_side: The max width/height of the copy (None: no reduction).
+
+    Returns:
+        (reduced image, scale) with scale the size of the original image divided by the size of the copy
+        (the original image and 1 if it is already small enough).
+    """
+    height, width = img.shape[:2]
+    if not max_side or max(height, width) <= max_side:
+        return img, 1.0
+    scale = max(height, width) / max_side
+    reduced = cv2.resize(img, (max(1, round(width / scale)), max(1, round(height / scale))),
+                         interpolation=cv2.INTER_AREA)
+    return reduced, scale
+
+
+def scale_facial_area(facial_area, scale, offset_x=0, offset_y=0):
+    """
+    Maps a facial area (and its eyes) found in a reduced or cropped image to the original image.
+
+    Args:
+        facial_area: The facial area from the detector.
+        scale: The size of the original image divided by the size of the detected image.
+        offset_x: The x of the detected image in the original image.
+        offset_y: The y of the detected image in the original image.
+    """
+    scaled_area = dict(facial_area)
+    for key in ('x', 'y', 'w', 'h'):
+        scaled_area[key] = int(round(facial_area[key] * scale))
+    scaled_area['x'] += offset_x
+    scaled_area['y'] += offset_y
+    for key in ('left_eye', 'right_eye'):
+        if facial_area.get(key) is not None:
+            eye_x, eye_y = facial_area[key]
+            scaled_area[key] = (int(round(eye_x * scale)) + offset_x, int(round(eye_y * scale)) + offset_y)
+    return scaled_area
+
+
+def refine_face(img, facial_area, detector_backend):
+    """
+    Detects again a face in a small region of the original image around its facial area, to get the aligned
+    face at full resolution (used for the faces that are too small in the reduced copy).
+
+    Args:
+        img: The original image loaded by cv2.
+        facial_area: The facial area of the face in the original image.
+        detector_backend: The detector backend to use.
+
+    Returns:
+        (aligned face, facial area in the original image), or None if the face is not found in the region.
+    """
+    x, y, w, h = facial_area['x'], facial_area['y'], facial_area['w'], facial_area['h']
+    left, top = max(0, x - w // 2), max(0, y - h // 2)
+    right, bottom = min(img.shape[1], x + w + w // 2), min(img.shape[0], y + h + h // 2)
+    region_faces = DeepFace.extract_faces(img_path=img[top:bottom, left:right], enforce_detection=False,
+                                          detector_backend=detector_backend, align=True)
+    region_faces = [face for face in region_faces if face['confidence']]
+    if not region_faces:
+        return None
+
+    # Keep the face nearest to the center of the facial area
+    center_x, center_y = x + w / 2 - left, y + h / 2 - top
+    nearest = min(region_faces, key=lambda face: (face['facial_area']['x'] + face['facial_area']['w'] / 2
+                                                  - center_x) ** 2 + (face['facial_area']['y']
+                                                                      + face['facial_area']['h'] / 2 - center_y) ** 2)
+    return nearest['face'], scale_facial_area(nearest['facial_area'], 1, left, top)
+
+
+def detect_faces(img, detector_backend, expand_percentage, enforce_detection=True, max_side=None, refine_below=160,
+                 tiling=None):
+    """
+    Detects the faces in an image (only once) and keeps everything needed for embedding and saving.
+    Images bigger than max_side are detected on a reduced copy and the facial areas are mapped back to the
+    original image, the faces smaller than refine_below pixels in the copy are aligned again at full resolution.
+    Very large images (more pixels than tiling["min_pixels"]) are detected in tiles, see detect_faces_tiled.
+
+    Args:
+        img: The path of the image or the image loaded by cv2.
+        detector_backend: The detector backend to use.
+        expand_percentage: How much to expand the saved face cropping area in percentage %.
+        enforce_detection: If True, raise an error when no face is detected in the image.
+        max_side: The max width/height of the image used for detection (None: full resolution).
+        refine_below: The min size in pixels of a face in the reduced copy to use its aligned face.
+        tiling: A dictionary with "min_pixels" and the arguments of detect_faces_tiled (None: no tiles).
+
+    Returns:
+        A list of dictionaries, one per face:
+          "face": the aligned face from the detector (RGB in [0, 1]), ready for embedding.
+          "facial_area": the facial area found by the detector (in the original image).
+          "save_area": the facial area expanded with expand_percentage, used to crop the face saved to disk.
+          "confidence": the confidence of the detector.
+    """
+    if needs_tiles(img, tiling):
+        tiling = {key: value for key, value in tiling.items() if key != 'min_pixels'}
+        faces = detect_faces_tiled(img, detector_backend, expand_percentage, max_side=max_side,
+                                   refine_below=refine_below, **tiling)
+        if not faces and enforce_detection:
+            raise ValueError("Face could not be detected in the image tiles.")
+        return faces
+
+    detection_img, scale = (img, 1.0) if isinstance(img, str) else reduce_image(img, max_side)
+    extracted_faces = DeepFace.extract_faces(img_path=detection_img, enforce_detection=enforce_detection,
+                                             detector_backend=detector_backend, align=True)
+    faces = []
+    for extracted_face in extracted_faces:
+        face, facial_area = extracted_face['face'], extracted_face['facial_area']
+        if scale != 1.0:
+            small_face = min(facial_area['w'], facial_area['h']) < refine_below
+            facial_area = scale_facial_area(facial_area, scale)
+            refined = refine_face(img, facial_area, detector_backend) if small_face else None
+            if refined is not None:
+                face, facial_area = refined
+
+        faces.append({
+            'face': face,
+            'facial_area': facial_area,
+            'save_area': expand_facial_area(facial_area, expand_percentage),
+            'confidence': extracted_face['confidence'],
+        })
+    return faces
+
+
+def needs_tiles(img, tiling):
+    """
+    Checks if an image (loaded by cv2) has more pixels than tiling["min_pixels"].
+    """
+    return (bool(tiling) and tiling.get('min_pixels') is not None and not isinstance(img, str)
+            and img.shape[0] * img.shape[1] > tiling['min_pixels'])
+
+
+def tile_positions(length, tile_size, overlap):
+    """
+    Returns the start of the tiles along one side of an image: tiles of tile_size pixels with overlap pixels
+    in common, the last tile ends at the end of the image.
+    """
+    if length <= tile_size:
+        return [0]
+    step = max(1, tile_size - overlap)
+    positions = list(range(0, length - tile_size, step))
+    positions.append(length - tile_size)
+    return positions
+
+
+def _overlap(area, other_area):
+    """
+    Intersection of two facial areas divided by the area of the smaller one (1: one contains the other).
+    """
+    left, top = max(area['x'], other_area['x']), max(area['y'], other_area['y'])
+    right = min(area['x'] + area['w'], other_area['x'] + other_area['w'])
+    bottom = min(area['y'] + area['h'], other_area['y'] + other_area['h'])
+    intersection = max(0, right - left) * max(0, bottom - top)
+    smaller = min(area['w'] * area['h'], other_area['w'] * other_area['h'])
+    return intersection / smaller if smaller else 0.0
+
+
+def merge_duplicate_faces(faces, max_overlap=0.5):
+    """
+    Non-maximum suppression of the faces found twice (in two tiles, or in a tile and the reduced copy): the face
+    with the best confidence is kept.
+
+    Args:
+        faces: The faces with their "facial_area" and "confidence" in the original image.
+        max_overlap: Max overlap of two facial areas (intersection / smaller area) to be different faces.
+    """
+    kept = []
+    for face in sorted(faces, key=lambda found: found['confidence'] or 0, reverse=True):
+        if all(_overlap(face['facial_area'], kept_face['facial_area']) <= max_overlap for kept_face in kept):
+            kept.append(face)
+    return kept
+
+
+def detect_faces_tiled(img, detector_backend, expand_percentage, tile_size=1600, overlap=320, threads=1,
+                       max_side=None, refine_below=160):
+    """
+    Detects the faces of a very large image (panorama, scan): the small faces are found at full resolution in
+    overlapping tiles (detected in parallel), the faces at least as big as the overlap (they can be cut by every
+    tile) on a reduced copy of the whole image, and the faces found twice are merged. The memory used by the
+    detector depends on the tile size, not on the image size.
+
+    Args:
+        img: The image loaded by cv2.
+        detector_backend: The detector backend to use.
+        expand_percentage: How much to expand the saved face cropping area in percentage %.
+        tile_size: The width/height of the tiles in pixels.
+        overlap: The pixels two tiles have in common (a face smaller than this is complete in one of the tiles).
+        threads: Number of tiles detected at the same time.
+        max_side: The max width/height of the reduced copy.
+        refine_below: The faces of the reduced copy smaller than this are aligned again at full resolution.
+
+    Returns:
+        The faces like detect_faces, with their facial areas in the original image.
+    """
+    height, width = img.shape[:2]
+    tiles = [(left, top) for top in tile_positions(height, tile_size, overlap)
+             for left in tile_positions(width, tile_size, overlap)]
+
+    def detect_tile(tile):
+        left, top = tile
+        right, bottom = min(width, left + tile_size), min(height, top + tile_size)
+        tile_faces = []
+        for extracted_face in DeepFace.extract_faces(img_path=img[top:bottom, left:right], enforce_detection=False,
+                                                     detector_backend=detector_backend, align=True):
+            facial_area = extracted_face['facial_area']
+            if not extracted_face['confidence']:  # No face in the tile (the whole tile is returned)
+                continue
+            # A face touching an inner side of the tile is cut, it is complete in the next tile
+            if ((left and facial_area['x'] <= 1) or (top and facial_area['y'] <= 1)
+                    or (right < width and facial_area['x'] + facial_area['w'] >= right - left - 1)
+                    or (bottom < height and facial_area['y'] + facial_area['h'] >= bottom - top - 1)):
+                continue
+            tile_faces.append({'face': extracted_face['face'],
+                               'facial_area': scale_facial_area(facial_area, 1, left, top),
+                               'confidence': extracted_face['confidence']})
+        return tile_faces
+
+    # The faces that can be cut by every tile (not smaller than the overlap) on the reduced copy of the whole image
+    detection_img, scale = reduce_image(img, max_side or tile_size)
+    faces = []
+    for extracted_face in DeepFace.extract_faces(img_path=detection_img, enforce_detection=False,
+                                                 detector_backend=detector_backend, align=True):
+        face, facial_area = extracted_face['face'], extracted_face['facial_area']
+        if not extracted_face['confidence'] or max(facial_area['w'], facial_area['h']) * scale < overlap:
+            continue  # No face, or complete in one of the tiles
+        small_face = min(facial_area['w'], facial_area['h']) < refine_below
+        facial_area = scale_facial_area(facial_area, scale)
+        refined = refine_face(img, facial_area, detector_backend) if small_face else None
+        if refined is not None:
+            face, facial_area = refined
+        faces.append({'face': face, 'facial_area': facial_area, 'confidence': extracted_face['confidence']})
+
+    metrics.count("tiles", len(tiles))
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        for tile_faces in executor.map(detect_tile, tiles):
+            faces.extend(tile_faces)
+
+    faces = merge_duplicate_faces(faces)
+    for face in faces:
+        face['save_area'] = expand_facial_area(face['facial_area'], expand_percentage)
+    return faces
+
+
+def check_face_quality(img, face, min_size=0, min_confidence=0, min_sharpness=0, max_asymmetry=None):
+    """
+    Cheap quality checks of a detected face, before it is embedded (tiny background faces, blur, profiles).
+
+    Args:
+        img: The original image loaded by cv2.
+        face: The face from detect_faces.
+        min_size: The min width/height in pixels of the face in the original image.
+        min_confidence: The min confidence of the detector.
+        min_sharpness: The min variance of the Laplacian of the face (resized to 112 pixels wide), lower is blurrier.
+        max_asymmetry: The max horizontal distance between the center of the eyes and the center of the face,
+                       divided by the face width (0 for a frontal face, higher for a profile face).
+
+    Returns:
+        None if the face is good enough, else the reason: "small", "confidence", "pose" or "blur".
+    """
+    facial_area = face['facial_area']
+    if min(facial_area['w'], facial_area['h']) < min_size:
+        return "small"
+
+    confidence = face.get('confidence')
+    if min_confidence and confidence is not None and confidence < min_confidence:
+        return "confidence"
+
+    left_eye, right_eye = facial_area.get('left_eye'), facial_area.get('right_eye')
+    if max_asymmetry is not None and left_eye is not None and right_eye is not None:
+        eyes_center_x = (left_eye[0] + right_eye[0]) / 2
+        face_center_x = facial_area['x'] + facial_area['w'] / 2
+        if abs(eyes_center_x - face_center_x) / facial_area['w'] > max_asymmetry:
+            return "pose"
+
+    if min_sharpness:
+        gray = cv2.cvtColor(crop_face(img, facial_area), cv2.COLOR_BGR2GRAY)
+        if gray.size:
+            gray = cv2.resize(gray, (112, max(1, round(112 * gray.shape[0] / gray.shape[1]))))
+            if cv2.Laplacian(gray, cv2.CV_64F).var() < min_sharpness:
+                return "blur"
+    return None
+
+
+def get_thumbnail_path(img_path):
+    """
+    Returns the path of the Eagle thumbnail of an original image ({name}_thumbnail.png next to {name}.{ext}).
+    """
+    return f"{img_path.rsplit('.', 1)[0]}_thumbnail.png"
+
+
+def detect_faces_on_thumbnail(img, thumbnail_path, detector_backend, expand_percentage, min_face_side=32):
+    """
+    Detects the faces on the small Eagle thumbnail of an image, the facial areas are scaled to the original image
+    and every face is aligned from its region of the original image (the detector only runs on small images).
+
+    Args:
+        img: The original image loaded by cv2.
+        thumbnail_path: The path of the Eagle thumbnail of the image.
+        detector_backend: The detector backend to use.
+        expand_percentage: How much to expand the saved face cropping area in percentage %.
+        min_face_side: The min size in pixels of a face on the thumbnail.
+
+    Returns:
+        The faces (same as detect_faces), or None if the full image should be used: no thumbnail, no face found
+        on the thumbnail, a face smaller than min_face_side or a face not found again in the original image.
+    """
+    if not os.path.exists(thumbnail_path):
+        return None
+    thumbnail = cv2.imdecode(np.fromfile(thumbnail_path, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if thumbnail is None:
+        return None
+
+    thumbnail_faces = DeepFace.extract_faces(img_path=thumbnail, enforce_detection=False,
+                                             detector_backend=detector_backend, align=True)
+    thumbnail_faces = [face for face in thumbnail_faces if face['confidence']]
+    if not thumbnail_faces or any(min(face['facial_area']['w'], face['facial_area']['h']) < min_face_side
+                                  for face in thumbnail_faces):
+        return None
+
+    scale = img.shape[1] / thumbnail.shape[1]
+    faces = []
+    for thumbnail_face in thumbnail_faces:
+        refined = refine_face(img, scale_facial_area(thumbnail_face['facial_area'], scale), detector_backend)
+        if refined is None:
+            return None
+        face, facial_area = refined
+        faces.append({
+            'face': face,
+            'facial_area': facial_area,
+            'save_area': expand_facial_area(facial_area, expand_percentage),
+            'confidence': thumbnail_face['confidence'],
+        })
+    return faces
+
+
+class FaceEmbedder:
+    """
+    Calculates the embeddings of aligned faces with the recognition model (the model is loaded only once).
+    """
+
+    def __init__(self, model_name, normalization="base"):
+        """
+        Args:
+            model_name: The name of the model to use (e.g. "Facenet512").
+            normalization: The normalization of the model input (same as DeepFace.represent).
+        """
+        self.model_name = model_name
+        self.normalization = normalization
+        self.model = DeepFace.build_model(model_name)
+        self.input_shape = self.model.input_shape
+
+    def preprocess(self, face):
+        """
+        Prepares an aligned face for the model (same steps as DeepFace.represent).
+
+        Args:
+            face: The aligned face from the detector (RGB in [0, 1]).
+
+        Returns:
+            The model input with shape (1, height, width, 3).
+        """
+        target_size = self.input_shape
+        img = face[:, :, ::-1]  # rgb to bgr
+        img = preprocessing.resize_image(img=img, target_size=(target_size[1], target_size[0]))
+        return preprocessing.normalize_input(img=img, normalization=self.normalization)
+
+    def embed(self, face):
+        """
+        Calculates the embedding of one aligned face.
+
+        Args:
+            face: The aligned face from the detector (RGB in [0, 1]).
+
+        Returns:
+            The embedding of the face as a list of floats.
+        """
+        return self.model.forward(self.preprocess(face))
+
+    def embed_batch(self, faces):
+        """
+        Calculates the embeddings of many aligned faces with one model call.
+
+        Args:
+            faces: A list of aligned faces from the detector (RGB in [0, 1]).
+
+        Returns:
+            A list with the embedding of every face (same order as faces).
+        """
+        if not faces:
+            return []
+
+        batch = np.concatenate([self.preprocess(face) for face in faces], axis=0)
+        keras_model = getattr(self.model, 'model', None)
+        if hasattr(keras_model, 'predict_on_batch'):  # Keras models (e.g. Facenet512) take the whole batch
+            return keras_model(batch, training=False).numpy().tolist()
+
+        # Other models (e.g. Dlib, SFace) only support one face per call
+        return [self.model.forward(batch[i:i + 1]) for i in range(len(batch))]
+
+
+class EmbeddingBatcher:
+    """
+    Collects the faces of several images and embeds them together when the batch is full or when the
+    oldest image waited more than the time window. The embeddings are then given back to their images.
+    """
+
+    def __init__(self, embedder, batch_size=32, time_window=2.0):
+        """
+        Args:
+            embedder: The FaceEmbedder used to embed the faces.
+            batch_size: The number of faces to embed in one model call.
+            time_window: The max time in seconds an image waits for its faces to be embedded.
+        """
+        self.embedder = embedder
+        self.batch_size = batch_size
+        self.time_window = time_window
+        self._pending = []  # List of (source, faces) waiting for embedding
+        self._pending_faces = 0
+        self._oldest_time = None
+
+    def add(self, source, faces):
+        """
+        Adds the faces of an image to the batch.
+
+        Args:
+            source: Anything that identifies the image (given back with the embedded faces).
+            faces: The faces of the image (from detect_faces).
+
+        Returns:
+            A list of (source, faces) of the images that are ready, each face has its "embedding" key set.
+            The images are returned in the same order they were added.
+        """
+        if not self._pending:
+            self._oldest_time = time.monotonic()
+        self._pending.append((source, faces))
+        self._pending_faces += len(faces)
+
+        if self._pending_faces >= self.batch_size or time.monotonic() - self._oldest_time >= self.time_window:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """
+        Embeds all the waiting faces (call it at the end to get the last images).
+
+        Returns:
+            A list of (source, faces) of the images, each face has its "embedding" key set.
+        """
+        pending = self._pending
+        self._pending = []
+        self._pending_faces = 0
+
+        all_faces = [face for source, faces in pending for face in faces]
+        for start in range(0, len(all_faces), self.batch_size):
+            batch = all_faces[start:start + self.batch_size]
+            try:
+                with metrics.timer("embed"):
+                    embeddings = self.embedder.embed_batch([face['face'] for face in batch])
+            except Exception as e:  # Handel Errors: embed the faces one by one to skip only the broken faces
+                print(f"Batch embedding failed ({e}), embedding the faces one by one")
+                embeddings = [self._embed_one(face['face']) for face in batch]
+            for face, embedding in zip(batch, embeddings):  # Give back every embedding to its face
+                face['embedding'] = embedding
+        return pending
+
+    def _embed_one(self, face):
+        try:
+            return self.embedder.embed(face)
+        except Exception as e:  # Handel Errors
+            print(e)
+            return None
+
+
+# ----------------------------------------------------------- Detection workers
+
+_embedders = {}
+_worker_settings = {}
+
+
+def get_face_embedder(model_name):
+    """
+    Returns the FaceEmbedder of the model, the model is loaded only once per process.
+    """
+    if model_name not in _embedders:
+        _embedders[model_name] = FaceEmbedder(model_name)
+    return _embedders[model_name]
+
+
+def use_inference_backend(inference, model_name, detector_backend):
+    """
+    Selects how the models run in this process: with DeepFace (TensorFlow/PyTorch) or with ONNX Runtime.
+
+    Args:
+        inference: None for DeepFace, or the arguments of onnx_backend.OnnxBackend ("folder", "quantize",
+                   "intra_op_threads", "inter_op_threads"), the models are exported on the first use.
+        model_name: The embedding model.
+        detector_backend: The detector backend (run by DeepFace if ONNX Runtime doesn't support it).
+    """
+    _embedders.clear()
+    if not inference:
+        return
+    from onnx_backend import OnnxBackend  # Optional dependency (onnxruntime)
+    backend = OnnxBackend(**inference)
+    backend.use_detector(detector_backend)
+    _embedders[model_name] = backend.embedder(model_name)
+
+
+def init_worker(settings):
+    """
+    Initializer of the detection workers: keeps the settings and loads the model once per worker.
+
+    Args:
+        settings: A dictionary with "model_name", "detector_backend", "expand_percentage", "batch_size",
+                  "detection_max_side", "thumbnail_detection", "thumbnail_min_face", "quality_gate" (the
+                  arguments of check_face_quality, None: every face is embedded), "inference" (see
+                  use_inference_backend) and "tiling" (see detect_faces, None: no tiles).
+    """
+    _worker_settings.update(settings)
+    tiling = settings.get('tiling')
+    if tiling and not tiling.get('threads'):  # The tiles of a photo are detected by the cores of the worker
+        _worker_settings['tiling'] = dict(tiling, threads=settings.get('threads_per_worker') or os.cpu_count())
+    if settings.get('metrics'):  # Sent back to the main process with the results
+        metrics.enabled = True
+
+    # Share the CPU cores between the worker processes instead of every worker using all of them
+    threads = settings.get('threads_per_worker')
+    inference = settings.get('inference')
+    if inference:
+        if threads and not inference.get('intra_op_threads'):
+            inference = dict(inference, intra_op_threads=threads)
+        use_inference_backend(inference, settings['model_name'], settings['detector_backend'])
+    elif threads:
+        import tensorflow as tf
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(threads)
+            tf.config.threading.set_inter_op_parallelism_threads(1)
+        except RuntimeError as e:  # TensorFlow was already initialized
+            print(e)
+
+    get_face_embedder(settings['model_name'])
+
+
+def process_images(images):
+    """
+    Detects, crops and embeds the faces of a list of images (runs in a detection worker).
+    The faces of all the images are embedded together in batches.
+
+    Args:
+        images: A list of (source, img_path, file_bytes), source is given back with the result.
+
+    Returns:
+        (results, worker_metrics, rejected_faces), results is a list of (source, status, result) in the same
+        order as images:
+          ("faces", faces): the faces with their "crop" and "embedding" keys (the aligned face is removed).
+          ("no_face", None): no face could be detected in the image (or every face was rejected by the quality
+                             gate).
+          ("broken", error): the image is broken (FileNotFoundError, SyntaxError).
+          ("error", error): any other error.
+        worker_metrics are the stage times of the worker (metrics.drain(), None if the metrics are disabled).
+        rejected_faces is the number of faces rejected by the quality gate per reason, {reason: count}.
+    """
+    settings = _worker_settings
+    batcher = EmbeddingBatcher(get_face_embedder(settings['model_name']), settings['batch_size'],
+                               time_window=float('inf'))
+    quality_gate = settings.get('quality_gate')
+    tiling = settings.get('tiling')
+    results = []
+    rejected_faces = {}
+
+    for source, img_path, file_bytes in images:
+        try:
+            # Decode the image only once, the same image is used for detection (reduced copy) and cropping
+            with metrics.timer("decode"):
+                img = cv2.imdecode(np.frombuffer(file_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if img is None:
+                raise ValueError(f"Exception while loading {img_path}")
+
+            with metrics.timer("detect"):
+                faces = None
+                # Detect on the Eagle thumbnail first (not for the very large photos, their small faces are lost)
+                if settings.get('thumbnail_detection') and not needs_tiles(img, tiling):
+                    faces = detect_faces_on_thumbnail(img, get_thumbnail_path(img_path), settings['detector_backend'],
+                                                      settings['expand_percentage'], settings['thumbnail_min_face'])
+                if faces is None:
+                    faces = detect_faces(img, settings['detector_backend'], settings['expand_percentage'],
+                                         enforce_detection=True, max_side=settings.get('detection_max_side'),
+                                         tiling=tiling)
+
+            if quality_gate:  # The rejected faces are not embedded and not saved
+                with metrics.timer("quality"):
+                    good_faces = []
+                    for face in faces:
+                        reason = check_face_quality(img, face, **quality_gate)
+                        if reason is None:
+                            good_faces.append(face)
+                        else:
+                            rejected_faces[reason] = rejected_faces.get(reason, 0) + 1
+                faces = good_faces
+                if not faces:
+                    results.append((source, "no_face", None))
+                    continue
+
+            for face in faces:
+                # Crop the Face from original image (full resolution), expanded with expand_percentage
+                face['crop'] = crop_face(img, face['save_area'])
+            batcher.add(source, faces)
+            results.append((source, "faces", faces))
+
+        except (FileNotFoundError, SyntaxError) as e:
+            results.append((source, "broken", str(e)))
+        except Exception as e:  # Handel Errors
+            if "Face could not be detected" in str(e):  # Handel Face could not be detected
+                results.append((source, "no_face", None))
+            else:
+                results.append((source, "error", str(e)))
+
+    batcher.flush()
+    for source, status, faces in results:
+        if status == "faces":
+            for face in faces:
+                del face['face']  # Not needed anymore, don't send it back to the main process
+
+    return results, metrics.drain(), rejected_faces
+
+
+# ----------------------------------------------------------- I/O stages
+
+class ThreadStage:
+    """
+    A pipeline stage that runs a function in threads (for I/O work: Eagle API calls, file reads and writes).
+    The tasks and the results go through bounded queues, so a fast stage waits for a slow one (backpressure).
+    """
+
+    _stop = object()
+
+    def __init__(self, fn, num_threads=1, queue_size=32, keep_results=False, on_error=None):
+        """
+        Args:
+            fn: The function to run for every task, its return value is the result of the task.
+            num_threads: The number of threads.
+            queue_size: The max number of tasks (and results) waiting in the queues.
+            keep_results: If True, the results can be read with results(), else they are dropped.
+            on_error: Called with (task, exception) when fn fails, its return value is the result of the task, so
+                      the failed task goes to the next stage (None: the error is printed and the task is dropped).
+        """
+        self.fn = fn
+        self.on_error = on_error
+        self.feed_error = None  # The exception that stopped feed() (e.g. the tasks generator failed)
+        self.tasks = queue.Queue(maxsize=queue_size)
+        self.results_queue = queue.Queue(maxsize=queue_size) if keep_results else None
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(num_threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self):
+        while True:
+            task = self.tasks.get()
+            if task is self._stop:
+                break
+            try:
+                result = self.fn(task)
+            except Exception as e:  # Handel Errors, one task should not stop the stage
+                if self.on_error is None:
+                    print(f"Error in pipeline stage: {e}")
+                    continue
+                result = self.on_error(task, e)
+            if self.results_queue is not None:
+                self.results_queue.put(result)
+
+        if self.results_queue is not None:
+            self.results_queue.put(self._stop)
+
+    def put(self, task):
+        """
+        Adds a task, waits if the queue is full.
+        """
+        self.tasks.put(task)
+
+    def feed(self, tasks):
+        """
+        Adds all the tasks then closes the stage (run it in its own thread to not block the results).
+        tasks can be a generator, it is read only as fast as the stage runs the tasks. If the generator fails, its
+        exception is kept in feed_error.
+        """
+        try:
+            for task in tasks:
+                self.put(task)
+        except Exception as e:  # Kept for the caller, the tasks already added are still run
+            self.feed_error = e
+        finally:  # Even if the generator fails, else results() would wait forever
+            self.close()
+
+    def close(self):
+        """
+        No more tasks will be added: the threads stop after finishing the tasks in the queue.
+        """
+        for _ in self.threads:
+            self.tasks.put(self._stop)
+
+    def join(self):
+        """
+        Waits until all the tasks are done and the threads stopped.
+        """
+        for thread in self.threads:
+            thread.join()
+
+    def results(self, timeout=None):
+        """
+        Yields the results as they are ready, until all the threads stopped (after close() is called).
+
+        Args:
+            timeout: A function returning the max seconds to wait for the next result (None: no limit), None is
+                     yielded when no result came in time (e.g. to send the results waiting in a batch).
+        """
+        running = len(self.threads)
+        while running:
+            try:
+                result = self.results_queue.get(timeout=timeout() if timeout else None)
+            except queue.Empty:
+                yield None
+                continue
+            if result is self._stop:
+                running -= 1
+                continue
+            yield result
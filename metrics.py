@@ -0,0 +1,261 @@
+# Metrics of the Face Recognition runs: time of every stage (histograms) and counters.
+# Disabled by default, then every call does nothing (one attribute check). When enabled, a line of JSON with all
+# the metrics is added to a file every interval, and the metrics can also be written as a Prometheus text file
+# and/or served on a Prometheus endpoint (http://localhost:{port}/metrics).
+#
+# Usage:
+#   with metrics.timer("detect"):
+#       ...
+#   metrics.count("faces", len(faces))
+import bisect
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the histogram buckets in seconds (the last bucket is +Inf)
+buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _Timer:
+    __slots__ = ("metrics", "stage", "start")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+class Metrics:
+    """
+    Stage timers, counters and histograms, shared by all the threads of a process.
+    The detection workers (other processes) send their metrics back with drain() and merge().
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}  # {stage: [bucket counts..., sum, count]}
+        self.start_time = time.time()
+        self._jsonl_path = None
+        self._prometheus_path = None
+        self._interval = 60
+        self._stop = threading.Event()
+        self._thread = None
+        self._server = None
+
+    def enable(self, jsonl_path=None, interval=60, prometheus_path=None, prometheus_port=None,
+               prometheus_host="127.0.0.1"):
+        """
+        Starts recording the metrics.
+
+        Args:
+            jsonl_path: The file where a JSON line with all the metrics is added every interval (None: no file).
+            interval: Seconds between two writes of the metrics.
+            prometheus_path: The Prometheus text file rewritten every interval (None: no file).
+            prometheus_port: The port of the Prometheus endpoint (None: no endpoint).
+            prometheus_host: The address the endpoint listens on ("127.0.0.1": this computer only, "0.0.0.0": the
+                             whole network).
+        """
+        self.enabled = True
+        self.start_time = time.time()
+        self._jsonl_path = jsonl_path
+        self._prometheus_path = prometheus_path
+        self._interval = interval
+        if jsonl_path or prometheus_path:
+            self._thread = threading.Thread(target=self._write_periodically, daemon=True)
+            self._thread.start()
+        if prometheus_port:
+            self._server = ThreadingHTTPServer((prometheus_host, prometheus_port), _PrometheusHandler)
+            self._server.daemon_threads = True
+            self._server.metrics = self
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+            host, port = self._server.server_address[:2]
+            print(f"Metrics endpoint: http://{host}:{port}/metrics")
+
+    def close(self):
+        """
+        Writes the last metrics and stops the writer and the endpoint.
+        """
+        if not self.enabled:
+            return
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.write()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    # ----------------------------------------------------------- Recording
+
+    def timer(self, stage):
+        """
+        Returns a context manager that records the time of a stage.
+        """
+        if not self.enabled:
+            return _null_timer
+        return _Timer(self, stage)
+
+    def observe(self, stage, seconds):
+        """
+        Records one duration of a stage.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = [0] * (len(buckets) + 3)
+            histogram[bisect.bisect_left(buckets, seconds)] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    def count(self, name, value=1):
+        """
+        Adds value to a counter.
+        """
+        if not self.enabled or not value:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def drain(self):
+        """
+        Returns the metrics recorded since the last drain and resets them (used in the detection workers).
+        """
+        if not self.enabled:
+            return None
+        with self.lock:
+            drained = {"counters": self.counters, "histograms": self.histograms}
+            self.counters, self.histograms = {}, {}
+        return drained
+
+    def merge(self, drained):
+        """
+        Adds the metrics from drain() of a detection worker.
+        """
+        if not self.enabled or not drained:
+            return
+        with self.lock:
+            for name, value in drained["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for stage, values in drained["histograms"].items():
+                histogram = self.histograms.setdefault(stage, [0] * (len(buckets) + 3))
+                for num, value in enumerate(values):
+                    histogram[num] += value
+
+    # ----------------------------------------------------------- Export
+
+    @staticmethod
+    def _quantile(histogram, quantile):
+        """
+        Estimates a quantile from the histogram buckets (the upper bound of the bucket, in ms).
+        """
+        total = histogram[-1]
+        rank = quantile * total
+        seen = 0
+        for num, bucket_count in enumerate(histogram[:len(buckets) + 1]):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return round(buckets[num] * 1000, 1) if num < len(buckets) else None
+        return None
+
+    def snapshot(self):
+        """
+        Returns all the metrics as a dictionary (for the JSON lines).
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {stage: list(values) for stage, values in self.histograms.items()}
+        stages = {}
+        for stage, histogram in histograms.items():
+            total_time, count = histogram[-2], histogram[-1]
+            stages[stage] = {"count": count, "total_s": round(total_time, 3),
+                             "mean_ms": round(total_time / count * 1000, 2) if count else None,
+                             "p50_ms": self._quantile(histogram, 0.5), "p95_ms": self._quantile(histogram, 0.95),
+                             "p99_ms": self._quantile(histogram, 0.99)}
+        return {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "uptime_s": round(time.time() - self.start_time, 1),
+                "counters": counters, "stages": stages}
+
+    def prometheus_text(self):
+        """
+        Returns all the metrics in the Prometheus text format.
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {stage: list(values) for stage, values in self.histograms.items()}
+
+        lines = []
+        for name, value in sorted(counters.items()):
+            lines.append(f"# TYPE facereco_{name}_total counter")
+            lines.append(f"facereco_{name}_total {value}")
+        lines.append("# TYPE facereco_stage_seconds histogram")
+        for stage, histogram in sorted(histograms.items()):
+            cumulative = 0
+            for num, bucket in enumerate(buckets + ("+Inf",)):
+                cumulative += histogram[num]
+                lines.append(f'facereco_stage_seconds_bucket{{stage="{stage}",le="{bucket}"}} {cumulative}')
+            lines.append(f'facereco_stage_seconds_sum{{stage="{stage}"}} {histogram[-2]}')
+            lines.append(f'facereco_stage_seconds_count{{stage="{stage}"}} {histogram[-1]}')
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """
+        Adds a JSON line to the metrics file and rewrites the Prometheus text file.
+        """
+        if self._jsonl_path:
+            with open(self._jsonl_path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(self.snapshot()) + "\n")
+        if self._prometheus_path:
+            with open(self._prometheus_path + ".tmp", "w", encoding="utf-8") as file:
+                file.write(self.prometheus_text())
+            os.replace(self._prometheus_path + ".tmp", self._prometheus_path)
+
+    def _write_periodically(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self.write()
+            except OSError as e:  # Handel Errors, the metrics should not stop the run
+                print(f"Couldn't write the metrics: {e}")
+
+
+class _PrometheusHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):  # Don't print every request
+        pass
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = self.server.metrics.prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# The metrics of the process (disabled until metrics.enable() is called)
+metrics = Metrics()
@@ -0,0 +1,216 @@
+# Local stand-in for the Eagle API, to run the scripts and the EagleClient without Eagle.
+# It serves the endpoints used by the scripts from an in-memory library, and can add latency and failures
+# to check the timeouts and retries.
+#
+# Run it alone:  python mock_eagle_server.py  (then set BASE_API_URL = "http://localhost:41596")
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+
+
+class MockEagleLibrary:
+    """
+    In-memory Eagle library: folders and items (each item has id, name, ext, tags and folders).
+    """
+
+    def __init__(self, library_path=".", offset_is_page=True):
+        """
+        Args:
+            library_path: The path of the library folder (the images are in {library_path}\\images\\{id}.info).
+            offset_is_page: True if "offset" of /api/item/list is the page number (same as Eagle).
+        """
+        self.library_path = library_path
+        self.offset_is_page = offset_is_page
+        self.folders = []
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def add_folder(self, name, folder_id=None):
+        folder = {"id": folder_id or f"F{len(self.folders):012d}", "name": name, "children": []}
+        self.folders.append(folder)
+        return folder["id"]
+
+    def add_item(self, name, ext, folder_id, tags=None, item_id=None, size=None, width=None, height=None):
+        item_id = item_id or f"I{len(self.items):012d}"
+        now = int(time.time() * 1000)
+        self.items[item_id] = {"id": item_id, "name": name, "ext": ext, "tags": list(tags or []),
+                               "folders": [folder_id], "annotation": "", "btime": now, "modificationTime": now,
+                               "size": size, "width": width, "height": height}
+        return item_id
+
+    def item_folder(self, item_id):
+        """
+        Returns the folder of the item files (same layout as Eagle: images\\{id}.info).
+        """
+        return f"{self.library_path}/images/{item_id}.info"
+
+    def list_items(self, limit, offset, folder_id=None, order_by=None):
+        with self.lock:
+            items = [item for item in self.items.values() if not folder_id or folder_id in item["folders"]]
+        if order_by and order_by.lstrip("-") == "CREATEDATE":  # Only the creation date order is supported
+            items.sort(key=lambda item: item.get("btime", 0), reverse=order_by.startswith("-"))
+        start = offset * limit if self.offset_is_page else offset
+        return items[start:start + limit]
+
+
+class MockEagleHandler(BaseHTTPRequestHandler):
+    server_version = "MockEagle/1.0"
+
+    def log_message(self, format, *args):  # Don't print every request
+        pass
+
+    def _send(self, data, status=200):
+        body = json.dumps({"status": "success" if status == 200 else "error", "data": data}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        server = self.server
+        with server.calls_lock:
+            server.durations.setdefault(self._endpoint, []).append(time.perf_counter() - self._start)
+
+    def _before_request(self, endpoint):
+        """
+        Counts the call, adds the latency and returns True if the call should fail.
+        """
+        server = self.server
+        self._endpoint, self._start = endpoint, time.perf_counter()
+        with server.calls_lock:
+            server.calls[endpoint] = server.calls.get(endpoint, 0) + 1
+        if server.latency:
+            time.sleep(server.latency)
+        if server.failure_rate and random.random() < server.failure_rate:
+            self._send(None, status=503)
+            return True
+        return False
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        library = self.server.library
+        if self._before_request(url.path):
+            return
+
+        if url.path == "/api/folder/list":
+            self._send(library.folders)
+
+        elif url.path == "/api/item/list":
+            self._send(library.list_items(int(query.get("limit", 200)), int(query.get("offset", 0)),
+                                          query.get("folders"), query.get("orderBy")))
+
+        elif url.path in ("/api/item/info", "/api/item/thumbnail"):
+            item = library.items.get(query.get("id"))
+            if item is None:
+                self._send(None, status=404)
+            elif url.path == "/api/item/info":
+                self._send(item)
+            else:
+                self._send(quote(f"{library.item_folder(item['id'])}/{item['name']}_thumbnail.png"))
+
+        elif url.path == "/api/library/info":
+            self._send({"library": {"path": library.library_path, "name": "Mock Library"}})
+
+        else:
+            self._send(None, status=404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        library = self.server.library
+        if self._before_request(url.path):
+            return
+
+        if url.path == "/api/item/update":
+            with library.lock:
+                item = library.items.get(body.get("id"))
+                if item is None:
+                    self._send(None, status=404)
+                    return
+                for key, value in body.items():
+                    if key != "id":
+                        item[key] = value
+                item["modificationTime"] = int(time.time() * 1000)
+            self._send(item)
+        else:
+            self._send(None, status=404)
+
+
+class MockEagleServer:
+    """
+    Runs the mock Eagle API in a background thread.
+
+    Example:
+        server = MockEagleServer(library).start()
+        client = EagleClient(server.url)
+        ...
+        server.stop()
+    """
+
+    def __init__(self, library, host="127.0.0.1", port=0, latency=0.0, failure_rate=0.0):
+        """
+        Args:
+            library: The MockEagleLibrary to serve.
+            host: The host to listen on.
+            port: The port to listen on (0: any free port).
+            latency: Seconds added to every call.
+            failure_rate: Part of the calls (0 to 1) that fail with status 503.
+        """
+        self.httpd = ThreadingHTTPServer((host, port), MockEagleHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.library = library
+        self.httpd.latency = latency
+        self.httpd.failure_rate = failure_rate
+        self.httpd.calls = {}
+        self.httpd.durations = {}
+        self.httpd.calls_lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def calls(self):
+        """
+        Number of calls per endpoint.
+        """
+        return dict(self.httpd.calls)
+
+    @property
+    def durations(self):
+        """
+        Time in seconds of every answered call per endpoint (measured in the server, with the added latency).
+        """
+        with self.httpd.calls_lock:
+            return {endpoint: list(durations) for endpoint, durations in self.httpd.durations.items()}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == "__main__":
+    mock_library = MockEagleLibrary()
+    mock_folder_id = mock_library.add_folder("FaceReco_Process")
+    for num in range(450):
+        mock_library.add_item(f"photo ({num})", "jpg", mock_folder_id)
+
+    mock_server = MockEagleServer(mock_library, port=41596).start()
+    print(f"Mock Eagle API running on {mock_server.url} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        mock_server.stop()
@@ -0,0 +1,345 @@
+# ONNX Runtime inference backend for the CPU: the embedding model (e.g. Facenet512) and the nets of the detector
+# (fastmtcnn) are exported once to ONNX files and run with ONNX Runtime instead of TensorFlow/PyTorch, with a set
+# number of threads per call and optionally an int8 embedding model. The steps around the models (detection
+# cascade, alignment, preprocessing) are still the ones of DeepFace, so the faces and embeddings stay the same
+# within a small tolerance.
+#
+# Equivalence report (compare the faces, embeddings and match decisions with DeepFace on the images of my_db):
+#   python onnx_backend.py --model Facenet512 --detector fastmtcnn --quantize
+#
+# Needs onnxruntime (pip install onnxruntime), and to export the models tf2onnx and onnx
+# (pip install tf2onnx onnx), the exported models are kept in the ONNX folder.
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from face_pipeline import FaceEmbedder
+
+# Detectors whose nets can be run with ONNX Runtime (the others are run by DeepFace)
+onnx_detectors = ("fastmtcnn",)
+
+
+def _deepface_detector(detector_backend):
+    """
+    Returns the detector object cached by DeepFace (the one used by DeepFace.extract_faces).
+    """
+    try:  # deepface >= 0.0.93
+        from deepface.modules import modeling
+        return modeling.build_model(task="face_detector", model_name=detector_backend)
+    except TypeError:
+        from deepface.detectors import DetectorWrapper
+        return DetectorWrapper.build_model(detector_backend)
+
+
+def export_embedding_model(model_name, model_path):
+    """
+    Exports the Keras model of DeepFace to an ONNX file (with any batch size).
+    """
+    import tensorflow as tf
+    import tf2onnx
+    from deepface import DeepFace
+
+    keras_model = getattr(DeepFace.build_model(model_name), 'model', None)
+    if not hasattr(keras_model, 'input_shape'):
+        raise ValueError(f"{model_name} is not a Keras model, it can't be exported to ONNX")
+    input_signature = (tf.TensorSpec((None,) + tuple(keras_model.input_shape[1:]), tf.float32, name="input"),)
+    tf2onnx.convert.from_keras(keras_model, input_signature=input_signature, opset=13,
+                               output_path=model_path + ".tmp")
+    os.replace(model_path + ".tmp", model_path)
+    print(f"{model_name} exported to '{model_path}'.")
+
+
+def quantize_model(model_path, quantized_path):
+    """
+    Saves an int8 copy of an ONNX model (dynamic quantization of the weights).
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(model_path, quantized_path + ".tmp", weight_type=QuantType.QInt8)
+    os.replace(quantized_path + ".tmp", quantized_path)
+    print(f"Int8 model saved to '{quantized_path}'.")
+
+
+def export_mtcnn_nets(mtcnn, folder, prefix):
+    """
+    Exports the P-Net, R-Net and O-Net of a facenet-pytorch MTCNN to ONNX files (P-Net with any image size).
+    """
+    import torch
+
+    nets = {"pnet": (mtcnn.pnet, (1, 3, 48, 48), {0: "batch", 2: "height", 3: "width"}),
+            "rnet": (mtcnn.rnet, (1, 3, 24, 24), {0: "batch"}),
+            "onet": (mtcnn.onet, (1, 3, 48, 48), {0: "batch"})}
+    for name, (net, input_shape, input_axes) in nets.items():
+        model_path = os.path.join(folder, f"{prefix}_{name}.onnx")
+        if os.path.exists(model_path):
+            continue
+        net = net.to("cpu").eval()
+        with torch.no_grad():
+            outputs = net(torch.zeros(input_shape))
+        output_names = [f"output{num}" for num in range(len(outputs))]
+        output_axes = {output_name: ({0: "batch", 2: "height", 3: "width"} if name == "pnet" else {0: "batch"})
+                       for output_name in output_names}
+        torch.onnx.export(net, torch.zeros(input_shape), model_path + ".tmp", input_names=["input"],
+                          output_names=output_names, dynamic_axes=dict(output_axes, input=input_axes), opset_version=13)
+        os.replace(model_path + ".tmp", model_path)
+        print(f"{prefix} {name} exported to '{model_path}'.")
+
+
+class OnnxFaceEmbedder(FaceEmbedder):
+    """
+    FaceEmbedder that runs the exported embedding model with ONNX Runtime (same preprocessing as DeepFace).
+    """
+
+    def __init__(self, model_name, session, normalization="base"):
+        """
+        Args:
+            model_name: The name of the model (e.g. "Facenet512").
+            session: The onnxruntime.InferenceSession of the exported model.
+            normalization: The normalization of the model input (same as DeepFace.represent).
+        """
+        self.model_name = model_name
+        self.normalization = normalization
+        self.session = session
+        self._input_name = session.get_inputs()[0].name
+        height, width = session.get_inputs()[0].shape[1:3]
+        self.input_shape = (width, height)  # Same order as the DeepFace models
+
+    def embed(self, face):
+        return self.embed_batch([face])[0]
+
+    def embed_batch(self, faces):
+        if not faces:
+            return []
+        batch = np.concatenate([self.preprocess(face) for face in faces], axis=0).astype(np.float32)
+        return self.session.run(None, {self._input_name: batch})[0].tolist()
+
+
+class OnnxBackend:
+    """
+    Exports the models to ONNX (once, in the ONNX folder) and runs them with ONNX Runtime.
+    """
+
+    def __init__(self, folder, quantize=False, intra_op_threads=None, inter_op_threads=1):
+        """
+        Args:
+            folder: The folder of the exported models.
+            quantize: True to use the int8 embedding model (the detector nets are small and stay float32).
+            intra_op_threads: Threads used inside one model call (None: ONNX Runtime default, all the cores).
+            inter_op_threads: Threads running independent parts of the model at the same time.
+        """
+        import onnxruntime as ort  # Optional dependency, only needed with the "onnx" inference backend
+
+        self.folder = folder
+        self.quantize = quantize
+        self.options = ort.SessionOptions()
+        self.options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        if intra_op_threads:
+            self.options.intra_op_num_threads = intra_op_threads
+        if inter_op_threads:
+            self.options.inter_op_num_threads = inter_op_threads
+        os.makedirs(folder, exist_ok=True)
+
+    def session(self, model_path):
+        import onnxruntime as ort
+
+        return ort.InferenceSession(model_path, sess_options=self.options, providers=["CPUExecutionProvider"])
+
+    def embedder(self, model_name):
+        """
+        Returns the OnnxFaceEmbedder of a model (exported and quantized on the first use).
+        """
+        model_path = os.path.join(self.folder, f"{model_name}.onnx")
+        if not os.path.exists(model_path):
+            export_embedding_model(model_name, model_path)
+        if self.quantize:
+            quantized_path = os.path.join(self.folder, f"{model_name}.int8.onnx")
+            if not os.path.exists(quantized_path):
+                quantize_model(model_path, quantized_path)
+            model_path = quantized_path
+        return OnnxFaceEmbedder(model_name, self.session(model_path))
+
+    def use_detector(self, detector_backend):
+        """
+        Runs the nets of the DeepFace detector with ONNX Runtime (exported on the first use).
+
+        Returns:
+            True if the detector runs with ONNX Runtime, False if it is not supported (it is run by DeepFace).
+        """
+        if detector_backend not in onnx_detectors:
+            print(f"Detector {detector_backend} can't run with ONNX Runtime, it is run by DeepFace.")
+            return False
+
+        import torch
+
+        class OnnxNet(torch.nn.Module):  # Replaces a net of the MTCNN (same inputs and outputs)
+            def __init__(self, session):
+                super().__init__()
+                self.session = session
+                self.input_name = session.get_inputs()[0].name
+
+            def forward(self, x):
+                outputs = self.session.run(None, {self.input_name: x.detach().cpu().numpy().astype(np.float32)})
+                return tuple(torch.from_numpy(output).to(x.device) for output in outputs)
+
+        mtcnn = _deepface_detector(detector_backend).model
+        export_mtcnn_nets(mtcnn, self.folder, detector_backend)
+        for name in ("pnet", "rnet", "onet"):
+            setattr(mtcnn, name, OnnxNet(self.session(os.path.join(self.folder, f"{detector_backend}_{name}.onnx"))))
+        return True
+
+
+def _identity(image_path):
+    return os.path.basename(os.path.dirname(image_path))
+
+
+def _run_backend(image_paths, detector_backend, embedder):
+    """
+    Detects and embeds the biggest face of every image (the images of the Database are cropped faces).
+
+    Returns:
+        (facial areas, embeddings, detection seconds, embedding seconds), None for the images with no face.
+    """
+    from face_pipeline import detect_faces
+
+    areas, embeddings = [], []
+    detect_time = embed_time = 0.0
+    for image_path in image_paths:
+        start = time.perf_counter()
+        faces = detect_faces(image_path, detector_backend, 0, enforce_detection=False)
+        detect_time += time.perf_counter() - start
+        if not faces:
+            areas.append(None)
+            embeddings.append(None)
+            continue
+        face = max(faces, key=lambda found: found['facial_area']['w'] * found['facial_area']['h'])
+        start = time.perf_counter()
+        embeddings.append(np.asarray(embedder.embed(face['face']), dtype=np.float32))
+        embed_time += time.perf_counter() - start
+        areas.append(face['facial_area'])
+    return areas, embeddings, detect_time, embed_time
+
+
+def _iou(area, other_area):
+    left, top = max(area['x'], other_area['x']), max(area['y'], other_area['y'])
+    right = min(area['x'] + area['w'], other_area['x'] + other_area['w'])
+    bottom = min(area['y'] + area['h'], other_area['y'] + other_area['h'])
+    intersection = max(0, right - left) * max(0, bottom - top)
+    union = area['w'] * area['h'] + other_area['w'] * other_area['h'] - intersection
+    return intersection / union if union else 1.0
+
+
+def _decisions(embeddings, identities, distance_metric, threshold):
+    """
+    Matches every face with the other faces (leave one out): the identity of the nearest face, or None.
+    """
+    from face_index import find_distances
+
+    matrix = np.stack(embeddings)
+    norms = np.linalg.norm(matrix, axis=1)
+    decisions = []
+    for row in range(len(matrix)):
+        distances = find_distances(matrix, norms, matrix[row], distance_metric)
+        distances[row] = np.inf
+        nearest = int(np.argmin(distances)) if len(matrix) > 1 else row
+        decisions.append(identities[nearest] if distances[nearest] <= threshold else None)
+    return decisions
+
+
+def equivalence_report(image_paths, model_name, detector_backend, backend, distance_metric, threshold,
+                       tolerance=0.02):
+    """
+    Compares the ONNX Runtime backend with DeepFace on the same images.
+
+    Args:
+        image_paths: The images to compare on (e.g. the images of my_db).
+        model_name: The embedding model.
+        detector_backend: The detector backend.
+        backend: The OnnxBackend.
+        distance_metric: The metric of the face distances.
+        threshold: The match threshold of the model and metric.
+        tolerance: The max distance allowed between the embeddings of the same face from both backends.
+
+    Returns:
+        A dictionary with the detection agreement (same number of faces, IoU of the facial areas), the distance
+        between the embeddings of both backends, the agreement of the match decisions and the faces/sec of both.
+    """
+    from face_index import find_distances
+
+    # DeepFace first, the detector nets are replaced by the ONNX ones after
+    reference = _run_backend(image_paths, detector_backend, FaceEmbedder(model_name))
+    backend.use_detector(detector_backend)
+    onnx = _run_backend(image_paths, detector_backend, backend.embedder(model_name))
+
+    both = [num for num in range(len(image_paths)) if reference[1][num] is not None and onnx[1][num] is not None]
+    ious = [_iou(reference[0][num], onnx[0][num]) for num in both]
+    embedding_distances = [float(find_distances(reference[1][num][None], np.linalg.norm(reference[1][num])[None],
+                                                onnx[1][num], distance_metric)[0]) for num in both]
+    identities = [_identity(image_paths[num]) for num in both]
+    reference_decisions = _decisions([reference[1][num] for num in both], identities, distance_metric, threshold)
+    onnx_decisions = _decisions([onnx[1][num] for num in both], identities, distance_metric, threshold)
+    same_decision = sum(a == b for a, b in zip(reference_decisions, onnx_decisions))
+
+    faces = max(1, len(both))
+    reference_time, onnx_time = reference[2] + reference[3], onnx[2] + onnx[3]
+    max_distance = max(embedding_distances, default=0.0)
+    return {
+        "images": len(image_paths),
+        "model_name": model_name,
+        "detector_backend": detector_backend,
+        "quantized": backend.quantize,
+        "distance_metric": distance_metric,
+        "threshold": threshold,
+        "faces_found_deepface": sum(embedding is not None for embedding in reference[1]),
+        "faces_found_onnx": sum(embedding is not None for embedding in onnx[1]),
+        "mean_facial_area_iou": round(float(np.mean(ious)), 4) if ious else None,
+        "min_facial_area_iou": round(float(np.min(ious)), 4) if ious else None,
+        "mean_embedding_distance": round(float(np.mean(embedding_distances)), 6) if both else None,
+        "max_embedding_distance": round(max_distance, 6),
+        "tolerance": tolerance,
+        "within_tolerance": max_distance <= tolerance,
+        "decision_agreement": round(same_decision / faces, 4),
+        "deepface_faces_per_sec": round(len(both) / reference_time, 2) if reference_time else None,
+        "onnx_faces_per_sec": round(len(both) / onnx_time, 2) if onnx_time else None,
+        "deepface_detect_ms": round(reference[2] / faces * 1000, 2),
+        "onnx_detect_ms": round(onnx[2] / faces * 1000, 2),
+        "deepface_embed_ms": round(reference[3] / faces * 1000, 2),
+        "onnx_embed_ms": round(onnx[3] / faces * 1000, 2),
+        "speedup": round(reference_time / onnx_time, 2) if onnx_time else None,
+    }
+
+
+if __name__ == "__main__":
+    from deepface.modules.verification import find_threshold
+    from face_index import image_extensions
+
+    parser = argparse.ArgumentParser(description="Faces, embeddings and match decisions of the ONNX Runtime "
+                                                 "backend compared to DeepFace.")
+    parser.add_argument("--db-path", default=os.path.join(".", "my_db"))
+    parser.add_argument("--onnx-folder", default=os.path.join(".", "onnx_models"))
+    parser.add_argument("--model", default="Facenet512")
+    parser.add_argument("--detector", default="fastmtcnn")
+    parser.add_argument("--metric", default="cosine")
+    parser.add_argument("--threshold", type=float, default=None)
+    parser.add_argument("--quantize", action="store_true", help="Use the int8 embedding model")
+    parser.add_argument("--threads", type=int, default=None, help="Intra-op threads (None: all the cores)")
+    parser.add_argument("--tolerance", type=float, default=0.02)
+    parser.add_argument("--samples", type=int, default=500)
+    parser.add_argument("--output", default=None, help="Save the report to a JSON file")
+    args = parser.parse_args()
+
+    paths = sorted(os.path.join(root, filename) for root, dirs, files in os.walk(args.db_path)
+                   for filename in files if filename.lower().endswith(image_extensions))[:args.samples]
+    if not paths:
+        raise SystemExit(f"No images in '{args.db_path}'.")
+    report = equivalence_report(paths, args.model, args.detector,
+                                OnnxBackend(args.onnx_folder, quantize=args.quantize, intra_op_threads=args.threads),
+                                args.metric, args.threshold or find_threshold(args.model, args.metric),
+                                args.tolerance)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
@@ -0,0 +1,175 @@
+# Prototype matching for the face index: every person folder of the Database is represented by a few
+# prototypes, the average face (centroid) and the most typical faces (medoids) of the folder, and a face is
+# matched with the nearest prototype instead of the nearest face image.
+# The number of compared faces depends on the number of persons, not on the number of face images per person.
+import os
+
+import numpy as np
+
+from ann_index import normalize_rows
+from face_index import find_distances
+
+
+def select_medoids(vectors, num_medoids, iterations=5):
+    """
+    Selects the most typical faces of a person: the faces are grouped in num_medoids clusters (k-means) and the
+    face nearest to the center of every cluster is kept.
+
+    Args:
+        vectors: The embeddings of the faces of the person.
+        num_medoids: The number of faces to keep.
+        iterations: The number of k-means iterations.
+
+    Returns:
+        The indexes of the selected faces in vectors, the face nearest to the average face first.
+    """
+    normalized = normalize_rows(vectors)
+    mean = normalize_rows(normalized.mean(axis=0, keepdims=True))[0]
+    by_centrality = np.argsort(-(normalized @ mean))
+    if len(vectors) <= num_medoids:
+        return [int(num) for num in by_centrality]
+
+    # Start from the most central face and the faces the most different from the chosen ones
+    centers = [normalized[by_centrality[0]]]
+    for _ in range(num_medoids - 1):
+        nearest_similarity = np.max(normalized @ np.array(centers).T, axis=1)
+        centers.append(normalized[int(np.argmin(nearest_similarity))])
+    centers = np.array(centers)
+
+    for _ in range(iterations):
+        assignments = np.argmax(normalized @ centers.T, axis=1)
+        for num in range(num_medoids):
+            members = normalized[assignments == num]
+            if len(members):
+                centers[num] = normalize_rows(members.mean(axis=0, keepdims=True))[0]
+
+    medoids = []
+    similarities = normalized @ centers.T
+    assignments = np.argmax(similarities, axis=1)
+    for num in range(num_medoids):
+        members = np.flatnonzero(assignments == num)
+        if len(members):
+            medoids.append(int(members[np.argmax(similarities[members, num])]))
+    return sorted(set(medoids), key=lambda medoid: -float(normalized[medoid] @ mean))
+
+
+class PrototypeIndex:
+    """
+    Prototypes of every person folder of a FaceIndex (centroid + num_medoids medoids), updated when a face is
+    added to the index. Every person has a fixed block of rows in the prototype matrix.
+    """
+
+    def __init__(self, face_index, num_medoids=3, refresh_growth=1.25, max_samples=300, seed=0):
+        """
+        Args:
+            face_index: The FaceIndex of the Database.
+            num_medoids: The number of typical faces kept per person (plus the average face).
+            refresh_growth: The medoids of a person are selected again when the person has this many times more
+                            faces than at the last selection (the average face is updated with every face).
+            max_samples: Max number of faces of a person used to select the medoids.
+            seed: The random seed of the faces sampling.
+        """
+        self.face_index = face_index
+        self.num_medoids = num_medoids
+        self.refresh_growth = refresh_growth
+        self.max_samples = max_samples
+        self.rng = np.random.default_rng(seed)
+
+        self.identities = {}  # {person folder: {"block", "rows", "sum", "medoids", "medoids_size"}}
+        self._vectors = None
+        self._norms = None
+        self._rows = []  # Face index row of the image of every prototype
+
+    @property
+    def block_size(self):
+        return self.num_medoids + 1
+
+    def build(self):
+        """
+        Calculates the prototypes of all the persons of the face index.
+        """
+        self.identities = {}
+        self._vectors = np.zeros((0, self.face_index.dimensions or 0), dtype=np.float32)
+        self._norms = np.zeros(0, dtype=np.float32)
+        self._rows = []
+
+        folders = {}
+        for row, entry in enumerate(self.face_index.entries):
+            folders.setdefault(os.path.dirname(entry["path"]), []).append(row)
+        for folder, rows in folders.items():
+            identity = self._new_identity(folder)
+            identity["rows"] = rows
+            identity["sum"] = np.asarray(self.face_index._matrix[rows], dtype=np.float64).sum(axis=0)
+            self._update_medoids(identity)
+            self._write_block(identity)
+        print(f"Face prototypes: {len(self.identities)} persons, {len(self._rows)} prototypes.")
+
+    def _new_identity(self, folder):
+        block = len(self.identities)
+        identity = {"block": block, "rows": [], "sum": None, "medoids": [], "medoids_size": 0}
+        self.identities[folder] = identity
+
+        needed = (block + 1) * self.block_size
+        if len(self._vectors) < needed:  # Grow the prototype matrix (doubled to keep adding cheap)
+            capacity = max(needed, 2 * len(self._vectors))
+            vectors = np.zeros((capacity, self.face_index.dimensions), dtype=np.float32)
+            if len(self._vectors):
+                vectors[:len(self._vectors)] = self._vectors
+            norms = np.zeros(capacity, dtype=np.float32)
+            norms[:len(self._norms)] = self._norms
+            self._vectors, self._norms = vectors, norms
+        self._rows.extend([None] * self.block_size)
+        return identity
+
+    def _update_medoids(self, identity):
+        rows = identity["rows"]
+        if len(rows) > self.max_samples:
+            rows = sorted(self.rng.choice(rows, self.max_samples, replace=False))
+        medoids = select_medoids(self.face_index._matrix[rows], self.num_medoids)
+        identity["medoids"] = [int(rows[medoid]) for medoid in medoids]
+        identity["medoids_size"] = len(identity["rows"])
+
+    def _write_block(self, identity):
+        """
+        Writes the prototypes of a person in its block: the average face then the medoids (the first medoid is
+        repeated when the person has less faces than num_medoids).
+        """
+        start = identity["block"] * self.block_size
+        medoids = identity["medoids"] + [identity["medoids"][0]] * (self.num_medoids - len(identity["medoids"]))
+        vectors = np.vstack([identity["sum"] / len(identity["rows"]), self.face_index._matrix[medoids]])
+
+        self._vectors[start:start + self.block_size] = vectors
+        self._norms[start:start + self.block_size] = np.linalg.norm(vectors, axis=1)
+        # The average face has no image, the image of the most typical face is used for it
+        self._rows[start:start + self.block_size] = [medoids[0]] + medoids
+
+    def add(self, row):
+        """
+        Updates the prototypes of the person of a face added to the face index.
+        """
+        folder = os.path.dirname(self.face_index.entries[row]["path"])
+        vector = np.asarray(self.face_index._matrix[row], dtype=np.float64)
+        identity = self.identities.get(folder) or self._new_identity(folder)
+
+        identity["rows"].append(row)
+        identity["sum"] = vector.copy() if identity["sum"] is None else identity["sum"] + vector
+        if not identity["medoids"] or len(identity["rows"]) >= identity["medoids_size"] * self.refresh_growth:
+            self._update_medoids(identity)
+        self._write_block(identity)
+
+    def find_nearest(self, embedding, distance_metric, threshold):
+        """
+        Finds the nearest prototype (same result format and threshold as FaceIndex.find_nearest).
+        """
+        count = len(self._rows)
+        if count == 0:
+            return None
+
+        distances = find_distances(self._vectors[:count], self._norms[:count], embedding, distance_metric)
+        prototype = int(np.argmin(distances))
+        if distances[prototype] > threshold:
+            return None
+
+        entry = self.face_index.entries[self._rows[prototype]]
+        return {"identity": entry["identity"], "path": os.path.join(self.face_index.db_path, entry["path"]),
+                "new_face": entry["new_face"], "distance": float(distances[prototype])}
@@ -0,0 +1,129 @@
+# Offline re-match of the faces of the processed items after the Database changed (e.g. a "New Face" folder was
+# renamed to the name of the person, or two person folders were merged), without detecting and embedding again.
+# The journal keeps the embedding and the match of every face of every item, and only the faces the change can
+# affect are searched again:
+#   - the faces matched with a folder that changed or was removed are searched again in the whole face index,
+#   - the other faces are only compared with the faces of the changed folders (one matrix product per chunk).
+# A snapshot of the folders (a digest of their images) is saved in the journal after every re-match, the first
+# re-match searches all the faces again.
+import hashlib
+import os
+
+import numpy as np
+
+
+def folder_key(face_index, identity, new_face):
+    """
+    Returns the key of a person or "New Face" folder (a person can have the same name as a "New Face" folder).
+    """
+    return os.path.join(face_index.new_faces_folder_name, identity) if new_face else identity
+
+
+def database_snapshot(face_index):
+    """
+    Returns the digest of every folder of the face index (changes when an image is added, removed or changed)
+    and the rows of the face index of every folder.
+
+    Returns:
+        ({folder key: digest}, {folder key: list of rows})
+    """
+    folder_images, folder_rows = {}, {}
+    for row, entry in enumerate(face_index.entries):
+        key = folder_key(face_index, entry["identity"], entry["new_face"])
+        folder_images.setdefault(key, []).append(f"{entry['path']}|{entry.get('size')}|{entry.get('mtime')}")
+        folder_rows.setdefault(key, []).append(row)
+    snapshot = {key: hashlib.sha1("\n".join(sorted(images)).encode("utf-8")).hexdigest()[:16]
+                for key, images in folder_images.items()}
+    return snapshot, folder_rows
+
+
+def distance_matrix(queries, matrix, distance_metric):
+    """
+    Calculates the distance between every query embedding and every row of the matrix.
+
+    Args:
+        queries: The (n, dimensions) embeddings to search for.
+        matrix: The (k, dimensions) embeddings to compare with.
+        distance_metric: "cosine", "euclidean" or "euclidean_l2" (same as face_index.find_distances).
+
+    Returns:
+        A (n, k) numpy array of distances.
+    """
+    queries = np.asarray(queries, dtype=np.float32)
+    matrix = np.asarray(matrix, dtype=np.float32)
+    query_norms = np.linalg.norm(queries, axis=1)
+    norms = np.linalg.norm(matrix, axis=1)
+    dot_products = queries @ matrix.T
+
+    if distance_metric == "cosine":
+        return 1 - dot_products / np.maximum(query_norms[:, None] * norms[None, :], 1e-12)
+
+    elif distance_metric == "euclidean":
+        squared = query_norms[:, None] ** 2 - 2 * dot_products + norms[None, :] ** 2
+        return np.sqrt(np.maximum(squared, 0))
+
+    elif distance_metric == "euclidean_l2":
+        cosine_similarity = dot_products / np.maximum(query_norms[:, None] * norms[None, :], 1e-12)
+        return np.sqrt(np.maximum(2 - 2 * cosine_similarity, 0))
+
+    raise ValueError(f"Invalid distance metric: {distance_metric}")
+
+
+def rematch_faces(face_index, records, embeddings, old_snapshot, distance_metric, threshold, chunk_size=4096):
+    """
+    Searches again the faces of the processed items that a change of the Database can affect.
+
+    Args:
+        face_index: The FaceIndex of the Database (synced with the Database folder).
+        records: The matches from the journal (RunJournal.get_matches), dictionaries with "identity", "new_face"
+                 and "distance" (identity None: the face had no match).
+        embeddings: The (n, dimensions) embeddings of the records.
+        old_snapshot: The snapshot of the last re-match ({}: every face is searched again).
+        distance_metric: The distance metric to use.
+        threshold: Faces with a distance bigger than the threshold are not a match.
+        chunk_size: Number of faces (and of faces of the changed folders) compared at once, the temporary distance
+                    matrix has at most chunk_size x chunk_size values.
+
+    Returns:
+        (updates, snapshot): updates is a dictionary {record number: new match} of the faces searched again, the
+        new match is a dictionary with "identity", "new_face" and "distance" (identity None: no match).
+        snapshot is the snapshot of the Database to save for the next re-match.
+    """
+    snapshot, folder_rows = database_snapshot(face_index)
+    changed_folders = {key for key, digest in snapshot.items() if old_snapshot.get(key) != digest}
+    changed_rows = np.array(sorted(row for key in changed_folders for row in folder_rows[key]), dtype=np.int64)
+
+    # The faces matched with a changed or removed folder are searched again in the whole face index
+    searched = set()
+    for num, record in enumerate(records):
+        if record["identity"] is not None and (
+                folder_key(face_index, record["identity"], record["new_face"]) in changed_folders
+                or folder_key(face_index, record["identity"], record["new_face"]) not in snapshot):
+            searched.add(num)
+
+    # The other faces only if a face of a changed folder is nearer than their match
+    others = np.array([num for num in range(len(records)) if num not in searched], dtype=np.int64)
+    if len(changed_rows) and len(others):
+        recorded_distances = np.array([np.inf if records[num]["distance"] is None else records[num]["distance"]
+                                       for num in others], dtype=np.float32)
+        for start in range(0, len(others), chunk_size):
+            chunk = others[start:start + chunk_size]
+            nearest = np.full(len(chunk), np.inf, dtype=np.float32)  # Running min over the chunks of changed rows
+            for row_start in range(0, len(changed_rows), chunk_size):
+                changed_matrix = face_index.embeddings(changed_rows[row_start:row_start + chunk_size])
+                nearest = np.minimum(nearest, distance_matrix(embeddings[chunk], changed_matrix,
+                                                              distance_metric).min(axis=1))
+            recorded = recorded_distances[start:start + chunk_size]
+            for offset in np.flatnonzero((nearest <= threshold) & (nearest < recorded)):
+                searched.add(int(chunk[offset]))
+
+    updates = {}
+    for num in sorted(searched):
+        match = face_index.find_nearest(embeddings[num], distance_metric, threshold)
+        if match is None:
+            updates[num] = {"identity": None, "new_face": False, "distance": None}
+        else:
+            updates[num] = {"identity": match["identity"], "new_face": match["new_face"],
+                            "distance": match["distance"]}
+    print(f"Re-match: {len(changed_folders)} changed folders, {len(updates)} of {len(records)} faces searched again.")
+    return updates, snapshot
@@ -0,0 +1,368 @@
+# Local journal of the Face Recognition runs (SQLite).
+# For every Eagle item it keeps the content hash of the image, the outcome and the tags, and for every image
+# content it keeps the detected faces and their embeddings. Everything is saved per settings (model, detector,
+# expand percentage), so changing a setting only invalidates the entries made with the old settings.
+# Re-runs skip the items already done, and an interrupted run continues where it stopped (also in the item
+# listing, with the page cursor). The match of every face of every item is kept too, for the re-match (rematch.py).
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+# Outcomes of an item that don't need to be processed again
+final_statuses = ("faces", "no_face", "broken")
+
+
+def content_hash(file_bytes):
+    """
+    Returns the hash of the content of a file (the same image always has the same hash).
+    """
+    return hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+
+
+def to_json(value):
+    """
+    Converts to JSON a dictionary that can contain numpy numbers (e.g. the facial area from the detector).
+    """
+    return json.dumps(value, default=lambda number: number.item() if hasattr(number, 'item') else str(number))
+
+
+def settings_key(settings):
+    """
+    Returns a short key of the settings that change the detected faces and embeddings.
+    """
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class RunJournal:
+    """
+    SQLite journal of the processed items and of the faces found in every image content.
+    It can be used from several threads (the reader, the main thread and the tag writer).
+    """
+
+    def __init__(self, journal_path, settings):
+        """
+        Args:
+            journal_path: The path of the SQLite file.
+            settings: A dictionary of the settings that change the results (model_name, detector_backend, ...).
+        """
+        self.settings = settings
+        self.key = settings_key(settings)
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(journal_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS items (
+                item_id TEXT NOT NULL,
+                settings_key TEXT NOT NULL,
+                content_hash TEXT,
+                size INTEGER,
+                status TEXT NOT NULL,
+                tags TEXT NOT NULL,
+                tags_written INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (item_id, settings_key)
+            );
+            CREATE TABLE IF NOT EXISTS images (
+                content_hash TEXT NOT NULL,
+                settings_key TEXT NOT NULL,
+                status TEXT NOT NULL,
+                PRIMARY KEY (content_hash, settings_key)
+            );
+            CREATE TABLE IF NOT EXISTS faces (
+                content_hash TEXT NOT NULL,
+                settings_key TEXT NOT NULL,
+                face_num INTEGER NOT NULL,
+                facial_area TEXT NOT NULL,
+                save_area TEXT NOT NULL,
+                confidence REAL,
+                embedding BLOB NOT NULL,
+                PRIMARY KEY (content_hash, settings_key, face_num)
+            );
+            CREATE TABLE IF NOT EXISTS matches (
+                item_id TEXT NOT NULL,
+                settings_key TEXT NOT NULL,
+                face_num INTEGER NOT NULL,
+                identity TEXT,
+                new_face INTEGER NOT NULL,
+                distance REAL,
+                embedding BLOB NOT NULL,
+                PRIMARY KEY (item_id, settings_key, face_num)
+            );
+            CREATE TABLE IF NOT EXISTS settings (
+                settings_key TEXT PRIMARY KEY,
+                settings TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS state (
+                name TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        """)
+        self.connection.execute("INSERT OR IGNORE INTO settings VALUES (?, ?)",
+                                (self.key, json.dumps(settings, sort_keys=True)))
+        self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    # ----------------------------------------------------------- Items
+
+    def is_done(self, item):
+        """
+        Checks if an item was already processed with the same settings and its file didn't change (same size in
+        Eagle). One primary key lookup, the file is not read. The tags that were not written are sent again
+        with get_unwritten_tags.
+
+        Args:
+            item: The Eagle item (from the item list).
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT size, status FROM items WHERE item_id = ? AND settings_key = ?",
+                (item['id'], self.key)).fetchone()
+        if row is None:
+            return False
+        size, status = row
+        return status in final_statuses and size == item.get('size')
+
+    def record_item(self, item, item_content_hash, status, tags):
+        """
+        Records the outcome of an item (its tags are not written to Eagle yet).
+
+        Args:
+            item: The Eagle item.
+            item_content_hash: The content hash of the image (None if the file couldn't be read).
+            status: "faces", "no_face" or "broken".
+            tags: The tags to write to the item (all the tags of the item).
+        """
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, 0, ?)",
+                (item['id'], self.key, item_content_hash, item.get('size'), status, json.dumps(tags), time.time()))
+            self.connection.commit()
+
+    def mark_tags_written(self, item_id):
+        """
+        Records that the tags of the item were written to Eagle.
+        """
+        with self.lock:
+            self.connection.execute("UPDATE items SET tags_written = 1 WHERE item_id = ? AND settings_key = ?",
+                                    (item_id, self.key))
+            self.connection.commit()
+
+    def get_unwritten_tags(self):
+        """
+        Returns the items that were processed but their tags were not written (e.g. the run was interrupted).
+
+        Returns:
+            A list of (item_id, tags).
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT item_id, tags FROM items WHERE settings_key = ? AND tags_written = 0",
+                (self.key,)).fetchall()
+        return [(item_id, json.loads(tags)) for item_id, tags in rows]
+
+    def set_item_tags(self, item_id, tags):
+        """
+        Replaces the tags of a processed item, they are written to Eagle by the tag writer (or by the next run
+        with get_unwritten_tags).
+        """
+        with self.lock:
+            self.connection.execute(
+                "UPDATE items SET tags = ?, tags_written = 0, updated_at = ? WHERE item_id = ? AND settings_key = ?",
+                (json.dumps(tags), time.time(), item_id, self.key))
+            self.connection.commit()
+
+    # ----------------------------------------------------------- State
+
+    def get_state(self, name, default=None):
+        """
+        Returns a value saved with set_state (e.g. the watermark of the daemon mode), or default.
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM state WHERE name = ?", (name,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def set_state(self, name, value):
+        """
+        Saves a value (anything that can be saved as JSON) that is kept between the runs.
+        """
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO state VALUES (?, ?)", (name, json.dumps(value)))
+            self.connection.commit()
+
+    # ----------------------------------------------------------- Faces
+
+    def get_faces(self, image_content_hash):
+        """
+        Returns the faces found in an image content with the same settings.
+
+        Args:
+            image_content_hash: The content hash of the image.
+
+        Returns:
+            (status, faces) with status "faces" or "no_face", each face has "facial_area", "save_area",
+            "confidence" and "embedding". None if the image content was never processed.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT status FROM images WHERE content_hash = ? AND settings_key = ?",
+                (image_content_hash, self.key)).fetchone()
+            if row is None:
+                return None
+            rows = self.connection.execute(
+                "SELECT facial_area, save_area, confidence, embedding FROM faces "
+                "WHERE content_hash = ? AND settings_key = ? ORDER BY face_num",
+                (image_content_hash, self.key)).fetchall()
+
+        faces = [{'facial_area': json.loads(facial_area), 'save_area': json.loads(save_area),
+                  'confidence': confidence, 'embedding': np.frombuffer(embedding, dtype=np.float32).tolist()}
+                 for facial_area, save_area, confidence, embedding in rows]
+        return row[0], faces
+
+    def record_faces(self, image_content_hash, status, faces):
+        """
+        Records the faces found in an image content (with their embeddings).
+
+        Args:
+            image_content_hash: The content hash of the image.
+            status: "faces" or "no_face".
+            faces: The faces from process_images (with "facial_area", "save_area", "confidence" and "embedding").
+        """
+        rows = [(image_content_hash, self.key, face_num, to_json(face['facial_area']), to_json(face['save_area']),
+                 None if face.get('confidence') is None else float(face['confidence']),
+                 np.asarray(face['embedding'], dtype=np.float32).tobytes())
+                for face_num, face in enumerate(faces) if face.get('embedding') is not None]
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?)",
+                                    (image_content_hash, self.key, status))
+            self.connection.execute("DELETE FROM faces WHERE content_hash = ? AND settings_key = ?",
+                                    (image_content_hash, self.key))
+            self.connection.executemany("INSERT INTO faces VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.connection.commit()
+
+    # ----------------------------------------------------------- Matches
+
+    def record_matches(self, item_id, matches):
+        """
+        Records the match of every face of an item (replaces the matches of the last time it was processed).
+
+        Args:
+            item_id: The Eagle id of the item.
+            matches: A list of dictionaries with "identity" (None: no match), "new_face", "distance" and
+                     "embedding".
+        """
+        rows = [(item_id, self.key, face_num, match['identity'], int(bool(match['new_face'])),
+                 None if match['distance'] is None else float(match['distance']),
+                 np.asarray(match['embedding'], dtype=np.float32).tobytes())
+                for face_num, match in enumerate(matches)]
+        with self.lock:
+            self.connection.execute("DELETE FROM matches WHERE item_id = ? AND settings_key = ?",
+                                    (item_id, self.key))
+            self.connection.executemany("INSERT INTO matches VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.connection.commit()
+
+    def get_matches(self):
+        """
+        Returns the matches of the faces of all the processed items.
+
+        Returns:
+            (records, embeddings): records is a list of dictionaries with "item_id", "face_num", "identity",
+            "new_face" and "distance", embeddings is the (n, dimensions) float32 matrix of their embeddings.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT item_id, face_num, identity, new_face, distance, embedding FROM matches "
+                "WHERE settings_key = ? ORDER BY item_id, face_num", (self.key,)).fetchall()
+        records = [{"item_id": item_id, "face_num": face_num, "identity": identity, "new_face": bool(new_face),
+                    "distance": distance} for item_id, face_num, identity, new_face, distance, embedding in rows]
+        embeddings = (np.stack([np.frombuffer(row[5], dtype=np.float32) for row in rows]) if rows
+                      else np.zeros((0, 0), dtype=np.float32))
+        return records, embeddings
+
+    def update_matches(self, records):
+        """
+        Saves new matches of faces (from the re-match).
+
+        Args:
+            records: A list of dictionaries with "item_id", "face_num", "identity", "new_face" and "distance".
+        """
+        with self.lock:
+            self.connection.executemany(
+                "UPDATE matches SET identity = ?, new_face = ?, distance = ? "
+                "WHERE item_id = ? AND settings_key = ? AND face_num = ?",
+                [(record['identity'], int(bool(record['new_face'])), record['distance'], record['item_id'],
+                  self.key, record['face_num']) for record in records])
+            self.connection.commit()
+
+
+class PageCursor:
+    """
+    Checkpoint of the item listing: the first page of the folder that still has items that are not done. It is
+    saved in the journal, an interrupted run continues the listing from that page instead of the first page.
+    """
+
+    def __init__(self, journal, name):
+        """
+        Args:
+            journal: The RunJournal where the cursor is saved.
+            name: The name of the cursor (e.g. with the folder id).
+        """
+        self.journal = journal
+        self.name = name
+        self.lock = threading.Lock()
+        self.start_page = journal.get_state(name, 0)
+        self._next_page = self.start_page  # First page with items not done
+        self._remaining = {}  # {page: number of items not done}
+        self._item_pages = {}  # {item id: page} of the items not done
+        self.complete = False  # True when the listing reached the last page of the folder
+
+    def add_page(self, page, items):
+        """
+        Records the items of a listed page (only the items that will be processed).
+        """
+        with self.lock:
+            self._remaining[page] = len(items)
+            for item in items:
+                self._item_pages[item['id']] = page
+        self._advance()
+
+    def done(self, item, finished=True):
+        """
+        Records that an item is done (processed, skipped or failed).
+
+        Args:
+            item: The Eagle item.
+            finished: False if the item must be processed again (e.g. its file couldn't be asked to Eagle): its page
+                      is never complete, the cursor stays at or before it and the next run lists it again.
+        """
+        with self.lock:
+            page = self._item_pages.pop(item['id'], None)
+            if page is None or not finished:
+                return
+            self._remaining[page] -= 1
+        self._advance()
+
+    def _advance(self):
+        with self.lock:
+            next_page = self._next_page
+            while self._remaining.get(next_page) == 0:
+                del self._remaining[next_page]
+                next_page += 1
+            if next_page != self._next_page:
+                self._next_page = next_page
+                self.journal.set_state(self.name, next_page)
+
+    def reset(self):
+        """
+        The listing is complete (complete is True) and its items are done: the next run lists the folder from the
+        first page.
+        """
+        self.journal.set_state(self.name, 0)
@@ -0,0 +1,58 @@
+# Tiled detection of very large images (face_pipeline.detect_faces_tiled) with a fake detector: the faces are
+# painted as rectangles in their own color channel, the detector finds the rectangles in the image it is given.
+import numpy as np
+import pytest
+
+pytest.importorskip("deepface")
+import face_pipeline  # noqa: E402
+
+face_channels = {}  # {color channel: face name}
+
+
+def fake_extract_faces(img_path, enforce_detection=True, detector_backend=None, align=True, **kwargs):
+    img = img_path
+    found = []
+    for channel in face_channels:
+        ys, xs = np.nonzero(img[:, :, channel] > 200)
+        if len(xs):
+            x, y = int(xs.min()), int(ys.min())
+            found.append({'face': img[y:ys.max() + 1, x:xs.max() + 1], 'confidence': 0.99,
+                          'facial_area': {'x': x, 'y': y, 'w': int(xs.max()) + 1 - x, 'h': int(ys.max()) + 1 - y}})
+    if not found:  # Same as DeepFace with enforce_detection=False: the whole image with no confidence
+        found.append({'face': img, 'confidence': 0,
+                      'facial_area': {'x': 0, 'y': 0, 'w': img.shape[1], 'h': img.shape[0]}})
+    return found
+
+
+@pytest.fixture
+def painted_image(monkeypatch):
+    monkeypatch.setattr(face_pipeline.DeepFace, "extract_faces", fake_extract_faces)
+    img = np.zeros((2000, 9000, 3), dtype=np.uint8)
+    faces = {"big_on_seam": (1200, 600, 600, 600),  # Bigger than the overlap, cut by the tiles at x=1280 and 1600
+             "small_on_seam": (1550, 200, 100, 100),  # Cut by the first tile, complete in the second one
+             "small": (5000, 1500, 60, 60)}
+    face_channels.clear()
+    for channel, (name, (x, y, w, h)) in enumerate(faces.items()):
+        img[y:y + h, x:x + w, channel] = 255
+        face_channels[channel] = name
+    return img, faces
+
+
+def test_faces_on_the_tile_seams_are_found_once(painted_image):
+    img, faces = painted_image
+    found = face_pipeline.detect_faces(img, "fake", 0, max_side=None,
+                                       tiling={"min_pixels": 1_000_000, "tile_size": 1600, "overlap": 320,
+                                               "threads": 2})
+
+    assert len(found) == len(faces)
+    for x, y, w, h in faces.values():
+        matches = [face for face in found if abs(face['facial_area']['x'] - x) <= 8
+                   and abs(face['facial_area']['y'] - y) <= 8 and abs(face['facial_area']['w'] - w) <= 16
+                   and abs(face['facial_area']['h'] - h) <= 16]
+        assert len(matches) == 1
+
+
+def test_tile_positions_cover_the_image():
+    positions = face_pipeline.tile_positions(9000, 1600, 320)
+    assert positions[0] == 0 and positions[-1] == 9000 - 1600
+    assert all(second - first <= 1600 - 320 for first, second in zip(positions, positions[1:]))
@@ -0,0 +1,229 @@
+# Unknown faces of the Database ("[new_faces]\New Face_{num}" folders).
+# The faces with no match are grouped online: a face joins the nearest "New Face" cluster (distance to the
+# average face of the cluster) or opens a new one, so the same stranger doesn't get one folder per photo.
+# The folder and file names are given from counters, the folders are listed once instead of checking every name.
+import hashlib
+import os
+import re
+
+import numpy as np
+
+from face_index import find_distances
+
+
+class NameAllocator:
+    """
+    Gives unique folder and image names. Every folder is listed once, then the names are taken from counters
+    (the file system is not checked name by name).
+    """
+
+    def __init__(self):
+        self._names = {}  # {folder path: set of the lower case names in the folder}
+        self._counters = {}  # {(folder path, name): next number}
+
+    def clear(self):
+        """
+        Forgets the listed folders (e.g. the Database folder was changed by the user), they are listed again.
+        """
+        self._names.clear()
+        self._counters.clear()
+
+    def _folder_names(self, folder_path):
+        folder_path = os.path.normpath(folder_path)
+        if folder_path not in self._names:
+            names = os.listdir(folder_path) if os.path.isdir(folder_path) else []
+            self._names[folder_path] = {name.lower() for name in names}
+        return self._names[folder_path]
+
+    def _next_number(self, folder_path, pattern, key):
+        """
+        Returns the next free number of a name pattern in a folder (bigger than all the numbers in use).
+        """
+        counter_key = (os.path.normpath(folder_path), key)
+        if counter_key not in self._counters:
+            numbers = [int(found.group(1)) for found in map(pattern.fullmatch, self._folder_names(folder_path))
+                       if found]
+            self._counters[counter_key] = max(numbers, default=-1) + 1
+        number = self._counters[counter_key]
+        self._counters[counter_key] += 1
+        return number
+
+    def image_path(self, folder_path, original_name, ext=".jpg"):
+        """
+        Returns a free image path in a folder: "{original_name}.jpg", or "{original_name}_{num}.jpg" if the name
+        is used. The name is reserved.
+        """
+        names = self._folder_names(folder_path)
+        file_name = f"{original_name}{ext}"
+        if file_name.lower() in names:
+            pattern = re.compile(re.escape(f"{original_name}_".lower()) + r"(\d+)" + re.escape(ext.lower()))
+            file_name = f"{original_name}_{self._next_number(folder_path, pattern, original_name.lower())}{ext}"
+        names.add(file_name.lower())
+        return os.path.join(folder_path, file_name)
+
+    def create_folder(self, base_path, prefix):
+        """
+        Creates the folder "{prefix}{num}" in base_path with the next free number and returns its path.
+        """
+        pattern = re.compile(re.escape(prefix.lower()) + r"(\d+)")
+        while True:
+            folder_name = f"{prefix}{self._next_number(base_path, pattern, prefix.lower())}"
+            folder_path = os.path.join(base_path, folder_name)
+            self._folder_names(base_path).add(folder_name.lower())
+            try:
+                os.makedirs(folder_path)
+                break
+            except FileExistsError:  # Created by another process since the folder was listed, take the next one
+                continue
+        self._names[os.path.normpath(folder_path)] = set()
+        return folder_path
+
+
+class UnknownFaceClusters:
+    """
+    Online clusters of the unknown faces, one cluster per "New Face_{num}" folder. A cluster is its average face
+    (sum and count of the embeddings). The clusters are kept in memory and saved in a sidecar file next to the
+    face index, the "New Face" folders of the index that are not in it are added when it is loaded.
+    """
+
+    def __init__(self, state_path, new_faces_path, names, distance_metric, threshold, prefix="New Face_"):
+        """
+        Args:
+            state_path: The path of the sidecar file (.npz).
+            new_faces_path: The path to the "[new_faces]" folder of the Database.
+            names: The NameAllocator used to create the new folders.
+            distance_metric: The distance metric to use.
+            threshold: Max distance between a face and the average face of a cluster to join it.
+            prefix: The prefix of the cluster folders.
+        """
+        self.state_path = state_path
+        self.new_faces_path = new_faces_path
+        self.names = names
+        self.distance_metric = distance_metric
+        self.threshold = threshold
+        self.prefix = prefix
+
+        self.folders = []  # Folder name of every cluster
+        self._rows = {}  # {folder name: cluster number}
+        self._sums = np.zeros((0, 0), dtype=np.float64)
+        self._counts = np.zeros(0, dtype=np.int64)
+        self.face_index = None  # The FaceIndex of the last load (the digests of the folders are saved from it)
+        self.changes = 0  # Changes since the last save
+
+    def __len__(self):
+        return len(self.folders)
+
+    def load(self, face_index):
+        """
+        Loads the clusters from the sidecar file and makes them match the "New Face" folders of the face index
+        (the folders that were renamed or deleted are removed, the ones that are missing are added, and the ones
+        whose images changed since the save are rebuilt from the face index).
+
+        Args:
+            face_index: The FaceIndex of the Database (already synced with the Database folder).
+        """
+        self.folders = []
+        self._rows = {}
+        self._sums = np.zeros((0, 0), dtype=np.float64)
+        self._counts = np.zeros(0, dtype=np.int64)
+        self.face_index = face_index
+
+        index_clusters = self._index_clusters(face_index)
+        saved = {}
+        if os.path.exists(self.state_path):
+            with np.load(self.state_path) as state:
+                if state["sums"].shape[1:] == (face_index.dimensions,) and "digests" in state.files:
+                    saved = {str(folder): (state["sums"][num], int(state["counts"][num]), str(state["digests"][num]))
+                             for num, folder in enumerate(state["folders"])}
+
+        for folder, (rows, digest) in index_clusters.items():
+            # Images added, removed or changed in the folder since the save (e.g. by the user): rebuilt from the index
+            if folder in saved and saved[folder][1] == len(rows) and saved[folder][2] == digest:
+                self._set_cluster(folder, *saved[folder][:2])
+            else:
+                self._set_cluster(folder, face_index.embeddings(rows).sum(axis=0, dtype=np.float64),
+                                  len(rows))
+        self.changes = 0
+        print(f"Unknown faces: {len(self.folders)} clusters.")
+
+    @staticmethod
+    def _index_clusters(face_index):
+        """
+        Returns the rows of the face index and the digest of the images of every "New Face" folder.
+
+        Returns:
+            {folder name: (list of rows, digest)}
+        """
+        folder_rows, folder_images = {}, {}
+        for row, entry in enumerate(face_index.entries):
+            if entry["new_face"]:
+                folder_rows.setdefault(entry["identity"], []).append(row)
+                folder_images.setdefault(entry["identity"], []).append(
+                    f"{entry['path']}|{entry.get('size')}|{entry.get('mtime')}")
+        return {folder: (rows, hashlib.sha1("\n".join(sorted(folder_images[folder])).encode("utf-8")).hexdigest())
+                for folder, rows in folder_rows.items()}
+
+    def save(self):
+        """
+        Saves the clusters to the sidecar file, with the digest of the images of every folder in the face index.
+        """
+        index_clusters = self._index_clusters(self.face_index) if self.face_index is not None else {}
+        digests = [index_clusters[folder][1] if folder in index_clusters else "" for folder in self.folders]
+        with open(self.state_path + ".tmp", "wb") as file:
+            np.savez(file, folders=np.array(self.folders, dtype=str), sums=self._sums[:len(self.folders)],
+                     counts=self._counts[:len(self.folders)], digests=np.array(digests, dtype=str))
+        os.replace(self.state_path + ".tmp", self.state_path)
+        self.changes = 0
+
+    def _set_cluster(self, folder, embedding_sum, count):
+        num = self._rows.get(folder)
+        if num is None:
+            num = len(self.folders)
+            if num >= len(self._counts):  # Grow the arrays (doubled to keep adding cheap)
+                capacity = max(16, 2 * len(self._counts))
+                sums = np.zeros((capacity, len(embedding_sum)), dtype=np.float64)
+                if num:
+                    sums[:num] = self._sums[:num]
+                counts = np.zeros(capacity, dtype=np.int64)
+                counts[:num] = self._counts[:num]
+                self._sums, self._counts = sums, counts
+            self.folders.append(folder)
+            self._rows[folder] = num
+        self._sums[num] = embedding_sum
+        self._counts[num] = count
+        self.changes += 1
+
+    def add(self, folder, embedding):
+        """
+        Adds a face to the cluster of a folder (e.g. a face matched with a face of the folder).
+        """
+        embedding = np.asarray(embedding, dtype=np.float64)
+        num = self._rows.get(folder)
+        if num is None:
+            self._set_cluster(folder, embedding, 1)
+        else:
+            self._set_cluster(folder, self._sums[num] + embedding, self._counts[num] + 1)
+
+    def assign(self, embedding):
+        """
+        Finds the cluster of an unknown face, or creates a new "New Face" folder if no cluster is near enough.
+        The face is added to the cluster.
+
+        Returns:
+            (folder path, True if the folder is new).
+        """
+        count = len(self.folders)
+        folder = None
+        if count:
+            centroids = self._sums[:count] / self._counts[:count, None]
+            distances = find_distances(centroids, np.linalg.norm(centroids, axis=1), embedding,
+                                       self.distance_metric)
+            nearest = int(np.argmin(distances))
+            if distances[nearest] <= self.threshold:
+                folder = self.folders[nearest]
+
+        is_new = folder is None
+        if is_new:
+            folder = os.path.basename(self.names.create_folder(self.new_faces_path, self.prefix))
+        self.add(folder, embedding)
+        return os.path.join(self.new_faces_path, folder), is_new
@@ -0,0 +1,156 @@
+# Leases of the Eagle items for the worker mode: several copies of the script on the same computer process the
+# same Eagle folder, and every item is claimed by one worker with a lease in a shared SQLite file.
+# A worker renews its leases while it runs, the leases of a worker that stopped expire and their items are
+# claimed again by the other workers. The done items are kept in the store and never claimed again (an item
+# tagged only "Extracted_FaceReco" is still listed, processing it again would save its faces twice).
+# The same store gives the lock of the Database writes (face index, folders and image names), so only one worker
+# writes to the Database at a time. The SQLite file must be on a local disk (the file locks of network drives are
+# not reliable).
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+class LeaseStore:
+    """
+    Shared store of the item leases (SQLite file on a local disk) and lock of the Database writes.
+    It can be used from several threads (the feeder, the main thread and the tag writer).
+    """
+
+    def __init__(self, store_path, worker_id=None, lease_seconds=300, lock_timeout=600):
+        """
+        Args:
+            store_path: The path of the SQLite file shared by all the workers.
+            worker_id: The name of this worker (None: computer name and process id).
+            lease_seconds: How long an item stays claimed if the worker stops (the leases are renewed while the
+                           worker runs).
+            lock_timeout: Seconds between two "waiting" messages while another worker holds the Database lock
+                          (the wait has no limit: the lock is released when the other worker stops).
+        """
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.lock = threading.Lock()
+        self.claimed = 0
+        self.reclaimed = 0  # Claimed from an expired lease of another worker
+        self.skipped = 0  # Claimed by another worker
+
+        self.connection = sqlite3.connect(store_path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS leases (
+                item_id TEXT PRIMARY KEY,
+                worker_id TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                done INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+
+        # The Database lock is an exclusive transaction on a second file (released if the worker process dies)
+        self._database_lock = threading.Lock()
+        self._lock_connection = sqlite3.connect(store_path + "-lock", timeout=lock_timeout, check_same_thread=False,
+                                                isolation_level=None)
+        self._lock_connection.execute("CREATE TABLE IF NOT EXISTS database_lock (worker_id TEXT)")
+
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._renew_periodically, daemon=True)
+        self._heartbeat.start()
+        print(f"Worker mode: worker '{self.worker_id}', leases in '{store_path}'")
+
+    def close(self):
+        """
+        Stops renewing the leases and releases the items that are not done (the other workers can claim them at
+        once).
+        """
+        self._stop.set()
+        self._heartbeat.join()
+        with self.lock:
+            self.connection.execute("DELETE FROM leases WHERE worker_id = ? AND done = 0", (self.worker_id,))
+            self.connection.close()
+        self._lock_connection.close()
+
+    # ----------------------------------------------------------- Leases
+
+    def claim(self, item_id):
+        """
+        Claims an item for this worker, if it is not done and no other worker has a lease on it that is not
+        expired.
+
+        Returns:
+            True if the item is claimed by this worker.
+        """
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.connection.execute("SELECT worker_id, expires_at, done FROM leases WHERE item_id = ?",
+                                              (item_id,)).fetchone()
+                claimed = row is None or (not row[2] and (row[0] == self.worker_id or row[1] < now))
+                if claimed:
+                    self.connection.execute("INSERT OR REPLACE INTO leases VALUES (?, ?, ?, 0)",
+                                            (item_id, self.worker_id, now + self.lease_seconds))
+                self.connection.execute("COMMIT")
+            except sqlite3.Error:
+                self.connection.execute("ROLLBACK")
+                raise
+
+            if not claimed:
+                self.skipped += 1
+            else:
+                self.claimed += 1
+                if row is not None and row[0] != self.worker_id:
+                    self.reclaimed += 1
+        return claimed
+
+    def release(self, item_id, done=True):
+        """
+        Releases the lease of an item of this worker.
+
+        Args:
+            item_id: The id of the item.
+            done: True if the item is done (never claimed again), False to let any worker claim it.
+        """
+        with self.lock:
+            if done:
+                self.connection.execute("UPDATE leases SET done = 1 WHERE item_id = ? AND worker_id = ?",
+                                        (item_id, self.worker_id))
+            else:
+                self.connection.execute("DELETE FROM leases WHERE item_id = ? AND worker_id = ?",
+                                        (item_id, self.worker_id))
+
+    def _renew_periodically(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            try:
+                with self.lock:
+                    self.connection.execute(
+                        "UPDATE leases SET expires_at = ? WHERE worker_id = ? AND done = 0",
+                        (time.time() + self.lease_seconds, self.worker_id))
+            except sqlite3.Error as e:  # Handel Errors, the next renewal can work
+                print(f"Couldn't renew the leases: {e}")
+
+    # ----------------------------------------------------------- Database lock
+
+    @contextmanager
+    def database_lock(self):
+        """
+        Holds the lock of the Database writes of all the workers (waits until the other workers release it, e.g.
+        the first sync of a large Database can hold it for a long time).
+        """
+        with self._database_lock:
+            while True:
+                try:
+                    self._lock_connection.execute("BEGIN EXCLUSIVE")
+                    break
+                except sqlite3.OperationalError as e:  # Timeout while another worker holds the lock
+                    if "locked" not in str(e):
+                        raise
+                    print("Waiting for the Database lock (another worker is writing to the Database)...")
+            try:
+                yield
+            finally:
+                self._lock_connection.execute("COMMIT")
+
+    def print_stats(self):
+        print(f"Worker '{self.worker_id}': {self.claimed} items claimed ({self.reclaimed} from expired leases), "
+              f"{self.skipped} items claimed by other workers.")